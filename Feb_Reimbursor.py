@@ -5,7 +5,9 @@ Simple script to press Alt+Tab, move mouse to center, and click
 import pyautogui
 import time
 from pathlib import Path
-from combine_drive_files import process_file, combine_pdfs
+from combine_drive_files import combine_links
+from drive_cache import ConversionCache, DownloadCache
+from stage_timing import StageTimings
 
 def parse_row_input(row_text):
     """
@@ -33,6 +35,18 @@ def get_value(index):
         return values[index - 1].strip()
     return ""
 
+def get_drive_links(*cells):
+    """
+    Collect the Google Drive links from one or more cells, in order.
+    A cell may hold several links separated by spaces, commas or newlines.
+    """
+    links = []
+    for cell in cells:
+        for part in cell.replace(',', ' ').split():
+            if 'drive.google.com' in part:
+                links.append(part)
+    return links
+
 def get_month_name_from_date(date_string):
     """
     Extract month name from a date string in format 'month/day/year'.
@@ -199,12 +213,14 @@ while True:
         pyautogui.press('tab')
         pyautogui.write(get_value(n+4))  # Value 21 - Total Expense
 
-        # Combine Google Drive files (Value 22 and Value 23)
-        link1 = get_value(n+5)  # Value 22 - First Google Drive link
-        link2 = get_value(n+6)  # Value 23 - Second Google Drive link
+        # Combine Google Drive files (Value 22 and Value 23, each may list several links)
+        links = get_drive_links(
+            get_value(n+5),  # Value 22 - First Google Drive link(s)
+            get_value(n+6),  # Value 23 - Second Google Drive link(s)
+        )
 
-        # Only combine if both links are provided
-        if link1 and link2:
+        # Only combine if at least two files are provided
+        if len(links) >= 2:
             print("\n" + "=" * 60)
             print("Combining Google Drive files...")
             print("=" * 60)
@@ -214,22 +230,13 @@ while True:
                 project_dir = Path(__file__).parent.absolute()
                 temp_dir = project_dir / "temp"
                 outputs_dir = project_dir / "outputs"
+                cache = DownloadCache(project_dir / "cache")
+                conversions = ConversionCache(project_dir / "cache" / "converted")
                 
                 # Create directories if they don't exist
                 temp_dir.mkdir(exist_ok=True)
                 outputs_dir.mkdir(exist_ok=True)
                 
-                # Process both files
-                pdf_paths = []
-                
-                print("Processing first file...")
-                pdf1 = process_file(link1, str(temp_dir))
-                pdf_paths.append(pdf1)
-                
-                print("\nProcessing second file...")
-                pdf2 = process_file(link2, str(temp_dir))
-                pdf_paths.append(pdf2)
-                
                 # Create output filename: "Value 8 - Value 2.pdf"
                 first_name = get_value(8)  # Value 8 - First Name
                 amount = get_value(2)      # Value 2 - Amount
@@ -237,11 +244,14 @@ while True:
                 output_filename = f"{first_name}-{amount}-{itom}.pdf"
                 output_path = outputs_dir / output_filename
                 
-                # Combine PDFs
-                print(f"\nCombining files into: {output_filename}")
-                combine_pdfs(pdf_paths, str(output_path))
+                # Download all files at the same time and combine them in order
+                print(f"\nCombining {len(links)} files into: {output_filename}")
+                timings = StageTimings()
+                combine_links(links, str(output_path), str(temp_dir), cache=cache, conversions=conversions,
+                              timings=timings)
                 
                 print(f"\nSUCCESS! Combined PDF saved as: {output_path}")
+                print(timings.format_table())
                 
                 # Clean up temporary files
                 print("\nCleaning up temporary files...")
@@ -259,7 +269,7 @@ while True:
                 import traceback
                 traceback.print_exc()
         else:
-            print("\nSkipping file combination - one or both Google Drive links are missing.")
+            print("\nSkipping file combination - fewer than two Google Drive links were provided.")
     else:
         break
     n += 8
@@ -0,0 +1,246 @@
+"""
+Admission control for combine pipelines.
+
+A burst of combines (say, a whole club at a reimbursement deadline) would
+otherwise start them all at once, each holding downloads, converted PDFs and
+PDF readers in memory, until the instance runs out of memory or disk. An
+AdmissionController lets at most `max_pipelines` pipelines run at the same
+time and stops admitting new ones while the input bytes held by running
+pipelines exceed `max_bytes`. Requests that can't start right away wait in a
+short FIFO queue; when the queue is full, or a request has waited `max_wait`
+seconds, acquire() raises Overloaded with a Retry-After estimate so the server
+can answer 429 at once instead of piling up work.
+
+Bytes are charged as a pipeline actually downloads and converts (feed its
+StageTimings spans to Slot.observe_span), so a running pipeline is never
+blocked half-way; only new pipelines wait.
+
+Usage:
+    with admission.acquire() as slot:
+        timings.add_listener(slot.observe_span)
+        run the pipeline
+
+Settings can be overridden with environment variables:
+    FEB_ADMISSION_PIPELINES  combines that run at the same time (default: 4)
+    FEB_ADMISSION_BYTES      input bytes running combines may hold before new ones wait,
+                             0 for no limit (default: 512 MB)
+    FEB_ADMISSION_QUEUE      combines that may wait for a turn (default: 8)
+    FEB_ADMISSION_WAIT       seconds a combine may wait before it is turned away (default: 10)
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+
+ADMISSION_PIPELINES = int(os.environ.get("FEB_ADMISSION_PIPELINES", 4))
+ADMISSION_BYTES = int(os.environ.get("FEB_ADMISSION_BYTES", 512 * 1024 * 1024))
+ADMISSION_QUEUE = int(os.environ.get("FEB_ADMISSION_QUEUE", 8))
+ADMISSION_WAIT = float(os.environ.get("FEB_ADMISSION_WAIT", 10))
+
+# Weight of the latest pipeline in the running average used for Retry-After
+_DURATION_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """Too many combines are running or waiting; retry after retry_after seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.admitted = False
+
+
+class Slot:
+    """An admitted pipeline; release it (or leave the with block) when it is done."""
+
+    def __init__(self, controller):
+        self._controller = controller
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self._released = False
+
+    def add_bytes(self, size):
+        """Charge size more input bytes to this pipeline."""
+        if size and not self._released:
+            self._controller._add_bytes(self, size)
+
+    def observe_span(self, span):
+        """StageTimings on_span hook: charge downloaded and converted files."""
+        if span['stage'] in ('download', 'convert') and span.get('bytes'):
+            self.add_bytes(span['bytes'])
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    """Bounded pipelines, bytes in flight and wait queue; see the module docstring."""
+
+    def __init__(self, max_pipelines=ADMISSION_PIPELINES, max_bytes=ADMISSION_BYTES, max_queued=ADMISSION_QUEUE,
+                 max_wait=ADMISSION_WAIT):
+        """
+        Args:
+            max_pipelines: Pipelines that run at the same time
+            max_bytes: Input bytes running pipelines may hold before new
+                ones wait (0 for no limit)
+            max_queued: Pipelines that may wait for a turn
+            max_wait: Seconds a pipeline may wait before Overloaded is raised
+        """
+        self.max_pipelines = max_pipelines
+        self.max_bytes = max_bytes
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.running = 0
+        self.bytes_in_flight = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._average_seconds = None
+        self._lock = threading.Lock()
+
+    def _has_room(self):
+        if self.running >= self.max_pipelines:
+            return False
+        return not self.max_bytes or self.bytes_in_flight < self.max_bytes
+
+    def _retry_after(self):
+        """Seconds until a new request is likely to get in (whole seconds, at least 1)."""
+        average = self._average_seconds or self.max_wait
+        turns = (len(self._waiters) + 1) / max(self.max_pipelines, 1)
+        return max(1, math.ceil(average * turns))
+
+    def _reject(self, message):
+        self.rejected += 1
+        return Overloaded(message, self._retry_after())
+
+    def _enqueue(self, wake, bounded):
+        """Admit at once (returns None) or queue a waiter; call with the lock held."""
+        if not self._waiters and self._has_room():
+            self.running += 1
+            return None
+        if bounded and len(self._waiters) >= self.max_queued:
+            raise self._reject(f"{self.running} combines running and {len(self._waiters)} waiting")
+        waiter = _Waiter(wake)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter):
+        """
+        Take a waiter that stopped waiting out of the queue.
+
+        Returns:
+            True if it was admitted in the meantime (the caller then owns a slot)
+        """
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def acquire(self, timeout=None, bounded=True):
+        """
+        Wait for room to run a pipeline (blocking).
+
+        Args:
+            timeout: Seconds to wait (default: max_wait; None with bounded=False
+                waits as long as it takes)
+            bounded: False to wait even when the queue is full (for callers
+                that are already rate-limited, such as background jobs)
+
+        Returns:
+            A Slot
+
+        Raises:
+            Overloaded if the queue is full or the wait timed out
+        """
+        if bounded and timeout is None:
+            timeout = self.max_wait
+        event = threading.Event()
+        with self._lock:
+            waiter = self._enqueue(event.set, bounded)
+        if waiter is not None and not event.wait(timeout):
+            if not self._give_up(waiter):
+                with self._lock:
+                    raise self._reject(f"No room for another combine within {timeout:.0f}s")
+        return Slot(self)
+
+    async def acquire_async(self, timeout=None):
+        """acquire() for coroutines: waits on the event loop instead of blocking a thread."""
+        if timeout is None:
+            timeout = self.max_wait
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            waiter = self._enqueue(wake, True)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if not self._give_up(waiter):
+                    with self._lock:
+                        raise self._reject(f"No room for another combine within {timeout:.0f}s")
+            except asyncio.CancelledError:
+                if self._give_up(waiter):
+                    Slot(self).release()
+                raise
+        return Slot(self)
+
+    def wait_turn(self, timeout=None):
+        """
+        Wait, as acquire() would, until a new pipeline could start, without starting one.
+
+        For callers about to join work that is already admitted or queued
+        (e.g. a request coalescing onto a background job): they still get
+        Overloaded instead of an unbounded wait when the server is saturated.
+
+        Raises:
+            Overloaded if the queue is full or the wait timed out
+        """
+        self._release(self.acquire(timeout), record=False)
+
+    def _add_bytes(self, slot, size):
+        with self._lock:
+            slot.bytes += size
+            self.bytes_in_flight += size
+
+    def _release(self, slot, record=True):
+        seconds = time.perf_counter() - slot.started
+        with self._lock:
+            slot._released = True
+            self.running -= 1
+            self.bytes_in_flight -= slot.bytes
+            if record and self._average_seconds is None:
+                self._average_seconds = seconds
+            elif record:
+                self._average_seconds += _DURATION_SMOOTHING * (seconds - self._average_seconds)
+            while self._waiters and self._has_room():
+                waiter = self._waiters.popleft()
+                waiter.admitted = True
+                self.running += 1
+                waiter.wake()
+
+    def stats(self):
+        """Current load: running and queued pipelines, bytes in flight, rejections so far."""
+        with self._lock:
+            return {'running': self.running, 'queued': len(self._waiters),
+                    'bytes_in_flight': self.bytes_in_flight, 'rejected': self.rejected}
@@ -0,0 +1,271 @@
+"""
+Local stand-in for Google Drive's download endpoints, for benchmarks and manual testing.
+
+Serves /uc?export=download&id=... the way Drive does for a few kinds of files,
+chosen per file ID:
+
+    direct    the file itself
+    scan      a virus-scan warning page; confirm=t returns the file
+    link      a warning page whose uc-download-link (with a one-off confirm
+              token) is the only way to get the file
+    signin    a Google sign-in page for every request
+    slow      the file, after a delay, trickled out in small writes
+    chunked   the file with chunked transfer encoding (no Content-Length)
+
+Byte-range requests are honoured, like Drive's download server.
+
+Point the combiner at it with FEB_DRIVE_BASE_URL, e.g.:
+    python benchmarks/drive_stub.py --port 8766
+    FEB_DRIVE_BASE_URL=http://127.0.0.1:8766 python -m server
+and combine links like https://drive.google.com/file/d/direct-pdf-small/view
+"""
+
+import argparse
+import hashlib
+import io
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import PyPDF2
+from PIL import Image, ImageDraw
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+CONTENT_TYPES = {'pdf': 'application/pdf', 'png': 'image/png', 'jpeg': 'image/jpeg'}
+
+# Seconds before a 'slow' file starts, and bytes per write while trickling
+SLOW_FIRST_BYTE = 0.5
+SLOW_WRITE_BYTES = 64 * 1024
+SLOW_WRITE_DELAY = 0.01
+
+_WARNING_PAGE = """<!DOCTYPE html><html><head><title>Google Drive - Virus scan warning</title></head>
+<body><p>Google Drive can't scan this file for viruses.</p>
+<a id="uc-download-link" class="goog-inline-block jfk-button" href="/uc?export=download&amp;confirm={token}&amp;id={file_id}">Download anyway</a>
+</body></html>"""
+
+_SIGNIN_PAGE = """<!DOCTYPE html><html><head><title>Google Drive: Sign-in</title></head>
+<body><form action="https://accounts.google.com/ServiceLogin"><p>Sign in to continue to Google Drive</p></form></body></html>"""
+
+
+def make_statement_pdf(pages, lines_per_page=45, seed=0):
+    """A text-only PDF (like a bank statement) with the given number of pages."""
+    rng = random.Random(seed)
+    writer = PyPDF2.PdfWriter()
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    })
+    font_ref = writer._add_object(font)
+    for number in range(pages):
+        page = writer.add_blank_page(612, 792)
+        lines = [f"BT /F1 9 Tf 40 {760 - 16 * i} Td (2026-{1 + number % 12:02d}-{1 + i % 28:02d}  "
+                 f"CARD PURCHASE {rng.randrange(10**8):08d}  {rng.uniform(1, 999):9.2f}) Tj ET"
+                 for i in range(lines_per_page)]
+        content = DecodedStreamObject()
+        content.set_data("\n".join(lines).encode())
+        page[NameObject('/Contents')] = writer._add_object(content)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/F1'): font_ref}),
+        })
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def make_receipt_image(width, height, fmt, seed=0, progressive=False):
+    """A photo-like receipt image (paper, text-ish strokes and sensor noise) as PNG or JPEG bytes."""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (236, 232, 222))
+    draw = ImageDraw.Draw(image)
+    line_height = max(12, height // 60)
+    for y in range(line_height * 2, height - line_height, line_height):
+        x = width // 10
+        while x < width * 0.9:
+            word = rng.randint(width // 60, width // 12)
+            draw.rectangle([x, y, x + word, y + line_height // 2], fill=(40 + rng.randrange(30),) * 3)
+            x += word + width // 50
+    noise = Image.effect_noise((width, height), 18).convert('RGB')
+    image = Image.blend(image, noise, 0.12)
+    out = io.BytesIO()
+    if fmt == 'png':
+        image.save(out, 'PNG')
+    else:
+        image.save(out, 'JPEG', quality=85, progressive=progressive)
+    return out.getvalue()
+
+
+def make_scanned_pdf(pages, seed=0):
+    """An image-only PDF (like a scanned invoice), one JPEG page per page."""
+    images = [make_receipt_image(1275, 1650, 'jpeg', seed=seed + i) for i in range(pages)]
+    frames = [Image.open(io.BytesIO(data)) for data in images]
+    out = io.BytesIO()
+    frames[0].save(out, 'PDF', save_all=True, append_images=frames[1:], resolution=150.0)
+    return out.getvalue()
+
+
+def synthetic_files():
+    """
+    The standard benchmark corpus.
+
+    Returns:
+        Dict of file ID -> (mode, file type, bytes); IDs are "<mode>-<name>"
+    """
+    statement_small = make_statement_pdf(3)
+    statement_large = make_statement_pdf(300, seed=1)
+    scanned = make_scanned_pdf(6, seed=2)
+    png = make_receipt_image(1200, 1600, 'png', seed=3)
+    jpeg = make_receipt_image(4000, 3000, 'jpeg', seed=4)
+    jpeg_progressive = make_receipt_image(4000, 3000, 'jpeg', seed=5, progressive=True)
+    return {
+        'direct-pdf-small': ('direct', 'pdf', statement_small),
+        'direct-pdf-statement': ('direct', 'pdf', statement_large),
+        'direct-pdf-scanned': ('direct', 'pdf', scanned),
+        'direct-png-receipt': ('direct', 'png', png),
+        'direct-jpeg-photo': ('direct', 'jpeg', jpeg),
+        'direct-jpeg-progressive': ('direct', 'jpeg', jpeg_progressive),
+        'scan-pdf-scanned': ('scan', 'pdf', scanned),
+        'link-pdf-statement': ('link', 'pdf', statement_large),
+        'signin-pdf-small': ('signin', 'pdf', statement_small),
+        'slow-pdf-scanned': ('slow', 'pdf', scanned),
+        'chunked-pdf-statement': ('chunked', 'pdf', statement_large),
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'DriveStub/1.0'
+    # Headers and body go out in separate writes; don't let Nagle + delayed ACK add 40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        file_id = (query.get('id') or [''])[0]
+        entry = self.server.files.get(file_id)
+        if url.path != '/uc' or entry is None:
+            return self._send_html(404, "<html><body>Not found</body></html>")
+        mode, file_type, data = entry
+        confirm = (query.get('confirm') or [''])[0]
+
+        if mode == 'signin':
+            return self._send_html(200, _SIGNIN_PAGE)
+        if mode == 'scan' and confirm != 't':
+            return self._send_html(200, _WARNING_PAGE.format(token='t', file_id=file_id))
+        if mode == 'link' and confirm != self.server.tokens[file_id]:
+            return self._send_html(200, _WARNING_PAGE.format(token=self.server.tokens[file_id], file_id=file_id))
+        self._send_file(file_id, mode, file_type, data)
+
+    def _send_html(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, file_id, mode, file_type, data):
+        start, end = 0, len(data)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            end = min(len(data), int(match.group(2)) + 1) if match.group(2) else len(data)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[file_type])
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.server.etags[file_id])
+        body = memoryview(data)[start:end]
+
+        if mode == 'chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for offset in range(0, len(body), 32 * 1024):
+                piece = body[offset:offset + 32 * 1024]
+                self.wfile.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if mode == 'slow':
+            time.sleep(SLOW_FIRST_BYTE)
+            for offset in range(0, len(body), SLOW_WRITE_BYTES):
+                self.wfile.write(body[offset:offset + SLOW_WRITE_BYTES])
+                time.sleep(SLOW_WRITE_DELAY)
+            return
+        self.wfile.write(body)
+
+
+class DriveStub:
+    """
+    Drive stand-in running on a background thread.
+
+    Usage:
+        with DriveStub(synthetic_files()) as stub:
+            os.environ["FEB_DRIVE_BASE_URL"] = stub.base_url
+    """
+
+    def __init__(self, files, host='127.0.0.1', port=0):
+        """
+        Args:
+            files: Dict of file ID -> (mode, file type, bytes), see synthetic_files()
+            host, port: Address to listen on (port 0 picks a free one)
+        """
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.files = files
+        self.server.tokens = {file_id: f"{random.randrange(16**6):06x}" for file_id in files}
+        self.server.etags = {file_id: f'"{hashlib.md5(data).hexdigest()}"' for file_id, (_, _, data) in files.items()}
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic files the way Google Drive does.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    print("Generating synthetic files...")
+    files = synthetic_files()
+    stub = DriveStub(files, args.host, args.port)
+    print(f"Drive stand-in listening on {stub.base_url} (set FEB_DRIVE_BASE_URL to this)")
+    for file_id, (mode, file_type, data) in files.items():
+        print(f"  https://drive.google.com/file/d/{file_id}/view  ({mode}, {file_type}, {len(data)} bytes)")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+End-to-end benchmarks against the local Drive stand-in (drive_stub.py).
+
+Reports p50/p95 latency, throughput and peak RSS for:
+    process_file:<file id>     download + convert one file, for each kind of file and Drive behaviour
+    combine_pdfs:<corpus>      merging local synthetic PDFs
+    combine_endpoint:<cache>   POST /combine through the Flask app with several links:
+                               cold (empty download, conversion and result caches before
+                               every run), warm (warm download/conversion caches, no
+                               result cache) or cached (answered from the result cache)
+
+Every scenario runs in a fresh Python process so its peak RSS isn't inflated by
+the ones before it; the stand-in server runs in this process.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--runs 10] [--only process_file,combine_endpoint:cold] [--json results.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(BENCH_DIR))
+
+RESULT_PREFIX = "BENCH_RESULT "
+
+ENDPOINT_LINKS = ['direct-pdf-small', 'direct-png-receipt', 'scan-pdf-scanned', 'direct-jpeg-photo']
+COMBINE_CORPORA = {
+    'statements': ['direct-pdf-statement', 'direct-pdf-small', 'direct-pdf-statement'],
+    'scanned': ['direct-pdf-scanned'] * 4,
+    'statements-streaming': ['direct-pdf-statement', 'direct-pdf-small', 'direct-pdf-statement'],
+}
+
+
+def drive_link(file_id):
+    return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
+
+
+def scenarios(file_ids):
+    names = [f"process_file:{file_id}" for file_id in file_ids]
+    names += [f"combine_pdfs:{corpus}" for corpus in COMBINE_CORPORA]
+    names += ["combine_endpoint:cold", "combine_endpoint:warm", "combine_endpoint:cached"]
+    return names
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, -(-int(fraction * 100) * len(ordered) // 100) - 1)]
+
+
+def peak_rss_mb(pid='self'):
+    """
+    Peak RSS of a process in MB.
+
+    Read from /proc (VmHWM) where available: ru_maxrss is carried over from
+    the parent across fork/exec, so it would report this runner's own peak.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if pid == 'self' else None
+
+
+# --- Child process: run one scenario ---------------------------------------
+
+def _scenario_runner(name, corpus_dir):
+    """Return (function doing one run, input bytes per run) for a scenario."""
+    kind, arg = name.split(':', 1)
+    sizes = json.loads((corpus_dir / "sizes.json").read_text())
+
+    if kind == 'process_file':
+        from combine_drive_files import process_file
+
+        def run():
+            result = process_file(drive_link(arg))
+            result.close()
+        return run, sizes[arg]
+
+    if kind == 'combine_pdfs':
+        from combine_drive_files import combine_pdfs, SpooledBuffer
+        paths = [str(corpus_dir / file_id) for file_id in COMBINE_CORPORA[arg]]
+        streaming = arg.endswith('-streaming')
+
+        def run():
+            with SpooledBuffer() as output:
+                combine_pdfs(paths, output, streaming=streaming)
+        return run, sum(sizes[file_id] for file_id in COMBINE_CORPORA[arg])
+
+    if kind == 'combine_endpoint':
+        import app as server
+        import combine_drive_files
+        import combine_service
+        from drive_cache import ConversionCache, DownloadCache, ResultCache
+        from single_flight import SingleFlight
+        client = server.app.test_client()
+        body = {'links': [drive_link(file_id) for file_id in ENDPOINT_LINKS], 'filename': 'bench.pdf'}
+        if arg == 'warm':
+            # Measure the pipeline with its inputs cached, not a replayed result
+            combine_service.result_cache = None
+        elif arg == 'cached':
+            combine_service.result_cache = ResultCache(tempfile.mkdtemp())
+
+        def run():
+            if arg == 'cold':
+                combine_service.download_cache = DownloadCache(tempfile.mkdtemp())
+                combine_service.conversion_cache = ConversionCache(tempfile.mkdtemp())
+                combine_service.result_cache = ResultCache(tempfile.mkdtemp())
+                # Nothing may be shared with the previous run either
+                server.combine_flight = SingleFlight()
+                combine_drive_files._download_flight = SingleFlight()
+            response = client.post('/combine', json=body)
+            if response.status_code != 200:
+                raise RuntimeError(f"/combine returned {response.status_code}: {response.get_data(as_text=True)}")
+        return run, sum(sizes[file_id] for file_id in ENDPOINT_LINKS)
+
+    raise ValueError(f"Unknown scenario {name}")
+
+
+def run_child(name, runs, warmup, corpus_dir):
+    sys.path.insert(0, str(REPO_ROOT / "server"))
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        run, input_bytes = _scenario_runner(name, Path(corpus_dir))
+        baseline_rss = peak_rss_mb()
+        timings, errors = [], []
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            try:
+                run()
+            except Exception as e:
+                if i >= warmup:
+                    errors.append(f"{e.__class__.__name__}: {e}")
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                timings.append(elapsed)
+        workers_rss = None
+        if 'combine_service' in sys.modules:
+            pool = sys.modules['combine_service'].cpu_pool
+            worker_peaks = [peak_rss_mb(pid) for pid in pool.worker_pids()]
+            workers_rss = max((peak for peak in worker_peaks if peak), default=None)
+            pool.shutdown()
+
+    ok_time = sum(timings) if not errors else None
+    result = {
+        'scenario': name,
+        'runs': runs,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'input_bytes': input_bytes,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'throughput_mb_s': (input_bytes * runs / ok_time / 1e6) if ok_time else None,
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        'workers_peak_rss_mb': workers_rss,
+    }
+    stdout.write(RESULT_PREFIX + json.dumps(result) + "\n")
+
+
+# --- Parent process: corpus, stand-in server, report ---------------------------
+
+def print_table(results):
+    header = f"{'scenario':42} {'runs':>4} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'MB/s':>8} {'RSS MB':>8} {'workers':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        throughput = f"{r['throughput_mb_s']:.1f}" if r['throughput_mb_s'] else "-"
+        workers = f"{r['workers_peak_rss_mb']:.0f}" if r['workers_peak_rss_mb'] else "-"
+        print(f"{r['scenario']:42} {r['runs']:>4} {r['errors']:>4} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+              f"{throughput:>8} {r['peak_rss_mb']:>8.0f} {workers:>8}")
+    failed = [r for r in results if r['first_error']]
+    for r in failed:
+        print(f"  {r['scenario']}: {r['first_error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the combiner against a local Drive stand-in.")
+    parser.add_argument('--runs', type=int, default=10, help="timed runs per scenario (default 10)")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs first (default 1)")
+    parser.add_argument('--only', help="comma-separated scenario names or prefixes (e.g. process_file)")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--corpus', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args.runs, args.warmup, args.corpus)
+
+    from drive_stub import DriveStub, synthetic_files
+
+    print("Generating synthetic files...")
+    files = synthetic_files()
+    work_dir = Path(tempfile.mkdtemp(prefix="feb_bench_"))
+    corpus_dir = work_dir / "corpus"
+    corpus_dir.mkdir()
+    for file_id, (_, _, data) in files.items():
+        (corpus_dir / file_id).write_bytes(data)
+    (corpus_dir / "sizes.json").write_text(json.dumps({file_id: len(data) for file_id, (_, _, data) in files.items()}))
+
+    names = scenarios(files)
+    if args.only:
+        wanted = [w.strip() for w in args.only.split(',')]
+        names = [n for n in names if any(n == w or n.startswith(w + ':') for w in wanted)]
+
+    results = []
+    with DriveStub(files) as stub:
+        env = dict(os.environ, FEB_DRIVE_BASE_URL=stub.base_url, PYTHONPATH=str(REPO_ROOT),
+                   FEB_CACHE_DIR=str(work_dir / "cache"), FEB_CONVERSION_CACHE_DIR=str(work_dir / "converted"),
+                   FEB_RESULT_CACHE_DIR=str(work_dir / "results"))
+        print(f"Drive stand-in at {stub.base_url}; {args.runs} runs per scenario\n")
+        for name in names:
+            process = subprocess.run(
+                [sys.executable, __file__, '--child', name, '--runs', str(args.runs),
+                 '--warmup', str(args.warmup), '--corpus', str(corpus_dir)],
+                env=env, capture_output=True, text=True,
+            )
+            lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+            if not lines:
+                print(f"{name}: benchmark process failed\n{process.stderr[-2000:]}")
+                continue
+            result = json.loads(lines[-1][len(RESULT_PREFIX):])
+            results.append(result)
+            print(f"  {name}: p50 {result['p50_ms']:.0f} ms")
+
+    print()
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -200,6 +200,10 @@ chrome.runtime.onMessage.addListener((request, _sender, sendResponse) => {
             .catch(error => sendResponse({ success: false, error: error.message }));
         return true;
     }
+    if (request.action === 'prefetchLinks') {
+        prefetchOnServer(request.links).then(() => sendResponse({ ok: true }));
+        return true;
+    }
     if (request.action === 'clearCombinedListForNewRun') {
         chrome.storage.session.set({ combinedList: [], lastCombinedPdf: null }).then(() => sendResponse({ ok: true }));
         return true;
@@ -275,19 +279,82 @@ chrome.runtime.onMessage.addListener((request, _sender, sendResponse) => {
 });
 
 // Try hosted Python server (handles encrypted PDFs). Returns blob or null.
+// How often to poll a hosted combine job, and how long to wait for it in total.
+const JOB_POLL_INTERVAL_MS = 1000;
+const JOB_MAX_WAIT_MS = 5 * 60 * 1000;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// A busy server answers /combine with 429 and Retry-After; wait that long (up to this cap) and try once more
+const BUSY_RETRY_MAX_MS = 30 * 1000;
+
+async function postCombine(base, body) {
+    const send = () => fetch(`${base}/combine`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body
+    });
+    let res = await send();
+    if (res.status === 429) {
+        const waitMs = (parseInt(res.headers.get('Retry-After'), 10) || 1) * 1000;
+        if (waitMs <= BUSY_RETRY_MAX_MS) {
+            await sleep(waitMs);
+            res = await send();
+        }
+    }
+    return res;
+}
+
+async function pdfBlobFrom(res) {
+    if (!res.ok) return null;
+    const ct = (res.headers.get('Content-Type') || '').toLowerCase();
+    if (!ct.includes('pdf')) return null;
+    return await res.blob();
+}
+
+// Ask the server to download the row's Drive files ahead of the combines (best effort;
+// older servers without /prefetch just answer 404)
+async function prefetchOnServer(links) {
+    if (!COMBINER_SERVER_URL || !COMBINER_SERVER_URL.trim() || !Array.isArray(links) || links.length === 0) return;
+    const base = COMBINER_SERVER_URL.replace(/\/$/, '');
+    try {
+        await fetch(`${base}/prefetch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ links })
+        });
+    } catch (_) {}
+}
+
+// Submit the combine as a job and poll it, so a slow Drive file or a cold start
+// can't hit the host's request timeout. Falls back to one long POST /combine on
+// servers without the job API.
 async function tryHostedCombiner(link1, link2, filename) {
     if (!COMBINER_SERVER_URL || !COMBINER_SERVER_URL.trim()) return null;
     const base = COMBINER_SERVER_URL.replace(/\/$/, '');
+    const body = JSON.stringify({ link1, link2, filename });
     try {
-        const res = await fetch(`${base}/combine`, {
+        const submitted = await fetch(`${base}/jobs`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ link1, link2, filename })
+            body
         });
-        if (!res.ok) return null;
-        const ct = (res.headers.get('Content-Type') || '').toLowerCase();
-        if (!ct.includes('pdf')) return null;
-        return await res.blob();
+        if (submitted.status === 404 || submitted.status === 405) {
+            return await pdfBlobFrom(await postCombine(base, body));
+        }
+        if (submitted.status !== 202) return null;
+        const job = await submitted.json();
+
+        const deadline = Date.now() + JOB_MAX_WAIT_MS;
+        while (Date.now() < deadline) {
+            await sleep(JOB_POLL_INTERVAL_MS);
+            const res = await fetch(`${base}/jobs/${job.id}`);
+            if (!res.ok) return null;
+            const { status } = await res.json();
+            if (status === 'done') return await pdfBlobFrom(await fetch(`${base}/jobs/${job.id}/result`));
+            if (status === 'failed') return null;
+        }
+        return null;
     } catch (_) {
         return null;
     }
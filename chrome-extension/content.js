@@ -1236,6 +1236,23 @@ async function fillForm(values) {
                 chrome.runtime.sendMessage({ action: 'clearCombinedListForNewRun' }, () => { resolve(); });
             });
         } catch (_) {}
+        // Every item's Drive links are known now; let the server start downloading them
+        // so each item's combine only has to merge when fillItem gets to it
+        const prefetchLinks = [];
+        for (let m = 17, item = 1; item <= 6; m += 8, item++) {
+            if (m !== 17 && getValue(values, m) !== "Yes") break;
+            const itemLink1 = getValue(values, m + 5);
+            const itemLink2 = getValue(values, m + 6);
+            if (itemLink1 && itemLink2) prefetchLinks.push(itemLink1, itemLink2);
+        }
+        if (prefetchLinks.length > 0) {
+            try {
+                // Not awaited: prefetching is best effort and must not delay filling the form
+                chrome.runtime.sendMessage({ action: 'prefetchLinks', links: prefetchLinks }, () => {
+                    void chrome.runtime.lastError;
+                });
+            } catch (_) {}
+        }
         let n = 17;
         let itemNumber = 1;
         const processedItems = [];
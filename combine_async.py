@@ -0,0 +1,514 @@
+"""
+Async counterparts of the download and convert steps in combine_drive_files,
+for the ASGI server (server/asgi_app.py).
+
+Downloads go through one shared httpx.AsyncClient, so a slow Drive file costs
+an idle socket on the event loop instead of a blocked thread, and hundreds can
+be in flight at once. Everything else is shared with the threaded code: the
+strategy order and win counts, sniffing and error messages, DRIVE_BASE_URL,
+retry/backoff settings and counters, the download and conversion caches and
+stage timings. Image conversion (and any cache write) runs on a thread.
+
+Compared with fetch_drive_file: gdown isn't used (it blocks), files are always
+downloaded into memory (SpooledBuffer), and a dropped body is resumed with
+Range requests within the request but not kept as a partial download.
+
+Settings can be overridden with environment variables:
+    FEB_ASYNC_HTTP_CONNECTIONS  max open connections to Drive (default: 100)
+"""
+
+import asyncio
+import html
+import os
+import re
+import time
+
+import httpx
+
+from combine_drive_files import (
+    DRIVE_BASE_URL,
+    DRIVE_STRATEGIES,
+    HEDGE_DELAY,
+    HEDGED_DOWNLOADS,
+    SpooledBuffer,
+    UploadedFile,
+    _StrategyFailed,
+    _StreamSniffer,
+    _is_html,
+    _open_cached,
+    _raise_download_failure,
+    _record_strategy_win,
+    _source_size,
+    conversion_key,
+    copy_buffer,
+    convert_google_drive_link,
+    image_to_pdf,
+    input_key,
+    process_upload,
+    strategy_order,
+)
+from drive_http import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_RETRIES,
+    HTTP_POOL_SIZE,
+    HTTP_READ_TIMEOUT,
+    HTTP_RESUME_ATTEMPTS,
+    RETRY_STATUSES,
+    IncompleteDownload,
+    _backoff_delay,
+    _record,
+    _retry_after,
+    range_source,
+)
+from single_flight import AsyncSingleFlight
+from stage_timing import timed
+
+ASYNC_HTTP_CONNECTIONS = int(os.environ.get("FEB_ASYNC_HTTP_CONNECTIONS", 100))
+ASYNC_STRATEGIES = tuple(name for name in DRIVE_STRATEGIES if name != 'gdown')
+
+_client = None
+_client_loop = None
+
+
+def get_client():
+    """Return the shared AsyncClient for the running event loop, creating it on first use."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_CONNECTIONS, max_keepalive_connections=HTTP_POOL_SIZE),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    """Close the shared AsyncClient (on server shutdown)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def http_get(url, headers=None, max_retries=HTTP_MAX_RETRIES):
+    """
+    Async drive_http.http_get: GET url as a streaming response, retrying
+    429/5xx and connection errors with the same backoff and counters.
+
+    The caller must close the response (await response.aclose()).
+    """
+    client = get_client()
+    retries = 0
+    throttled = 0
+    while True:
+        try:
+            response = await client.send(client.build_request('GET', url, headers=headers), stream=True)
+        except httpx.TransportError as e:
+            if retries >= max_retries:
+                _record(retries, throttled, failed=True)
+                raise
+            delay = _backoff_delay(retries)
+            print(f"Request to {url} failed ({e.__class__.__name__}), retrying in {delay:.1f}s ({retries + 1}/{max_retries})")
+        else:
+            if response.status_code not in RETRY_STATUSES or retries >= max_retries:
+                if retries:
+                    print(f"Request to {url} finished with {response.status_code} after {retries} retries")
+                _record(retries, throttled)
+                return response
+            if response.status_code == 429:
+                throttled += 1
+            delay = _retry_after(response)
+            if delay is None:
+                delay = _backoff_delay(retries)
+            await response.aclose()
+            print(f"Drive returned {response.status_code} for {url}, retrying in {delay:.1f}s ({retries + 1}/{max_retries})")
+        await asyncio.sleep(delay)
+        retries += 1
+
+
+async def _open_response(response):
+    """Async _open_response: sniff the first bytes, returning (head, chunks, info, aclose)."""
+    sniffer = _StreamSniffer(response.headers.get('Content-Type', '').lower())
+    started = time.perf_counter()
+    chunks = response.aiter_bytes(8192)
+    try:
+        async for chunk in chunks:
+            if sniffer.feed(chunk):
+                break
+        else:
+            sniffer.reject()
+    except BaseException:
+        await response.aclose()
+        raise
+
+    info = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'file_type': sniffer.file_type,
+        'resume': range_source(response),
+        'sniff': (time.perf_counter() - started, len(sniffer.head)),
+    }
+    return sniffer.head, chunks, info, response.aclose
+
+
+async def _strategy_direct(file_id):
+    return await _open_response(await http_get(f"{DRIVE_BASE_URL}/uc?export=download&id={file_id}"))
+
+
+async def _strategy_confirm(file_id):
+    return await _open_response(await http_get(f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}"))
+
+
+async def _strategy_scrape(file_id):
+    response = await http_get(f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}")
+    try:
+        content = b''
+        async for chunk in response.aiter_bytes(8192):
+            content += chunk
+            if len(content) >= 2048 and not _is_html(content[:2048]):
+                break
+        if not _is_html(content[:2048], response.headers.get('Content-Type', '').lower()):
+            # Drive sent the file itself; let the faster strategies claim it
+            raise _StrategyFailed("Drive served the file directly, nothing to scrape")
+    finally:
+        await response.aclose()
+
+    html_content = content.decode('utf-8', errors='ignore')
+    if 'sign in' in html_content.lower() or 'signin' in html_content.lower():
+        raise _StrategyFailed("Drive asked for sign-in", auth_required=True, html=True)
+    match = re.search(r'href="(/uc\?export=download[^"]+)"', html_content)
+    if not match:
+        match = re.search(r'id="uc-download-link"[^>]*href="([^"]+)"', html_content)
+    if match:
+        download_url = DRIVE_BASE_URL + html.unescape(match.group(1))
+    else:
+        download_url = f"{DRIVE_BASE_URL}/uc?id={file_id}&export=download"
+    return await _open_response(await http_get(download_url))
+
+
+_STRATEGY_FUNCTIONS = {
+    'direct': _strategy_direct,
+    'confirm': _strategy_confirm,
+    'scrape': _strategy_scrape,
+}
+
+
+async def _run_strategy(name, file_id, timings):
+    """Run one strategy, converting network errors into _StrategyFailed."""
+    with timed(timings, 'strategy', file_id=file_id, strategy=name, outcome='failed') as span:
+        try:
+            opened = await _STRATEGY_FUNCTIONS[name](file_id)
+        except asyncio.CancelledError:
+            span.labels['outcome'] = 'lost'
+            raise
+        except _StrategyFailed:
+            raise
+        except httpx.HTTPError as e:
+            raise _StrategyFailed(f"{name} failed: {e}")
+        span.labels['outcome'] = 'won'
+    return opened
+
+
+async def _fetch_sequential(file_id, order, timings):
+    failures = []
+    for name in order:
+        print(f"Trying '{name}' download for {file_id}...")
+        try:
+            return name, await _run_strategy(name, file_id, timings)
+        except _StrategyFailed as e:
+            print(f"'{name}' download failed: {e}")
+            failures.append(e)
+    _raise_download_failure(file_id, failures)
+
+
+async def _fetch_hedged(file_id, order, timings):
+    """
+    Race the strategies like combine_drive_files._fetch_hedged: the next one
+    starts after HEDGE_DELAY seconds or once the running ones have all failed,
+    and the first supported file wins. The others are cancelled.
+    """
+    pending = list(order)
+    running = {}
+    failures = []
+
+    def start(name):
+        running[asyncio.ensure_future(_run_strategy(name, file_id, timings))] = name
+
+    try:
+        while True:
+            if pending and not running:
+                name = pending.pop(0)
+                print(f"Starting '{name}' download for {file_id}...")
+                start(name)
+            done, _ = await asyncio.wait(running, timeout=HEDGE_DELAY if pending else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Current strategies are slow; hedge with the next one
+                name = pending.pop(0)
+                print(f"Still waiting after {HEDGE_DELAY:.1f}s, also starting '{name}' download for {file_id}...")
+                start(name)
+                continue
+            winner = None
+            for task in done:
+                name = running.pop(task)
+                try:
+                    opened = task.result()
+                except _StrategyFailed as e:
+                    print(f"'{name}' download failed: {e}")
+                    failures.append(e)
+                    continue
+                if winner is None:
+                    winner = (name, opened)
+                else:
+                    await opened[3]()  # Finished in the same instant but lost; release it
+            if winner is not None:
+                return winner
+            if not pending and not running:
+                _raise_download_failure(file_id, failures)
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+            for task in running:
+                if not task.cancelled() and task.exception() is None:
+                    await task.result()[3]()
+
+
+async def _copy_body(chunks, out, source, written, close):
+    """Async drive_http.copy_body: write the rest of a body, resuming dropped connections with Range requests."""
+    end = source['length'] if source is not None else None
+    resumes = 0
+    while True:
+        try:
+            async for chunk in chunks:
+                out.write(chunk)
+                written += len(chunk)
+            if end is None or written >= end:
+                await close()
+                return written
+            error = f"connection closed after {written} of {end} bytes"
+        except httpx.TransportError as e:
+            error = f"{e.__class__.__name__}: {e}"
+
+        await close()
+        if source is None or resumes >= HTTP_RESUME_ATTEMPTS:
+            raise IncompleteDownload(f"Download interrupted ({error})", written)
+        resumes += 1
+        print(f"Download dropped at byte {written} ({error}), resuming with a Range request ({resumes}/{HTTP_RESUME_ATTEMPTS})")
+        headers = {'Range': f"bytes={written}-"}
+        if source['validator']:
+            headers['If-Range'] = source['validator']
+        try:
+            response = await http_get(source['url'], headers=headers)
+        except httpx.HTTPError as e:
+            raise IncompleteDownload(f"Download interrupted and could not be resumed: {e}", written)
+        if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f"bytes {written}-"):
+            await response.aclose()
+            raise IncompleteDownload(f"Download interrupted ({error}) and the server refused to resume it", written)
+        chunks = response.aiter_bytes(8192)
+        close = response.aclose
+
+
+async def _fetch_from_google_drive(file_id, out, timings=None):
+    """Async _fetch_from_google_drive (without gdown or parallel byte ranges)."""
+    order = [name for name in strategy_order() if name in ASYNC_STRATEGIES]
+    if HEDGED_DOWNLOADS:
+        name, (content, chunks, info, close) = await _fetch_hedged(file_id, order, timings)
+    else:
+        name, (content, chunks, info, close) = await _fetch_sequential(file_id, order, timings)
+    source = info.pop('resume', None)
+    sniff = info.pop('sniff')
+    if timings is not None:
+        timings.record('sniff', sniff[0], bytes=sniff[1], file_id=file_id, strategy=name)
+
+    try:
+        out.write(content)
+        with timed(timings, 'transfer', file_id=file_id, strategy=name) as span:
+            written = await _copy_body(chunks, out, source, len(content), close)
+            span.bytes = written - len(content)
+    finally:
+        await close()
+
+    _record_strategy_win(name)
+    print(f"Downloaded {file_id} ({info['file_type']}) using '{name}'")
+    return dict(info, strategy=name)
+
+
+async def _revalidate_cached(file_id, entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    if not headers:
+        return False
+    try:
+        response = await http_get(f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}", headers=headers)
+        await response.aclose()
+    except httpx.HTTPError as e:
+        print(f"Revalidation failed for {file_id}: {e}")
+        return False
+    return response.status_code == 304
+
+
+# Downloads in progress on this event loop, shared by concurrent combines
+_download_flight = AsyncSingleFlight()
+
+
+def _copy_download(result):
+    source, file_type, origin = result
+    return copy_buffer(source), file_type, origin
+
+
+async def fetch_drive_file(file_id, cache=None, timings=None):
+    """
+    Download a file from Google Drive into memory, using the download cache when given.
+
+    A file another combine is already downloading is fetched once and
+    copied (source 'coalesced' in the timing span).
+
+    Args:
+        file_id: Google Drive file ID
+        cache: Optional DownloadCache; fresh (or successfully revalidated)
+            entries are served without downloading again
+        timings: Optional StageTimings to record the 'download' span (and
+            the strategy, sniff and transfer spans within it) in
+
+    Returns:
+        Tuple of (binary file object positioned at the start, file type:
+        'pdf', 'png' or 'jpeg')
+
+    Raises:
+        ValueError if Drive did not serve a supported file
+    """
+    with timed(timings, 'download', file_id=file_id) as span:
+        (source, file_type, origin), shared = await _download_flight.do(
+            file_id, _fetch_drive_file, file_id, cache, timings, share=_copy_download)
+        if shared:
+            origin = 'coalesced'
+        span.labels.update(file_type=file_type, source=origin)
+        span.bytes = _source_size(source)
+    return source, file_type
+
+
+async def _fetch_drive_file(file_id, cache, timings):
+    if cache is not None:
+        entry = cache.lookup(file_id)
+        # A hit evicted before it could be opened counts as a miss
+        if entry is not None:
+            if entry['fresh']:
+                cached = _open_cached(cache, entry, None)
+                if cached is not None:
+                    cache.touch(file_id)
+                    print(f"Using cached download for {file_id}")
+                    return cached, entry['file_type'], 'cache'
+            elif await _revalidate_cached(file_id, entry):
+                cached = _open_cached(cache, entry, None)
+                if cached is not None:
+                    cache.touch(file_id, revalidated=True)
+                    print(f"Cached download for {file_id} is still current")
+                    return cached, entry['file_type'], 'revalidated'
+
+    out = SpooledBuffer()
+    try:
+        info = await _fetch_from_google_drive(file_id, out, timings)
+        out.seek(0)
+        if cache is not None:
+            await asyncio.to_thread(cache.store, file_id, out, info, file_type=info['file_type'])
+            out.seek(0)
+    except BaseException:
+        out.close()
+        raise
+    return out, info['file_type'], 'drive'
+
+
+async def process_file(google_drive_link, cache=None, convert=None, conversions=None, timings=None):
+    """
+    Download a file from Google Drive and convert it to PDF if needed.
+
+    Args:
+        google_drive_link: Google Drive shareable link
+        cache: Optional DownloadCache to serve repeat downloads from
+        convert: Blocking function called as convert(image, output) on a
+            thread (default: image_to_pdf)
+        conversions: Optional ConversionCache to reuse earlier image conversions
+        timings: Optional StageTimings to record the download and 'convert'
+            spans in
+
+    Returns:
+        Binary file object of the PDF, positioned at the start
+    """
+    file_id, _ = convert_google_drive_link(google_drive_link)
+    source, file_type = await fetch_drive_file(file_id, cache, timings)
+    if file_type == 'pdf':
+        return source
+
+    try:
+        key = await asyncio.to_thread(conversion_key, source) if conversions is not None else None
+        entry = conversions.lookup(key) if key is not None else None
+        # None when evicted since the lookup; then it is converted again
+        cached = conversions.open_entry(entry) if entry is not None else None
+        if cached is not None:
+            conversions.touch(key)
+            print(f"Using cached conversion for {file_id}")
+            if timings is not None:
+                timings.record('convert', 0.0, bytes=entry.get('size'), file_id=file_id, file_type=file_type,
+                               cached=True)
+            return cached
+
+        pdf_file = SpooledBuffer()
+        try:
+            with timed(timings, 'convert', file_id=file_id, file_type=file_type, cached=False) as span:
+                await asyncio.to_thread(convert or image_to_pdf, source, pdf_file)
+                span.bytes = pdf_file.tell()
+            pdf_file.seek(0)
+            if key is not None:
+                await asyncio.to_thread(conversions.store, key, pdf_file, file_type='pdf')
+                pdf_file.seek(0)
+        except BaseException:
+            pdf_file.close()
+            raise
+        return pdf_file
+    finally:
+        source.close()
+
+
+async def process_files(google_drive_links, cache=None, convert=None, conversions=None, timings=None):
+    """
+    Download and convert several Google Drive files concurrently.
+
+    UploadedFile items may be mixed with the links; they are converted (if
+    needed) on a thread by process_upload.
+
+    Returns:
+        List of PDF file objects in the same order as google_drive_links; a
+        link repeated in the list maps to the same file object
+
+    Raises:
+        The first error (in input order); the other files are cancelled or closed
+    """
+    file_ids = [input_key(link) for link in google_drive_links]
+    tasks = {}
+    for file_id, link in zip(file_ids, google_drive_links):
+        if file_id in tasks:
+            continue
+        if isinstance(link, UploadedFile):
+            work = asyncio.to_thread(process_upload, link, convert, conversions, timings)
+        else:
+            work = process_file(link, cache, convert, conversions, timings)
+        tasks[file_id] = asyncio.ensure_future(work)
+    try:
+        for file_id in file_ids:
+            await tasks[file_id]
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for task in tasks.values():
+            if not task.cancelled() and task.exception() is None:
+                task.result().close()
+        raise
+    return [tasks[file_id].result() for file_id in file_ids]
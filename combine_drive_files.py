@@ -1,11 +1,12 @@
 """
-Script to combine two Google Drive files (PDF, PNG, or JPEG) into one PDF.
+Script to combine Google Drive files (PDF, PNG, or JPEG) into one PDF.
 
 Usage:
     python combine_drive_files.py
 """
 
 import requests
+import io
 import os
 import tempfile
 from pathlib import Path
@@ -14,6 +15,27 @@ import PyPDF2
 from io import BytesIO
 import re
 import shutil
+import sys
+import html
+import hashlib
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from drive_cache import ConversionCache, DownloadCache, hash_file
+from drive_http import http_get, new_session, range_source, open_range, copy_body, IncompleteDownload
+from pdf_optimize import (fit_pdf_to_budget, optimize_pdf, MAX_OUTPUT_BYTES, MAX_IMAGE_DPI, OPTIMIZE_OUTPUT,
+                          REMOVE_UNUSED_RESOURCES)
+from pdf_stream import StreamingPdfWriter
+from single_flight import SingleFlight
+from stage_timing import StageTimings, timed
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # Try to import gdown for better Google Drive support
 try:
@@ -22,6 +44,124 @@ try:
 except ImportError:
     GDOWN_AVAILABLE = False
 
+# Downloads and converted PDFs stay in memory up to this size, then spill to a temp file
+SPOOL_THRESHOLD = int(os.environ.get("FEB_SPOOL_THRESHOLD", 16 * 1024 * 1024))
+
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """
+    In-memory file that moves to disk only once it grows past SPOOL_THRESHOLD.
+    
+    Pillow asks every output file for fileno(), which would make a plain
+    SpooledTemporaryFile roll over to disk immediately; this one refuses until
+    it has rolled over on its own.
+    
+    Once on disk the buffer is a named temp file (.path), so a worker process
+    can open it instead of being sent its bytes (see to_job_source). The file
+    is deleted when the buffer is closed or garbage collected, unless keep()
+    hands it over.
+    """
+    
+    def __init__(self, max_size=None, dir=None):
+        super().__init__(max_size=SPOOL_THRESHOLD if max_size is None else max_size, mode='w+b', dir=dir)
+        self._dir = dir
+        self.path = None
+        self._remove = None
+    
+    @property
+    def name(self):
+        return self.path
+    
+    def fileno(self):
+        if not self._rolled:
+            raise io.UnsupportedOperation("fileno")
+        return super().fileno()
+    
+    def rollover(self):
+        if self._rolled:
+            return
+        fd, path = tempfile.mkstemp(prefix='feb_spool_', dir=self._dir)
+        self._use_file(path, os.fdopen(fd, 'w+b'))
+    
+    def _use_file(self, path, file):
+        """Move the contents (and position) so far into file and keep working on disk."""
+        memory = self._file
+        file.write(memory.getvalue())
+        file.seek(memory.tell())
+        memory.close()
+        self._file = file
+        self.path = path
+        self._remove = weakref.finalize(self, _remove_quietly, path)
+        self._rolled = True
+    
+    def adopt(self, path):
+        """
+        Take over the file at path as this buffer's contents, positioned at
+        its end, instead of copying it in; it is then deleted with the buffer.
+        
+        Returns:
+            False (and leaves path alone) if something was already written
+        """
+        if self._rolled or self._file.tell() or self._file.getbuffer().nbytes:
+            return False
+        file = open(path, 'r+b')
+        self._use_file(path, file)
+        file.seek(0, os.SEEK_END)
+        return True
+    
+    def keep(self):
+        """
+        Close the buffer but leave its file on disk, for another process.
+        
+        Returns:
+            The file's path, which the caller must remove, or None if the
+            buffer never left memory (nothing is kept)
+        """
+        if self._remove is not None:
+            self._remove.detach()
+        self.close()
+        return self.path
+    
+    def close(self):
+        super().close()
+        if self._remove is not None:
+            self._remove()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def copy_buffer(source):
+    """
+    Private SpooledBuffer copy of a file object's contents, positioned at the
+    start; source is rewound afterwards.
+    """
+    copy = SpooledBuffer()
+    source.seek(0)
+    shutil.copyfileobj(source, copy)
+    source.seek(0)
+    copy.seek(0)
+    return copy
+
+
+def _describe(source):
+    """Name of a path or file object for progress messages."""
+    if isinstance(source, (str, os.PathLike)):
+        return str(source)
+    name = getattr(source, 'name', None)
+    return name if isinstance(name, str) else "<in-memory file>"
+
+
+# Where Drive requests go; point it at a stand-in server (see benchmarks/drive_stub.py) for testing
+DRIVE_BASE_URL = os.environ.get("FEB_DRIVE_BASE_URL", "https://drive.google.com").rstrip('/')
+
 
 def convert_google_drive_link(shareable_link):
     """
@@ -42,7 +182,7 @@ def convert_google_drive_link(shareable_link):
         raise ValueError("Invalid Google Drive link format")
     
     # Return file ID and direct download link
-    return file_id, f"https://drive.google.com/uc?export=download&id={file_id}"
+    return file_id, f"{DRIVE_BASE_URL}/uc?export=download&id={file_id}"
 
 
 def download_file(url, output_path):
@@ -57,229 +197,1567 @@ def download_file(url, output_path):
         Path to the downloaded file
     """
     print(f"Downloading file from: {url}")
-    response = requests.get(url, stream=True)
+    response = http_get(url, stream=True)
     response.raise_for_status()
     
+    # A dropped connection resumes from the last byte received
     with open(output_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+        copy_body(response.iter_content(chunk_size=8192), f, range_source(response), close=response.close)
     
     print(f"File downloaded to: {output_path}")
     return output_path
 
 
+# Pixels per inch used to size image pages (a 1000px wide photo becomes a 10in wide page)
+IMAGE_RESOLUTION = 100.0
+
+# Embed baseline JPEGs into the PDF as-is instead of decoding and re-encoding them
+JPEG_PASSTHROUGH = os.environ.get("FEB_JPEG_PASSTHROUGH", "1") != "0"
+
+# Images that must be decoded are decoded at no more than this many pixels (page
+# size is kept). JPEGs are shrunk by libjpeg while decoding (to 1/2, 1/4 or 1/8);
+# other formats can only be decoded at full size, so they are refused above it.
+MAX_IMAGE_PIXELS = int(os.environ.get("FEB_MAX_IMAGE_PIXELS", 16_000_000))
+# Largest reduction libjpeg can apply while decoding (per side)
+_JPEG_MAX_REDUCTION = 8
+
+# Rows are alpha-flattened in strips of about this many pixels
+FLATTEN_STRIP_PIXELS = 1_000_000
+
+# SOF markers for baseline and extended sequential (Huffman) JPEGs
+_JPEG_SEQUENTIAL_SOF = (0xC0, 0xC1)
+_JPEG_COLOR_SPACES = {1: '/DeviceGray', 3: '/DeviceRGB'}
+
+
+def _open_binary(source, mode='rb'):
+    """Open a path, or wrap an already-open file object so `with` leaves it open."""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, mode)
+    return _Unclosed(source)
+
+
+class _Unclosed:
+    """Context manager yielding a caller-owned file object without closing it."""
+    
+    def __init__(self, f):
+        self.f = f
+    
+    def __enter__(self):
+        return self.f
+    
+    def __exit__(self, *exc):
+        return False
+
+
+def _jpeg_passthrough_info(f):
+    """
+    Read a JPEG's frame header without decoding the image.
+    
+    Returns:
+        (width, height, PDF color space) if the JPEG can be embedded directly
+        (8-bit baseline/extended sequential, grayscale or YCbCr/RGB), else None
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:
+            # Fill byte before the real marker
+            f.seek(-1, io.SEEK_CUR)
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = int.from_bytes(length_bytes, 'big')
+        if code == 0xEE:
+            # Adobe APP14: may signal inverted CMYK/YCCK, leave those to Pillow
+            return None
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            if code not in _JPEG_SEQUENTIAL_SOF:
+                return None
+            frame = f.read(6)
+            if len(frame) < 6:
+                return None
+            precision = frame[0]
+            height = int.from_bytes(frame[1:3], 'big')
+            width = int.from_bytes(frame[3:5], 'big')
+            color_space = _JPEG_COLOR_SPACES.get(frame[5])
+            if precision != 8 or not width or not height or color_space is None:
+                return None
+            return width, height, color_space
+        if code == 0xDA:
+            # Start of scan before any frame header
+            return None
+        f.seek(length - 2, io.SEEK_CUR)
+
+
+def _write_jpeg_pdf(f, size, width, height, color_space, out):
+    """Write a one-page PDF embedding the JPEG in f (size bytes) as a DCTDecode image."""
+    page_width = width * 72.0 / IMAGE_RESOLUTION
+    page_height = height * 72.0 / IMAGE_RESOLUTION
+    content = f"q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q\n".encode('ascii')
+    offsets = []
+    written = 0
+    
+    def emit(data):
+        nonlocal written
+        out.write(data)
+        written += len(data)
+    
+    def begin_object():
+        offsets.append(written)
+        emit(f"{len(offsets)} 0 obj\n".encode('ascii'))
+    
+    emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    begin_object()
+    emit(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+    begin_object()
+    emit(b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n")
+    begin_object()
+    emit(
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] "
+        f"/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>\nendobj\n".encode('ascii')
+    )
+    begin_object()
+    emit(
+        f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+        f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode /Length {size} >>\nstream\n".encode('ascii')
+    )
+    f.seek(0)
+    for chunk in iter(lambda: f.read(65536), b''):
+        emit(chunk)
+    emit(b"\nendstream\nendobj\n")
+    begin_object()
+    emit(f"<< /Length {len(content)} >>\nstream\n".encode('ascii') + content + b"endstream\nendobj\n")
+    
+    xref_offset = written
+    emit(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode('ascii'))
+    for offset in offsets:
+        emit(f"{offset:010d} 00000 n \n".encode('ascii'))
+    emit(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+
+
+def _jpeg_to_pdf_passthrough(image_path, output_pdf_path):
+    """
+    Embed a JPEG in a PDF without decoding it.
+    
+    Returns:
+        True if the PDF was written, False if the JPEG needs the Pillow path
+    """
+    with _open_binary(image_path) as f:
+        info = _jpeg_passthrough_info(f)
+        if info is None:
+            return False
+        size = f.seek(0, io.SEEK_END)
+        with _open_binary(output_pdf_path, 'wb') as out:
+            _write_jpeg_pdf(f, size, *info, out)
+    return True
+
+
+def _image_bytes(image):
+    """Approximate memory held by a decoded image."""
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def _max_rss_mb():
+    """Peak resident memory of this process so far, in MB (None where unsupported)."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _flatten_alpha(image):
+    """
+    Composite an RGBA image onto white, a strip of rows at a time.
+    
+    Pasting with the image as its own mask avoids split(), which would hold a
+    full-size copy of every band at once.
+    """
+    width, height = image.size
+    flattened = Image.new('RGB', image.size, (255, 255, 255))
+    rows = max(1, FLATTEN_STRIP_PIXELS // width)
+    for top in range(0, height, rows):
+        box = (0, top, width, min(height, top + rows))
+        strip = image.crop(box)
+        flattened.paste(strip, box, mask=strip)
+    return flattened
+
+
 def image_to_pdf(image_path, output_pdf_path):
     """
     Convert an image (PNG, JPEG) to PDF.
     
+    Baseline JPEGs are embedded unchanged (no decode, no quality loss); other
+    images are decoded with Pillow, flattened to RGB and re-encoded. No image
+    is decoded at more than about MAX_IMAGE_PIXELS pixels, so memory per
+    conversion stays bounded: larger JPEGs are shrunk while decoding, and
+    larger images of other formats are refused. The page size is unchanged.
+    
     Args:
-        image_path: Path to the image file
-        output_pdf_path: Path to save the PDF
+        image_path: Path to the image file, or a binary file object
+        output_pdf_path: Path to save the PDF, or a writable binary file object
+    
+    Returns:
+        Dict with 'passthrough', the decoded 'pixels', the estimated
+        'peak_image_bytes' held at once, and the process 'max_rss_mb'
+    
+    Raises:
+        ValueError if the image can't be decoded within MAX_IMAGE_PIXELS
     """
-    print(f"Converting image {image_path} to PDF...")
+    print(f"Converting image {_describe(image_path)} to PDF...")
+    if JPEG_PASSTHROUGH and _jpeg_to_pdf_passthrough(image_path, output_pdf_path):
+        print(f"JPEG embedded without re-encoding: {_describe(output_pdf_path)}")
+        return {'passthrough': True, 'pixels': 0, 'peak_image_bytes': 0, 'max_rss_mb': _max_rss_mb()}
+    
+    if not isinstance(image_path, (str, os.PathLike)):
+        image_path.seek(0)
     image = Image.open(image_path)
+    original_width, original_height = image.size
+    pixels = original_width * original_height
+    target_size = image.size
+    if pixels > MAX_IMAGE_PIXELS:
+        scale = (MAX_IMAGE_PIXELS / pixels) ** 0.5
+        target_size = (max(1, int(original_width * scale)), max(1, int(original_height * scale)))
+        limit = MAX_IMAGE_PIXELS * (_JPEG_MAX_REDUCTION ** 2 if image.format == 'JPEG' else 1)
+        if pixels > limit:
+            image.close()
+            raise ValueError(
+                f"Image is too large to convert ({original_width}x{original_height} pixels). "
+                f"Please upload a version under {limit // 1_000_000} megapixels."
+            )
+        if image.format == 'JPEG':
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, picking the largest
+            # result that fits under the ceiling, instead of full size
+            reduction = next(r for r in (2, 4, 8) if pixels / (r * r) <= MAX_IMAGE_PIXELS)
+            image.draft(None, (-(-original_width // reduction), -(-original_height // reduction)))
+            if image.size[0] * image.size[1] <= MAX_IMAGE_PIXELS:
+                target_size = image.size
+    
+    image.load()
+    peak = current = _image_bytes(image)
+    
+    if image.size[0] > target_size[0] or image.size[1] > target_size[1]:
+        print(f"Downscaling {original_width}x{original_height} image to {target_size[0]}x{target_size[1]}")
+        resized = image.resize(target_size, Image.LANCZOS)
+        peak = max(peak, current + _image_bytes(resized))
+        image.close()
+        image, current = resized, _image_bytes(resized)
     
     # Convert RGBA to RGB if necessary
     if image.mode == 'RGBA':
-        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-        rgb_image.paste(image, mask=image.split()[3])  # Use alpha channel as mask
+        rgb_image = _flatten_alpha(image)
+        peak = max(peak, current + _image_bytes(rgb_image) + FLATTEN_STRIP_PIXELS * 4)
+        image.close()
         image = rgb_image
     elif image.mode != 'RGB':
-        image = image.convert('RGB')
+        rgb_image = image.convert('RGB')
+        peak = max(peak, current + _image_bytes(rgb_image))
+        image.close()
+        image = rgb_image
+    
+    # Keep the page the size the full-resolution image would have had
+    resolution = IMAGE_RESOLUTION * image.size[0] / original_width
+    image.save(output_pdf_path, 'PDF', resolution=resolution)
+    image.close()
     
-    image.save(output_pdf_path, 'PDF', resolution=100.0)
-    print(f"Image converted to PDF: {output_pdf_path}")
+    max_rss_mb = _max_rss_mb()
+    print(f"Image converted to PDF: {_describe(output_pdf_path)}")
+    print(f"  Peak decoded image memory: ~{peak / (1024 * 1024):.1f} MB"
+          + (f" (process max RSS {max_rss_mb:.0f} MB)" if max_rss_mb is not None else ""))
+    return {'passthrough': False, 'pixels': image.size[0] * image.size[1], 'peak_image_bytes': peak, 'max_rss_mb': max_rss_mb}
+
 
+# Write merged pages straight to the output and drop each input once it is
+# written (see pdf_stream), so large statements merge in bounded memory.
+# Outlines and form fields of the inputs are not kept in this mode.
+STREAMING_MERGE = os.environ.get("FEB_STREAMING_MERGE", "0") != "0"
 
-def combine_pdfs(pdf_paths, output_path):
+
+def _open_pdf(pdf_path, timings=None):
+    reader = PyPDF2.PdfReader(pdf_path)
+    if getattr(reader, 'is_encrypted', False):
+        with timed(timings, 'decrypt', input=_describe(pdf_path)):
+            reader.decrypt("")
+    return reader
+
+
+def combine_pdfs(pdf_paths, output_path, streaming=None, timings=None):
     """
     Combine multiple PDF files into one.
     Decrypts with empty password when needed (e.g. bank statement PDFs).
+    
+    Inputs may be paths or binary file objects, and output_path may be a
+    writable file object, so the whole merge can run in memory. pdf_paths may
+    be any iterable (e.g. iter_processed_files), in which case each file is
+    added as soon as it is produced.
+    
+    Args:
+        pdf_paths: Iterable of PDF paths or binary file objects
+        output_path: Path or writable binary file object for the combined PDF
+        streaming: Write each input's pages to the output as soon as it is
+            read and release it, instead of building the whole document in
+            memory first (default: STREAMING_MERGE)
+        timings: Optional StageTimings to record 'merge', 'decrypt' and
+            'write' spans in
+    
+    Returns:
+        Dict with the number of 'pages', output 'bytes', whether the merge
+        was 'streaming', and the process 'max_rss_mb'
     """
-    print(f"Combining {len(pdf_paths)} PDF files...")
-    pdf_merger = PyPDF2.PdfMerger()
-    for pdf_path in pdf_paths:
-        print(f"  Adding: {pdf_path}")
-        reader = PyPDF2.PdfReader(pdf_path)
-        if getattr(reader, 'is_encrypted', False):
-            reader.decrypt("")
-        pdf_merger.append(reader)
-    pdf_merger.write(output_path)
-    pdf_merger.close()
-    print(f"Combined PDF saved to: {output_path}")
+    if streaming is None:
+        streaming = STREAMING_MERGE
+    if hasattr(pdf_paths, '__len__'):
+        print(f"Combining {len(pdf_paths)} PDF files...")
+    else:
+        print("Combining PDF files as they become ready...")
+    
+    if streaming:
+        writer = StreamingPdfWriter(output_path)
+        with timed(timings, 'merge', streaming=True) as span:
+            for pdf_path in pdf_paths:
+                print(f"  Adding: {_describe(pdf_path)}")
+                reader = _open_pdf(pdf_path, timings)
+                writer.add_reader(reader)
+                # Nothing from this input is needed any more
+                del reader
+            span.labels['pages'] = writer.page_count
+        with timed(timings, 'write') as span:
+            writer.close()
+            span.bytes = writer.bytes_written
+        pages, size = writer.page_count, writer.bytes_written
+    else:
+        start = None if isinstance(output_path, (str, os.PathLike)) else output_path.tell()
+        pdf_merger = PyPDF2.PdfMerger()
+        readers = {}
+        with timed(timings, 'merge', streaming=False) as span:
+            for pdf_path in pdf_paths:
+                print(f"  Adding: {_describe(pdf_path)}")
+                # A file object listed twice must share one reader (and one read position)
+                reader = readers.get(id(pdf_path))
+                if reader is None:
+                    reader = readers[id(pdf_path)] = _open_pdf(pdf_path, timings)
+                pdf_merger.append(reader)
+            pages = span.labels['pages'] = len(pdf_merger.pages)
+        with timed(timings, 'write') as span:
+            pdf_merger.write(output_path)
+            pdf_merger.close()
+            size = span.bytes = os.path.getsize(output_path) if start is None else output_path.tell() - start
+    
+    max_rss_mb = _max_rss_mb()
+    print(f"Combined PDF saved to: {_describe(output_path)}")
+    print(f"  {pages} pages, {size} bytes"
+          + (f", process max RSS {max_rss_mb:.0f} MB" if max_rss_mb is not None else "")
+          + (" (streaming merge)" if streaming else ""))
+    return {'pages': pages, 'bytes': size, 'streaming': streaming, 'max_rss_mb': max_rss_mb}
 
 
-def download_from_google_drive(file_id, temp_dir):
+def sniff_file_type(header):
     """
-    Download a file from Google Drive using multiple methods.
+    Identify a file from its first bytes.
+    
+    Returns:
+        'pdf', 'png', 'jpeg', or None if the type is not supported
+    """
+    if header.startswith(b'%PDF'):
+        return 'pdf'
+    elif header.startswith(b'\x89PNG'):
+        return 'png'
+    elif header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    return None
+
+
+FILE_TYPE_EXTENSIONS = {'pdf': '.pdf', 'png': '.png', 'jpeg': '.jpg'}
+
+
+def _revalidate_cached(file_id, entry):
+    """
+    Ask Google Drive whether a cached file is still current using its validators.
+    
+    Returns:
+        True if Drive answered 304 Not Modified, False otherwise
+    """
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    if not headers:
+        return False
+    
+    download_url = f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}"
+    try:
+        response = http_get(download_url, headers=headers, stream=True, allow_redirects=True)
+        response.close()
+    except requests.RequestException as e:
+        print(f"Revalidation failed for {file_id}: {e}")
+        return False
+    return response.status_code == 304
+
+
+def download_from_google_drive(file_id, temp_dir=None, cache=None):
+    """
+    Download a file from Google Drive, using the download cache when given.
+    
+    Same as fetch_drive_file, but returns only the downloaded file.
+    """
+    return fetch_drive_file(file_id, temp_dir, cache=cache)[0]
+
+
+# In-memory downloads in progress, so combines running at the same time
+# fetch a file they share only once
+_download_flight = SingleFlight()
+
+
+def _copy_download(result):
+    source, file_type, origin = result
+    return copy_buffer(source), file_type, origin
+
+
+def fetch_drive_file(file_id, temp_dir=None, cache=None, timings=None):
+    """
+    Download a file from Google Drive, using the download cache when given.
+    
+    The file type is detected from the first bytes while the download is still
+    streaming; HTML pages and unsupported files are rejected before the rest
+    of the body is transferred.
+    
+    In-memory downloads (temp_dir None) of a file that another thread is
+    already fetching wait for that download and get a copy of it instead of
+    starting their own (source 'coalesced' in the timing span).
     
     Args:
         file_id: Google Drive file ID
-        temp_dir: Temporary directory to save files
+        temp_dir: Temporary directory to save files, or None to download into
+            memory (spilling to a temp file only above SPOOL_THRESHOLD)
+        cache: Optional DownloadCache; fresh (or successfully revalidated)
+            entries are served without downloading again
+        timings: Optional StageTimings to record the 'download' span (and
+            the strategy, sniff and transfer spans within it) in
     
     Returns:
-        Path to the downloaded file
+        Tuple of (path to the downloaded file (a private copy in temp_dir), or
+        a binary file object positioned at the start when temp_dir is None;
+        file type: 'pdf', 'png' or 'jpeg')
+    
+    Raises:
+        ValueError if Drive did not serve a supported file
     """
-    # First, try using gdown if available (better for Google Drive)
-    if GDOWN_AVAILABLE:
-        try:
-            print("Attempting download using gdown library...")
-            url = f"https://drive.google.com/uc?id={file_id}"
-            temp_file_path = os.path.join(temp_dir, f"gdown_{file_id}")
-            gdown.download(url, temp_file_path, quiet=False, fuzzy=True)
-            
-            # Check if file was downloaded successfully
-            if os.path.exists(temp_file_path) and os.path.getsize(temp_file_path) > 0:
-                print("Successfully downloaded using gdown!")
-                return temp_file_path
-            else:
-                print("gdown download failed, trying alternative method...")
-        except Exception as e:
-            print(f"gdown failed: {e}, trying alternative method...")
+    with timed(timings, 'download', file_id=file_id) as span:
+        if temp_dir is None:
+            (source, file_type, origin), shared = _download_flight.do(
+                file_id, _fetch_drive_file, file_id, None, cache, timings, share=_copy_download)
+            if shared:
+                origin = 'coalesced'
+        else:
+            source, file_type, origin = _fetch_drive_file(file_id, temp_dir, cache, timings)
+        span.labels.update(file_type=file_type, source=origin)
+        span.bytes = _source_size(source)
+    return source, file_type
+
+
+def _source_size(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    return size
+
+
+def _fetch_drive_file(file_id, temp_dir, cache, timings):
+    """
+    fetch_drive_file without the timing span.
     
-    # Fallback to requests method
-    session = requests.Session()
+    Returns:
+        Tuple of (file, file type, where it came from: 'cache',
+        'revalidated', 'resume' or 'drive')
+    """
+    if cache is not None:
+        entry = cache.lookup(file_id)
+        # A hit evicted before it could be opened counts as a miss
+        if entry is not None:
+            if entry['fresh']:
+                cached = _open_cached(cache, entry, temp_dir)
+                if cached is not None:
+                    cache.touch(file_id)
+                    print(f"Using cached download for {file_id}")
+                    return cached, entry['file_type'], 'cache'
+            elif _revalidate_cached(file_id, entry):
+                cached = _open_cached(cache, entry, temp_dir)
+                if cached is not None:
+                    cache.touch(file_id, revalidated=True)
+                    print(f"Cached download for {file_id} is still current")
+                    return cached, entry['file_type'], 'revalidated'
     
-    # Method 1: Try direct download
-    download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-    response = session.get(download_url, stream=True, allow_redirects=True)
+    if temp_dir is None:
+        out = SpooledBuffer()
+    else:
+        out = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, prefix=f"drive_{file_id}_", suffix='.tmp')
+    try:
+        info = None
+        partial = cache.lookup_partial(file_id) if cache is not None else None
+        if partial is not None:
+            info = _resume_partial(file_id, partial, out, timings=timings)
+            if info is None:
+                cache.discard_partial(file_id)
+        if info is None:
+            info = _fetch_from_google_drive(file_id, out, timings=timings)
+        file_type = info['file_type']
+        origin = 'resume' if info['strategy'] == 'resume' else 'drive'
+        out.seek(0)
+        
+        if cache is not None:
+            cache.store(file_id, out, info, file_type=file_type)
+            cache.discard_partial(file_id)
+            out.seek(0)
+    except IncompleteDownload as e:
+        # Without a validator a later resume could splice two versions together
+        if cache is not None and e.partial and e.partial['validator']:
+            out.seek(0)
+            cache.store_partial(file_id, out, e.written, **e.partial)
+            print(f"Kept {e.written} bytes of {file_id}; the next attempt will resume from there")
+        out.close()
+        if temp_dir is not None:
+            os.remove(out.name)
+        raise
+    except BaseException:
+        out.close()
+        if temp_dir is not None:
+            os.remove(out.name)
+        raise
     
-    # Check if we got HTML (means we need to handle virus scan warning or large file)
-    content_type = response.headers.get('Content-Type', '').lower()
-    content = b''
+    if temp_dir is None:
+        return out, file_type, origin
     
-    # Read first chunk to check if it's HTML
-    for chunk in response.iter_content(chunk_size=8192):
-        content += chunk
-        if len(content) > 1000:  # Read enough to detect HTML
-            break
+    out.close()
+    temp_file_path = os.path.splitext(out.name)[0] + FILE_TYPE_EXTENSIONS[file_type]
+    os.replace(out.name, temp_file_path)
+    return temp_file_path, file_type, origin
+
+
+def _open_cached(cache, entry, temp_dir):
+    """
+    Return a cache hit the same way download_from_google_drive returns a fresh
+    download, or None if it was evicted since the lookup.
+    """
+    if temp_dir is None:
+        # Cache objects are never modified in place, so reading them directly is safe
+        return cache.open_entry(entry)
+    return cache.materialize(entry, temp_dir, suffix=FILE_TYPE_EXTENSIONS.get(entry.get('file_type'), ''))
+
+
+AUTH_REQUIRED_MESSAGE = (
+    "This file requires authentication. Please make the file publicly accessible:\n"
+    "1. Right-click the file in Google Drive\n"
+    "2. Click 'Share'\n"
+    "3. Change access to 'Anyone with the link' can view\n"
+    "4. Copy the new shareable link and try again"
+)
+HTML_RESPONSE_MESSAGE = (
+    "Google Drive returned an HTML page instead of the file. The file may be too large or require "
+    "permission. Please make sure the file is publicly accessible or try a different link format."
+)
+
+# Download strategies, in the order they are tried by default
+# gdown always talks to drive.google.com, so it is left out when FEB_DRIVE_BASE_URL points elsewhere
+_USE_GDOWN = GDOWN_AVAILABLE and DRIVE_BASE_URL == "https://drive.google.com"
+DRIVE_STRATEGIES = ('gdown', 'direct', 'confirm', 'scrape') if _USE_GDOWN else ('direct', 'confirm', 'scrape')
+
+# Hedged downloads start the next strategy if the current one hasn't produced a
+# file after HEDGE_DELAY seconds (or as soon as it fails), and keep the first winner
+HEDGED_DOWNLOADS = os.environ.get("FEB_HEDGED_DOWNLOADS", "1") != "0"
+HEDGE_DELAY = float(os.environ.get("FEB_HEDGE_DELAY", 2.0))
+
+# Exponentially decayed win counts per strategy; the default order follows them
+_strategy_scores = {name: 0.0 for name in DRIVE_STRATEGIES}
+_strategy_wins = {name: 0 for name in DRIVE_STRATEGIES}
+_strategy_lock = threading.Lock()
+STRATEGY_SCORE_DECAY = 0.9
+
+
+def strategy_order():
+    """Strategies sorted by recent success, falling back to DRIVE_STRATEGIES order on ties."""
+    with _strategy_lock:
+        return sorted(DRIVE_STRATEGIES, key=lambda name: -_strategy_scores[name])
+
+
+def get_strategy_stats():
+    """Return total wins per strategy and the current preferred order."""
+    with _strategy_lock:
+        wins = dict(_strategy_wins)
+    return {'wins': wins, 'order': strategy_order()}
+
+
+def _record_strategy_win(name):
+    with _strategy_lock:
+        for other in _strategy_scores:
+            _strategy_scores[other] *= STRATEGY_SCORE_DECAY
+        _strategy_scores[name] += 1.0
+        _strategy_wins[name] += 1
+
+
+class _StrategyFailed(Exception):
+    """A download strategy got something other than a supported file."""
     
-    # Check if response is HTML
-    if b'<!doctype' in content.lower() or b'<html' in content.lower() or 'text/html' in content_type:
-        print("Detected HTML response, trying alternative download method...")
-        
-        # Method 2: Try with confirm parameter
-        download_url = f"https://drive.google.com/uc?export=download&confirm=t&id={file_id}"
-        response = session.get(download_url, stream=True, allow_redirects=True)
+    def __init__(self, message, auth_required=False, html=False):
+        super().__init__(message)
+        self.auth_required = auth_required
+        self.html = html
+
+
+def _is_html(content, content_type=''):
+    lowered = content.lower()
+    return b'<!doctype' in lowered or b'<html' in lowered or 'text/html' in content_type
+
+
+# Bytes kept from a rejected download to tell a sign-in page from other HTML
+SNIFF_ERROR_BYTES = 1024
+
+
+class _StreamSniffer:
+    """
+    Identify a download from its first bytes as they arrive.
+    
+    feed() returns the file type as soon as a supported signature is seen, so
+    the rest of the body can be streamed straight to its destination. Anything
+    else is rejected after at most SNIFF_ERROR_BYTES, which is only read to
+    produce a helpful error message.
+    """
+    
+    def __init__(self, content_type=''):
+        self.content_type = content_type
+        self.head = b''
+        self.file_type = None
+    
+    def feed(self, chunk):
+        """Add the next chunk; returns the file type once known, else None (need more)."""
+        self.head += chunk
+        if len(self.head) < 4:
+            return None
+        self.file_type = sniff_file_type(self.head[:4])
+        if self.file_type:
+            return self.file_type
+        if len(self.head) < SNIFF_ERROR_BYTES:
+            return None
+        self.reject()
+    
+    def reject(self):
+        """Raise the _StrategyFailed that describes what was received."""
+        if _is_html(self.head, self.content_type):
+            html_content = self.head[:SNIFF_ERROR_BYTES].decode('utf-8', errors='ignore').lower()
+            auth_required = 'sign in' in html_content or 'signin' in html_content
+            raise _StrategyFailed("Drive returned an HTML page", auth_required=auth_required, html=True)
+        raise _StrategyFailed(f"Unsupported file type. File header: {self.head[:4]}")
+
+
+def _open_response(response, session=None):
+    """
+    Read the start of a response and check it is a supported file.
+    
+    Returns:
+        Tuple of (first bytes, iterator over the remaining chunks, info dict
+        with validators, 'file_type', how to 'resume' the body (see
+        drive_http.range_source) and the 'sniff' (seconds, bytes read),
+        close function)
+    
+    Raises:
+        _StrategyFailed if Drive sent an HTML page or an unsupported file;
+        the connection is closed without reading the rest of the body
+    """
+    sniffer = _StreamSniffer(response.headers.get('Content-Type', '').lower())
+    started = time.perf_counter()
+    chunks = response.iter_content(chunk_size=8192)
+    try:
+        for chunk in chunks:
+            if sniffer.feed(chunk):
+                break
+        else:
+            sniffer.reject()
+    except _StrategyFailed:
+        response.close()
+        raise
+    
+    info = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'file_type': sniffer.file_type,
+        'resume': range_source(response, session),
+        'sniff': (time.perf_counter() - started, len(sniffer.head)),
+    }
+    return sniffer.head, chunks, info, response.close
+
+
+class _SniffingWriter:
+    """File-like wrapper that checks the first bytes written and aborts on anything unsupported."""
+    
+    def __init__(self, out):
+        self.out = out
+        self.sniffer = _StreamSniffer()
+    
+    def write(self, data):
+        if self.sniffer.file_type is None:
+            self.sniffer.feed(data)
+        return self.out.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+def _strategy_gdown(file_id, session, cancelled):
+    """Let gdown handle Drive's confirm pages (it can't stream to us, so it downloads to a buffer)."""
+    url = f"{DRIVE_BASE_URL}/uc?id={file_id}"
+    buffer = SpooledBuffer()
+    writer = _SniffingWriter(buffer)
+    try:
+        gdown.download(url, writer, quiet=False, fuzzy=True)
+        if writer.sniffer.file_type is None:
+            writer.sniffer.reject()
+    except _StrategyFailed:
+        buffer.close()
+        raise
+    except Exception as e:
+        buffer.close()
+        raise _StrategyFailed(f"gdown failed: {e}")
+    buffer.seek(0)
+    chunks = iter(lambda: buffer.read(65536), b'')
+    return b'', chunks, {'file_type': writer.sniffer.file_type}, buffer.close
+
+
+def _strategy_direct(file_id, session, cancelled):
+    """Plain uc?export=download; works for small files without a virus-scan warning."""
+    download_url = f"{DRIVE_BASE_URL}/uc?export=download&id={file_id}"
+    return _open_response(http_get(download_url, session=session, stream=True, allow_redirects=True), session)
+
+
+def _strategy_confirm(file_id, session, cancelled):
+    """Skip the virus-scan warning page with confirm=t."""
+    download_url = f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}"
+    return _open_response(http_get(download_url, session=session, stream=True, allow_redirects=True), session)
+
+
+def _strategy_scrape(file_id, session, cancelled):
+    """Fetch Drive's warning page and follow the download link it contains."""
+    page_url = f"{DRIVE_BASE_URL}/uc?export=download&confirm=t&id={file_id}"
+    response = http_get(page_url, session=session, stream=True, allow_redirects=True)
+    try:
+        # Only the warning page is read whole; a file body is given up after its first bytes
         content = b''
         for chunk in response.iter_content(chunk_size=8192):
             content += chunk
-            if len(content) > 1000:
+            if len(content) >= 2048 and not _is_html(content[:2048]):
                 break
-        
-        # If still HTML, try to extract download link from the page
-        if b'<!doctype' in content.lower() or b'<html' in content.lower():
-            print("Still HTML, attempting to parse download link...")
-            # Try to find the download link in the HTML
-            html_content = content.decode('utf-8', errors='ignore')
-            
-            # Check if it's an authentication page
-            if 'sign in' in html_content.lower() or 'signin' in html_content.lower():
-                raise ValueError(
-                    "This file requires authentication. Please make the file publicly accessible:\n"
-                    "1. Right-click the file in Google Drive\n"
-                    "2. Click 'Share'\n"
-                    "3. Change access to 'Anyone with the link' can view\n"
-                    "4. Copy the new shareable link and try again"
-                )
-            
-            # Look for the download link pattern
-            # Google Drive often has: href="/uc?export=download&id=..." or similar
-            match = re.search(r'href="(/uc\?export=download[^"]+)"', html_content)
-            if match:
-                download_url = "https://drive.google.com" + match.group(1)
-                response = session.get(download_url, stream=True, allow_redirects=True)
+        if not _is_html(content[:2048], response.headers.get('Content-Type', '').lower()):
+            # Drive sent the file itself; let the faster strategies claim it
+            raise _StrategyFailed("Drive served the file directly, nothing to scrape")
+    finally:
+        response.close()
+    
+    html_content = content.decode(response.encoding or 'utf-8', errors='ignore')
+    # Check if it's an authentication page
+    if 'sign in' in html_content.lower() or 'signin' in html_content.lower():
+        raise _StrategyFailed("Drive asked for sign-in", auth_required=True, html=True)
+    if cancelled.is_set():
+        raise _StrategyFailed("Cancelled")
+    
+    # Look for the download link pattern
+    # Google Drive often has: href="/uc?export=download&id=..." or similar
+    match = re.search(r'href="(/uc\?export=download[^"]+)"', html_content)
+    if not match:
+        # Try alternative pattern
+        match = re.search(r'id="uc-download-link"[^>]*href="([^"]+)"', html_content)
+    if match:
+        download_url = DRIVE_BASE_URL + html.unescape(match.group(1))
+    else:
+        # Last resort: try the alternative API endpoint
+        download_url = f"{DRIVE_BASE_URL}/uc?id={file_id}&export=download"
+    return _open_response(http_get(download_url, session=session, stream=True, allow_redirects=True), session)
+
+
+_STRATEGY_FUNCTIONS = {
+    'gdown': _strategy_gdown,
+    'direct': _strategy_direct,
+    'confirm': _strategy_confirm,
+    'scrape': _strategy_scrape,
+}
+
+
+def _raise_download_failure(file_id, failures):
+    """Turn the strategies' failures into the most helpful error for the user."""
+    if any(f.auth_required for f in failures):
+        raise ValueError(AUTH_REQUIRED_MESSAGE)
+    unsupported = [f for f in failures if not f.html and str(f).startswith("Unsupported file type")]
+    if unsupported:
+        raise ValueError(str(unsupported[0]))
+    if any(f.html for f in failures):
+        raise ValueError(HTML_RESPONSE_MESSAGE)
+    raise ValueError(f"Could not download {file_id} from Google Drive: " + "; ".join(str(f) for f in failures))
+
+
+def _run_strategy(name, file_id, session, cancelled):
+    """Run one strategy, converting network errors into _StrategyFailed."""
+    try:
+        return _STRATEGY_FUNCTIONS[name](file_id, session, cancelled)
+    except _StrategyFailed:
+        raise
+    except requests.RequestException as e:
+        raise _StrategyFailed(f"{name} failed: {e}")
+
+
+def _fetch_sequential(file_id, order, timings=None):
+    """Try each strategy in turn until one returns a supported file."""
+    session = new_session()
+    cancelled = threading.Event()
+    failures = []
+    for name in order:
+        print(f"Trying '{name}' download for {file_id}...")
+        try:
+            with timed(timings, 'strategy', file_id=file_id, strategy=name, outcome='failed') as span:
+                opened = _run_strategy(name, file_id, session, cancelled)
+                span.labels['outcome'] = 'won'
+            return name, opened
+        except _StrategyFailed as e:
+            print(f"'{name}' download failed: {e}")
+            failures.append(e)
+    _raise_download_failure(file_id, failures)
+
+
+def _fetch_hedged(file_id, order, timings=None):
+    """
+    Race the strategies: the next one starts after HEDGE_DELAY seconds or as
+    soon as the running ones have all failed. The first to produce a supported
+    file wins; the others are told to stop and close whatever they opened.
+    """
+    results = queue.Queue()
+    cancelled = threading.Event()
+    claim_lock = threading.Lock()
+    winner = []
+    
+    def attempt(name):
+        try:
+            with timed(timings, 'strategy', file_id=file_id, strategy=name, outcome='failed') as span:
+                opened = _run_strategy(name, file_id, new_session(), cancelled)
+                with claim_lock:
+                    won = not winner
+                    if won:
+                        winner.append(name)
+                span.labels['outcome'] = 'won' if won else 'lost'
+        except _StrategyFailed as e:
+            results.put((name, None, e))
+            return
+        except Exception as e:
+            results.put((name, None, _StrategyFailed(f"{name} failed: {e}")))
+            return
+        if not won:
+            opened[3]()  # Lost the race; release the connection
+            return
+        results.put((name, opened, None))
+    
+    pending = list(order)
+    running = 0
+    failures = []
+    while True:
+        if pending and running == 0:
+            name = pending.pop(0)
+            print(f"Starting '{name}' download for {file_id}...")
+            threading.Thread(target=attempt, args=(name,), daemon=True).start()
+            running += 1
+        try:
+            name, opened, error = results.get(timeout=HEDGE_DELAY if pending else None)
+        except queue.Empty:
+            # Current strategies are slow; hedge with the next one
+            name = pending.pop(0)
+            print(f"Still waiting after {HEDGE_DELAY:.1f}s, also starting '{name}' download for {file_id}...")
+            threading.Thread(target=attempt, args=(name,), daemon=True).start()
+            running += 1
+            continue
+        running -= 1
+        if opened is not None:
+            cancelled.set()
+            return name, opened
+        print(f"'{name}' download failed: {error}")
+        failures.append(error)
+        if not pending and running == 0:
+            _raise_download_failure(file_id, failures)
+
+
+# Large files can be fetched as several byte ranges at once (off by default)
+RANGE_PARTS = int(os.environ.get("FEB_RANGE_PARTS", 1))
+RANGE_PART_MIN_BYTES = int(os.environ.get("FEB_RANGE_PART_MIN_BYTES", 8 * 1024 * 1024))
+
+
+def _copy_in_parts(chunks, out, source, written, close):
+    """
+    Finish a download as RANGE_PARTS parallel byte ranges.
+    
+    The already-open response supplies the first range; the others are
+    fetched on their own connections into spooled buffers and appended in
+    order. Each range resumes on its own if its connection drops.
+    """
+    length = source['length']
+    parts = max(2, min(RANGE_PARTS, length // RANGE_PART_MIN_BYTES))
+    size = -(-length // parts)
+    bounds = [(start, min(length, start + size)) for start in range(0, length, size)]
+    print(f"Downloading {length} bytes as {len(bounds)} parallel ranges")
+    
+    def fetch_part(start, end):
+        buffer = SpooledBuffer()
+        try:
+            response = open_range(source, start, end)
+            if response is None:
+                raise IncompleteDownload(f"Server refused byte range {start}-{end - 1}", start)
+            copy_body(response.iter_content(chunk_size=8192), buffer, source, written=start, end=end,
+                      close=response.close)
+        except BaseException:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return buffer
+    
+    executor = ThreadPoolExecutor(max_workers=len(bounds) - 1)
+    futures = [executor.submit(fetch_part, start, end) for start, end in bounds[1:]]
+    try:
+        written = copy_body(chunks, out, source, written=written, end=bounds[0][1], close=close)
+        for future in futures:
+            # Only a contiguous prefix counts if a later range fails
+            try:
+                buffer = future.result()
+            except IncompleteDownload as e:
+                raise IncompleteDownload(str(e), written)
+            with buffer:
+                shutil.copyfileobj(buffer, out)
+            written = out.tell()
+        return written
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+
+def _partial_record(info, source):
+    """What store_partial keeps so an interrupted download can be resumed later."""
+    return {
+        'url': source['url'],
+        'validator': source['validator'],
+        'length': source['length'],
+        'etag': info.get('etag'),
+        'last_modified': info.get('last_modified'),
+        'file_type': info['file_type'],
+    }
+
+
+def _fetch_from_google_drive(file_id, out, hedged=None, timings=None):
+    """
+    Download a file from Google Drive using multiple methods.
+    
+    Args:
+        file_id: Google Drive file ID
+        out: Writable binary file object the file contents are written to
+        hedged: Race the strategies instead of trying them one at a time
+            (default: HEDGED_DOWNLOADS)
+        timings: Optional StageTimings to record 'strategy', 'sniff' and
+            'transfer' spans in
+    
+    Returns:
+        Dict with the 'etag'/'last_modified' validators from the final
+        response, the 'file_type' detected from the first bytes, and the name
+        of the 'strategy' that succeeded
+    
+    Raises:
+        IncompleteDownload (with a `partial` record for store_partial) if the
+        body kept dropping even after resuming
+    """
+    if hedged is None:
+        hedged = HEDGED_DOWNLOADS
+    order = strategy_order()
+    if hedged:
+        name, (content, chunks, info, close) = _fetch_hedged(file_id, order, timings)
+    else:
+        name, (content, chunks, info, close) = _fetch_sequential(file_id, order, timings)
+    source = info.pop('resume', None)
+    sniff = info.pop('sniff', None)
+    if sniff is not None and timings is not None:
+        timings.record('sniff', sniff[0], bytes=sniff[1], file_id=file_id, strategy=name)
+    
+    try:
+        # Write the content we already read, then the rest
+        out.write(content)
+        with timed(timings, 'transfer', file_id=file_id, strategy=name) as span:
+            if (source is not None and RANGE_PARTS > 1 and source['ranges']
+                    and (source['length'] or 0) >= 2 * RANGE_PART_MIN_BYTES):
+                written = _copy_in_parts(chunks, out, source, len(content), close)
             else:
-                # Try alternative pattern
-                match = re.search(r'id="uc-download-link"[^>]*href="([^"]+)"', html_content)
-                if match:
-                    download_url = "https://drive.google.com" + match.group(1)
-                    response = session.get(download_url, stream=True, allow_redirects=True)
-                else:
-                    # Last resort: try the alternative API endpoint
-                    download_url = f"https://drive.google.com/uc?id={file_id}&export=download"
-                    response = session.get(download_url, stream=True, allow_redirects=True)
-    
-    # Determine file extension from Content-Type or default
-    content_type = response.headers.get('Content-Type', '').lower()
-    file_extension = '.tmp'
-    
-    if 'pdf' in content_type:
-        file_extension = '.pdf'
-    elif 'png' in content_type:
-        file_extension = '.png'
-    elif 'jpeg' in content_type or 'jpg' in content_type:
-        file_extension = '.jpg'
-    
-    # Create temporary file
-    temp_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, suffix=file_extension)
-    temp_file_path = temp_file.name
-    temp_file.close()
-    
-    # Download the entire file
-    with open(temp_file_path, 'wb') as f:
-        # Write the content we already read
-        if content:
-            f.write(content)
-        # Write the rest
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+                written = copy_body(chunks, out, source, written=len(content), close=close)
+            span.bytes = written - len(content)
+    except IncompleteDownload as e:
+        e.partial = _partial_record(info, source) if source is not None else None
+        raise
+    finally:
+        close()
     
-    return temp_file_path
+    _record_strategy_win(name)
+    print(f"Downloaded {file_id} ({info['file_type']}) using '{name}'")
+    return dict(info, strategy=name)
 
 
-def process_file(google_drive_link, temp_dir):
+def _resume_partial(file_id, partial, out, timings=None):
+    """
+    Continue a download saved by store_partial, writing the whole file to out.
+    
+    Returns:
+        The same dict as _fetch_from_google_drive, or None (with out left
+        empty) if the server won't resume it
+    """
+    source = {
+        'url': partial['url'],
+        'validator': partial['validator'],
+        'length': partial['length'],
+        'ranges': True,
+        'session': new_session(),
+    }
+    try:
+        response = open_range(source, partial['bytes'])
+    except requests.RequestException:
+        response = None
+    if response is None:
+        print(f"Saved partial download of {file_id} can't be resumed, starting over")
+        return None
+    
+    print(f"Resuming download of {file_id} from byte {partial['bytes']}")
+    info = {'etag': partial['etag'], 'last_modified': partial['last_modified'], 'file_type': partial['file_type']}
+    try:
+        with open(partial['path'], 'rb') as f:
+            shutil.copyfileobj(f, out)
+        with timed(timings, 'transfer', file_id=file_id, strategy='resume') as span:
+            written = copy_body(response.iter_content(chunk_size=8192), out, source, written=partial['bytes'],
+                                close=response.close)
+            span.bytes = written - partial['bytes']
+    except IncompleteDownload as e:
+        e.partial = _partial_record(info, source)
+        raise
+    finally:
+        response.close()
+    return dict(info, strategy='resume')
+
+
+# Bump when image_to_pdf output changes so older cached conversions are not reused
+CONVERSION_VERSION = 1
+
+
+def conversion_key(source):
+    """
+    Conversion cache key for an image: its SHA-256 plus every setting that
+    affects what image_to_pdf produces.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        digest = hash_file(source)
+    else:
+        source.seek(0)
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: source.read(65536), b''):
+            sha256.update(chunk)
+        source.seek(0)
+        digest = sha256.hexdigest()
+    settings = _conversion_settings()
+    return f"{digest}_{hashlib.sha256(settings.encode()).hexdigest()[:12]}"
+
+
+def _conversion_settings():
+    return f"v{CONVERSION_VERSION}|{IMAGE_RESOLUTION}|{JPEG_PASSTHROUGH}|{MAX_IMAGE_PIXELS}"
+
+
+# Bump when a change to merging, optimization or the size budget changes the combined PDF
+RESULT_VERSION = 1
+
+
+def result_key(google_drive_links, max_bytes=MAX_OUTPUT_BYTES, max_dpi=MAX_IMAGE_DPI):
+    """
+    Result cache key for a combine: the Drive file IDs in order plus every
+    setting that affects the combined PDF.
+
+    Links are reduced to their file IDs, so different share-link spellings of
+    the same files map to the same key, and uploads to their content hash; the
+    order of the files is kept.
+
+    Raises:
+        ValueError if a link isn't a Google Drive link
+    """
+    file_ids = [input_key(link) for link in google_drive_links]
+    settings = (f"r{RESULT_VERSION}|{_conversion_settings()}|{max_bytes}|{max_dpi}|"
+                f"{OPTIMIZE_OUTPUT}|{REMOVE_UNUSED_RESOURCES}|{STREAMING_MERGE}")
+    return hashlib.sha256("\n".join(file_ids + [settings]).encode()).hexdigest()
+
+
+def process_file(google_drive_link, temp_dir=None, cache=None, convert=None, conversions=None, timings=None):
     """
     Download a file from Google Drive and convert it to PDF if needed.
     
     Args:
         google_drive_link: Google Drive shareable link
-        temp_dir: Temporary directory to save files
+        temp_dir: Temporary directory to save files, or None to keep the
+            download and conversion in memory
+        cache: Optional DownloadCache to serve repeat downloads from
+        convert: Function called as convert(image, output) to turn an image
+            into a PDF (default: image_to_pdf); the server uses this to run
+            conversions in its process pool
+        conversions: Optional ConversionCache; an image converted before
+            (same bytes, same settings) is not converted again
+        timings: Optional StageTimings to record the download and 'convert'
+            spans in
     
     Returns:
-        Path to the PDF file (original or converted)
+        Path to the PDF file (original or converted), or a binary file object
+        positioned at the start when temp_dir is None
     """
     # Convert Google Drive link to get file ID
     file_id, _ = convert_google_drive_link(google_drive_link)
     
-    # Download the file
-    temp_file_path = download_from_google_drive(file_id, temp_dir)
-    
-    # Check actual file type by reading first bytes
-    with open(temp_file_path, 'rb') as f:
-        file_header = f.read(4)
+    # Download the file; its type comes from the magic bytes sniffed while
+    # streaming, and HTML or unsupported files have already been rejected
+    source, file_type = fetch_drive_file(file_id, temp_dir, cache=cache, timings=timings)
     
-    # Determine file type from magic bytes
-    if file_header.startswith(b'%PDF'):
+    if file_type == 'pdf':
         # It's a PDF
-        print(f"File is a PDF: {temp_file_path}")
-        return temp_file_path
-    elif file_header.startswith(b'\x89PNG'):
-        # It's a PNG
-        print(f"File is a PNG: {temp_file_path}")
-        pdf_path = os.path.splitext(temp_file_path)[0] + '.pdf'
-        image_to_pdf(temp_file_path, pdf_path)
-        os.remove(temp_file_path)  # Remove original image
-        return pdf_path
-    elif file_header.startswith(b'\xff\xd8\xff'):
-        # It's a JPEG
-        print(f"File is a JPEG: {temp_file_path}")
-        pdf_path = os.path.splitext(temp_file_path)[0] + '.pdf'
-        image_to_pdf(temp_file_path, pdf_path)
-        os.remove(temp_file_path)  # Remove original image
-        return pdf_path
+        print(f"File is a PDF: {_describe(source)}")
+        return source
+    
+    # It's a PNG or JPEG
+    print(f"File is a {file_type.upper()}: {_describe(source)}")
+    return _convert_image(source, file_type, file_id, temp_dir, convert, conversions, timings)
+
+
+def _convert_image(source, file_type, file_id, temp_dir, convert, conversions, timings):
+    """
+    Convert a downloaded or uploaded image to PDF, through the conversion cache.
+    
+    The source is consumed: closed (or, as a path, removed) once converted.
+    """
+    key = conversion_key(source) if conversions is not None else None
+    entry = conversions.lookup(key) if key is not None else None
+    cached = None
+    if entry is not None:
+        # None when evicted since the lookup; then it is converted again
+        if temp_dir is None:
+            cached = conversions.open_entry(entry)
+        else:
+            cached = conversions.materialize(entry, temp_dir, prefix=f"drive_{file_id}_", suffix='.pdf')
+    if cached is not None:
+        conversions.touch(key)
+        print(f"Using cached conversion for {file_id}")
+        if timings is not None:
+            timings.record('convert', 0.0, bytes=entry.get('size'), file_id=file_id, file_type=file_type, cached=True)
+        if temp_dir is None:
+            source.close()
+        else:
+            os.remove(source)
+        return cached
+    
+    convert = convert or image_to_pdf
+    if temp_dir is None:
+        pdf_file = SpooledBuffer()
+        with timed(timings, 'convert', file_id=file_id, file_type=file_type, cached=False) as span:
+            convert(source, pdf_file)
+            span.bytes = pdf_file.tell()
+        source.close()
+        pdf_file.seek(0)
+        if key is not None:
+            conversions.store(key, pdf_file, file_type='pdf')
+            pdf_file.seek(0)
+        return pdf_file
+    pdf_path = os.path.splitext(source)[0] + '.pdf'
+    with timed(timings, 'convert', file_id=file_id, file_type=file_type, cached=False) as span:
+        convert(source, pdf_path)
+        span.bytes = os.path.getsize(pdf_path)
+    # The raw download stays in the download cache and the PDF in the
+    # conversion cache, so this private copy is no longer needed
+    os.remove(source)
+    if key is not None:
+        conversions.store(key, pdf_path, file_type='pdf')
+    return pdf_path
+
+
+class UploadedFile:
+    """
+    An input file sent along with the request instead of as a Drive link.
+    
+    combine_links and friends accept these mixed with links; the file object
+    is read in place (a PDF is merged straight from it) and closed by the
+    pipeline. Its SHA-256 stands in for the Drive file ID in result_key.
+    """
+    
+    def __init__(self, source, sha256, size, name=None):
+        """
+        Args:
+            source: Binary file object holding the upload (e.g. a SpooledBuffer)
+            sha256: Hex SHA-256 of the contents
+            size: Length of the contents in bytes
+            name: Client-side file name, for messages
+        """
+        self.source = source
+        self.sha256 = sha256
+        self.size = size
+        self.name = name or "upload"
+    
+    @property
+    def label(self):
+        """Stands in for a file ID in messages and timing spans."""
+        return f"upload:{self.name}"
+    
+    def close(self):
+        self.source.close()
+
+
+def process_upload(upload, convert=None, conversions=None, timings=None):
+    """
+    Convert an uploaded file to PDF if needed (process_file for an UploadedFile).
+    
+    Returns:
+        Binary file object of the PDF, positioned at the start
+    
+    Raises:
+        ValueError if the upload is not a PDF, PNG or JPEG
+    """
+    source = upload.source
+    source.seek(0)
+    file_type = sniff_file_type(source.read(4))
+    source.seek(0)
+    if file_type is None:
+        source.close()
+        raise ValueError(f"{upload.name} is not a PDF, PNG or JPEG file")
+    if file_type == 'pdf':
+        print(f"Upload is a PDF: {upload.name}")
+        return source
+    print(f"Upload is a {file_type.upper()}: {upload.name}")
+    return _convert_image(source, file_type, upload.label, None, convert, conversions, timings)
+
+
+def input_key(item):
+    """Identity of a combine input: the Drive file ID of a link, or upload:<sha256>."""
+    if isinstance(item, UploadedFile):
+        return f"upload:{item.sha256}"
+    return convert_google_drive_link(item)[0]
+
+
+# Upper bound on concurrent downloads/conversions for one batch of links
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("FEB_DOWNLOAD_WORKERS", 8))
+
+
+def iter_processed_files(google_drive_links, temp_dir=None, cache=None, max_workers=None, convert=None,
+                         conversions=None, timings=None):
+    """
+    Download and convert several Google Drive files in parallel, yielding the
+    PDFs in input order as soon as each one (and every one before it) is ready.
+    
+    Each distinct file is fetched once, on up to max_workers threads, so the
+    total time is roughly that of the slowest download rather than the sum of
+    all of them.
+    
+    Args:
+        google_drive_links: List of Google Drive shareable links
+        temp_dir: Temporary directory to save files, or None to work in memory
+        cache: Optional DownloadCache to serve repeat downloads from
+        max_workers: Maximum number of concurrent downloads
+            (default: one per file, up to MAX_DOWNLOAD_WORKERS)
+        convert: Image-to-PDF function passed to process_file
+        conversions: Optional ConversionCache passed to process_file
+        timings: Optional StageTimings passed to process_file
+    
+    Yields:
+        PDF paths (or file objects, see process_file) in the same order as
+        google_drive_links; a link repeated in the list maps to the same result
+    
+    Raises:
+        The first error (in input order) raised while processing a link;
+        downloads that have not started yet are cancelled, and the results of
+        the ones still running (or never yielded) are deleted or closed as
+        they finish
+    
+    UploadedFile items may be mixed with the links; they are converted (if
+    needed) in memory by process_upload.
+    """
+    # The same receipt linked (or uploaded) twice is only processed once
+    file_ids = [input_key(link) for link in google_drive_links]
+    unique_links = {}
+    for file_id, link in zip(file_ids, google_drive_links):
+        unique_links.setdefault(file_id, link)
+    
+    if not unique_links:
+        return
+    
+    workers = max_workers or min(len(unique_links), MAX_DOWNLOAD_WORKERS)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    yielded = set()
+    try:
+        for file_id, link in unique_links.items():
+            if isinstance(link, UploadedFile):
+                futures[file_id] = executor.submit(process_upload, link, convert, conversions, timings)
+            else:
+                futures[file_id] = executor.submit(process_file, link, temp_dir, cache, convert, conversions,
+                                                   timings)
+        for file_id in file_ids:
+            result = futures[file_id].result()
+            yielded.add(file_id)
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Without this, files still downloading when the combine failed (or
+        # ready but never handed out) would leave their temp PDFs behind
+        for file_id, future in futures.items():
+            if file_id not in yielded:
+                future.add_done_callback(_discard_result)
+
+
+def _discard_result(future):
+    """Done-callback that deletes (or closes) the PDF of a file nobody is going to merge."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if isinstance(result, (str, os.PathLike)):
+        try:
+            os.remove(result)
+        except OSError:
+            pass
     else:
-        # Try reading more bytes to see if it's HTML
-        with open(temp_file_path, 'rb') as f:
-            more_content = f.read(100)
-        if b'<!doctype' in more_content.lower() or b'<html' in more_content.lower():
-            raise ValueError("Google Drive returned an HTML page instead of the file. The file may be too large or require permission. Please make sure the file is publicly accessible or try a different link format.")
-        raise ValueError(f"Unsupported file type. File header: {file_header}")
+        result.close()
+
+
+def process_files(google_drive_links, temp_dir=None, cache=None, max_workers=None, conversions=None,
+                  timings=None):
+    """
+    Download and convert several Google Drive files in parallel.
+    
+    Args:
+        google_drive_links: List of Google Drive shareable links
+        temp_dir: Temporary directory to save files, or None to work in memory
+        cache: Optional DownloadCache to serve repeat downloads from
+        max_workers: Maximum number of concurrent downloads
+        conversions: Optional ConversionCache to reuse earlier image conversions
+        timings: Optional StageTimings to record per-file stage spans in
+    
+    Returns:
+        List of PDF paths (or file objects, see process_file) in the same
+        order as google_drive_links; a link repeated in the list maps to the
+        same result
+    
+    Raises:
+        The first error (in input order) raised while processing a link
+    """
+    return list(iter_processed_files(google_drive_links, temp_dir, cache=cache, max_workers=max_workers,
+                                     conversions=conversions, timings=timings))
+
+
+def merge_pdfs(pdf_files, output_path, max_bytes=MAX_OUTPUT_BYTES, max_dpi=MAX_IMAGE_DPI,
+               optimize=OPTIMIZE_OUTPUT, timings=None):
+    """
+    Merge PDFs in order, optimize the result and, when a budget is set, fit it.
+    
+    Args:
+        pdf_files: Iterable of PDF paths or binary file objects
+        output_path: Path (or writable binary file object) for the combined PDF
+        max_bytes: Size budget for the combined PDF (see fit_pdf_to_budget)
+        max_dpi: Image resolution cap at letter size (see fit_pdf_to_budget)
+        optimize: Deduplicate objects and compress streams (see optimize_pdf)
+        timings: Optional StageTimings to record the merge, 'optimize' and
+            'budget' spans in
+    
+    Returns:
+        The fit_pdf_to_budget report when a budget is set, else None
+    """
+    budgeted = max_bytes is not None or max_dpi is not None
+    merged = SpooledBuffer() if budgeted or optimize else output_path
+    try:
+        combine_pdfs(pdf_files, merged, timings=timings)
+        if optimize:
+            # Runs before the budget pass so the budget sees the optimized size
+            print("Optimizing combined PDF...")
+            optimized = SpooledBuffer() if budgeted else output_path
+            merged.seek(0)
+            try:
+                with timed(timings, 'optimize') as span:
+                    span.bytes = optimize_pdf(merged, optimized)['bytes']
+            except Exception:
+                if budgeted:
+                    optimized.close()
+                raise
+            merged.close()
+            merged = optimized
+        if budgeted:
+            print("Fitting combined PDF to the size budget...")
+            merged.seek(0)
+            with timed(timings, 'budget') as span:
+                report = fit_pdf_to_budget(merged, output_path, max_bytes=max_bytes, max_dpi=max_dpi)
+                span.bytes = report['bytes']
+            return report
+    finally:
+        if merged is not output_path:
+            merged.close()
+
+
+# Jobs for worker processes (cpu_pool) exchange files the way they are held:
+# a file on disk travels as its path, so only inputs and outputs that stayed
+# in memory (at most SPOOL_THRESHOLD each) are sent as bytes.
+
+
+def to_job_source(source):
+    """
+    An input for image_to_pdf_job / merge_pdfs_job: the path of a file that is
+    on disk (a path, a spilled SpooledBuffer, an open cache file), else the
+    bytes of an in-memory file object.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    name = getattr(source, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        source.flush()
+        return name
+    source.seek(0)
+    return source.read()
+
+
+def _from_job_source(source):
+    return BytesIO(source) if isinstance(source, bytes) else source
+
+
+def _to_job_output(buffer):
+    """What a job sends back for its SpooledBuffer output: the kept file's path, or the bytes."""
+    if buffer.path is None:
+        buffer.seek(0)
+        data = buffer.read()
+        buffer.close()
+        return data
+    return buffer.keep()
+
+
+def from_job_output(result, output):
+    """
+    Write a job's output (see _to_job_output) to output, a path or writable
+    binary file object. A file on disk is moved into place, or adopted by an
+    empty SpooledBuffer, rather than copied where possible.
+    """
+    if isinstance(result, bytes):
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, 'wb') as f:
+                f.write(result)
+        else:
+            output.write(result)
+        return
+    if isinstance(output, (str, os.PathLike)):
+        shutil.move(result, output)
+        return
+    if isinstance(output, SpooledBuffer) and output.adopt(result):
+        return
+    try:
+        with open(result, 'rb') as f:
+            shutil.copyfileobj(f, output)
+    finally:
+        _remove_quietly(result)
+
+
+def image_to_pdf_job(image):
+    """
+    image_to_pdf in a worker process (a picklable job for cpu_pool).
+    
+    Args:
+        image: Path or bytes of the image (see to_job_source)
+    
+    Returns:
+        Tuple of (the PDF, for from_job_output; image_to_pdf report)
+    """
+    output = SpooledBuffer()
+    try:
+        report = image_to_pdf(_from_job_source(image), output)
+    except BaseException:
+        output.close()
+        raise
+    return _to_job_output(output), report
+
+
+def merge_pdfs_job(sources, max_bytes=None, max_dpi=None):
+    """
+    merge_pdfs in a worker process (a picklable job for cpu_pool).
+    
+    The same source object listed twice is parsed once, like a repeated file
+    object in combine_pdfs.
+    
+    Args:
+        sources: Paths or bytes of the PDFs, in order (see to_job_source)
+    
+    Returns:
+        Tuple of (the merged PDF, for from_job_output; merge_pdfs report;
+        list of stage timing spans recorded in the worker, see
+        StageTimings.extend)
+    """
+    files = {}
+    pdf_files = [files.setdefault(id(source), _from_job_source(source)) for source in sources]
+    output = SpooledBuffer()
+    timings = StageTimings()
+    try:
+        report = merge_pdfs(pdf_files, output, max_bytes=max_bytes, max_dpi=max_dpi, timings=timings)
+    except BaseException:
+        output.close()
+        raise
+    return _to_job_output(output), report, timings.spans
+
+
+def combine_links(google_drive_links, output_path, temp_dir=None, cache=None, max_workers=None,
+                  max_bytes=MAX_OUTPUT_BYTES, max_dpi=MAX_IMAGE_DPI, convert=None, merge=None,
+                  conversions=None, timings=None):
+    """
+    Combine any number of Google Drive files (PDF, PNG, or JPEG), in order, into one PDF.
+    
+    Downloads and conversions run in parallel, and each file is merged as soon
+    as it and all the files before it are ready.
+    
+    Args:
+        google_drive_links: Ordered list of Google Drive shareable links
+            (and/or UploadedFile inputs, which are closed when done)
+        output_path: Path (or writable binary file object) for the combined PDF
+        temp_dir: Temporary directory to save files, or None to work in memory
+        cache: Optional DownloadCache to serve repeat downloads from
+        max_workers: Maximum number of concurrent downloads
+        max_bytes: Size budget for the combined PDF (see fit_pdf_to_budget)
+        max_dpi: Image resolution cap at letter size (see fit_pdf_to_budget)
+        convert: Image-to-PDF function passed to process_file
+        merge: Function with merge_pdfs' signature used for the merge and
+            budget step (default: merge_pdfs in this process)
+        conversions: Optional ConversionCache to reuse earlier image conversions
+        timings: Optional StageTimings that collects a span per pipeline
+            stage and file (see stage_timing)
+    
+    Returns:
+        The fit_pdf_to_budget report when a budget is set, else None
+    """
+    if not google_drive_links:
+        raise ValueError("Need at least one Google Drive link to combine")
+    
+    pdf_files = []
+    
+    def tracked():
+        for pdf_file in iter_processed_files(google_drive_links, temp_dir, cache=cache,
+                                             max_workers=max_workers, convert=convert,
+                                             conversions=conversions, timings=timings):
+            pdf_files.append(pdf_file)
+            yield pdf_file
+    
+    merge = merge or merge_pdfs
+    try:
+        return merge(tracked(), output_path, max_bytes=max_bytes, max_dpi=max_dpi, timings=timings)
+    finally:
+        for pdf_file in pdf_files:
+            if not isinstance(pdf_file, (str, os.PathLike)):
+                pdf_file.close()
 
 
 def main():
     """
-    Main function to combine two Google Drive files into one PDF.
+    Main function to combine Google Drive files into one PDF.
     """
     print("=" * 60)
     print("Google Drive File Combiner")
@@ -297,16 +1775,27 @@ def main():
     temp_dir.mkdir(exist_ok=True)
     outputs_dir.mkdir(exist_ok=True)
     
+    # Downloads and image conversions are kept between runs so retries don't
+    # hit Google Drive or re-convert images again
+    cache = DownloadCache(project_dir / "cache")
+    conversions = ConversionCache(project_dir / "cache" / "converted")
+    
     print(f"Using project temp directory: {temp_dir}")
     print(f"Outputs will be saved to: {outputs_dir}")
     print()
     
     # Get Google Drive links from user
-    print("Enter the first Google Drive link (PDF, PNG, or JPEG):")
-    link1 = input().strip()
-    
-    print("\nEnter the second Google Drive link (PDF, PNG, or JPEG):")
-    link2 = input().strip()
+    print("Enter the Google Drive links to combine (PDF, PNG, or JPEG), one per line.")
+    print("Press Enter on an empty line when done:")
+    links = []
+    while True:
+        link = input().strip()
+        if not link:
+            break
+        links.append(link)
+    if not links:
+        print("No links entered, nothing to combine.")
+        return
     
     # Get output filename
     print("\nEnter output PDF filename (default: combined_output.pdf):")
@@ -320,30 +1809,18 @@ def main():
     output_path = outputs_dir / output_filename
     
     try:
-        # Process both files
-        pdf_paths = []
-        
-        print("\n" + "=" * 60)
-        print("Processing first file...")
-        print("=" * 60)
-        pdf1 = process_file(link1, str(temp_dir))
-        pdf_paths.append(pdf1)
-        
-        print("\n" + "=" * 60)
-        print("Processing second file...")
-        print("=" * 60)
-        pdf2 = process_file(link2, str(temp_dir))
-        pdf_paths.append(pdf2)
-        
-        # Combine PDFs
+        # Download all files at the same time, merging each as soon as it is ready
         print("\n" + "=" * 60)
-        print("Combining files...")
+        print(f"Processing and combining {len(links)} files...")
         print("=" * 60)
-        combine_pdfs(pdf_paths, str(output_path))
+        timings = StageTimings()
+        combine_links(links, str(output_path), str(temp_dir), cache=cache, conversions=conversions,
+                      timings=timings)
         
         print("\n" + "=" * 60)
         print(f"SUCCESS! Combined PDF saved as: {output_path}")
         print("=" * 60)
+        print(timings.format_table())
         
     except Exception as e:
         print(f"\nERROR: {str(e)}")
@@ -0,0 +1,191 @@
+"""
+Bounded pool of worker processes for CPU-bound jobs (image conversion, PDF merging).
+
+Pillow encoding and PyPDF2 parsing hold the GIL, so running them on request
+threads serializes every concurrent combine. CpuPool keeps up to a fixed number of
+long-lived worker processes, started one at a time as concurrent jobs need
+them; run() hands a job to an idle worker and blocks the calling thread until
+it finishes. A job that runs past its timeout has its
+worker killed and replaced, so one runaway PDF can't wedge the pool.
+
+Jobs must be module-level functions, and their arguments and results must be
+picklable: pass files on disk as paths and only small ones as bytes, never
+open files (see combine_drive_files.to_job_source).
+
+Settings can be overridden with environment variables:
+    FEB_CPU_WORKERS      most worker processes (default: CPUs available to this
+                         process; 0 runs jobs inline). Each worker is a whole
+                         interpreter with Pillow and PyPDF2 loaded, so lower it
+                         to fit memory, e.g. 1 or 2 on a 512 MB instance
+    FEB_CPU_JOB_TIMEOUT  seconds before a job is killed (default: 60)
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+
+def _available_cpus():
+    """CPUs this process may run on (os.cpu_count() reports the host's inside containers)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS or Windows
+        return os.cpu_count() or 1
+
+
+CPU_WORKERS = int(os.environ.get("FEB_CPU_WORKERS", _available_cpus()))
+CPU_JOB_TIMEOUT = float(os.environ.get("FEB_CPU_JOB_TIMEOUT", 60))
+
+# spawn, not fork: the server forks from a process with live threads and locks
+_context = multiprocessing.get_context("spawn")
+
+
+class JobTimeout(TimeoutError):
+    """A job ran longer than its timeout and its worker was killed."""
+
+
+def _worker_main(conn):
+    """Loop in the worker process: receive (func, args), send back (ok, result or exception)."""
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except BaseException as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The exception (or result) itself couldn't be pickled
+            conn.send((False, RuntimeError(f"{func.__name__} failed: {e!r}")))
+
+
+class _Worker:
+    def __init__(self):
+        self.conn, child_conn = _context.Pipe()
+        self.process = _context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class CpuPool:
+    """Bounded pool of worker processes; see the module docstring."""
+
+    def __init__(self, workers=CPU_WORKERS, timeout=CPU_JOB_TIMEOUT):
+        self.size = workers
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._spawned = 0
+        self._lock = threading.Lock()
+
+    def _get_worker(self, timeout):
+        """
+        An idle worker, a newly started one while the pool is below its size,
+        or the next one to free up.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        # Workers are started only when jobs overlap, so an idle server (and
+        # importing it) costs no extra interpreters
+        with self._lock:
+            spawn = self._spawned < self.size
+            if spawn:
+                self._spawned += 1
+        if spawn:
+            try:
+                return _Worker()
+            except BaseException:
+                with self._lock:
+                    self._spawned -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise JobTimeout(f"No CPU worker became free within {timeout:.0f}s")
+
+    def run(self, func, *args, timeout=None):
+        """
+        Run func(*args) in a worker process and return its result.
+
+        Args:
+            func: Module-level function to call
+            args: Picklable arguments
+            timeout: Seconds allowed for the job (default: the pool's timeout);
+                the same limit applies to waiting for a free worker
+
+        Raises:
+            JobTimeout if no worker frees up, or the job doesn't finish, in time.
+            Any exception raised by func is re-raised here.
+        """
+        if self.size <= 0:
+            return func(*args)
+        timeout = self.timeout if timeout is None else timeout
+        worker = self._get_worker(timeout)
+
+        timed_out = crashed = False
+        try:
+            worker.conn.send((func, args))
+            if worker.conn.poll(timeout):
+                ok, value = worker.conn.recv()
+            else:
+                timed_out = True
+        except (EOFError, OSError):
+            # The worker died (e.g. killed by the OOM killer)
+            crashed = True
+        finally:
+            if timed_out or crashed:
+                worker.kill()
+                self._idle.put(_Worker())
+            else:
+                self._idle.put(worker)
+
+        if timed_out:
+            print(f"CPU job {func.__name__} exceeded {timeout:.0f}s, its worker was killed")
+            raise JobTimeout(f"{func.__name__} took longer than {timeout:.0f}s and was stopped")
+        if crashed:
+            raise RuntimeError(f"CPU worker crashed while running {func.__name__}")
+        if not ok:
+            raise value
+        return value
+
+    def busy_workers(self):
+        """Number of workers running a job right now."""
+        return self._spawned - self._idle.qsize()
+
+    def worker_pids(self):
+        """Process IDs of the currently idle workers (for diagnostics)."""
+        return [worker.process.pid for worker in list(self._idle.queue)]
+
+    def shutdown(self):
+        """Stop all idle workers."""
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._spawned -= 1
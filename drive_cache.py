@@ -0,0 +1,388 @@
+"""
+Persistent on-disk cache for files downloaded from Google Drive.
+
+File contents are stored once per SHA-256 hash under objects/, and each cache
+key (normally the Drive file ID) points at its object through a small JSON
+record under keys/. Records remember the ETag / Last-Modified validators Drive
+sent, so stale entries can be revalidated with a conditional request instead
+of being downloaded again. The total size of objects/ is capped and the least
+recently used keys are evicted first. Downloads that were interrupted can be
+kept under partial/ so a later attempt resumes them instead of starting over.
+
+ConversionCache stores PDFs converted from images the same way, in its own
+directory with its own size cap, keyed by the source file's hash plus the
+conversion settings.
+
+ResultCache keeps whole combined PDFs for the server, keyed by the ordered
+Drive file IDs plus every setting that affects the output, so a repeated
+/combine is answered without downloading or merging anything. Entries expire
+after a TTL because the Drive files behind the IDs may change.
+
+Settings can be overridden with environment variables:
+    FEB_CACHE_DIR                   cache directory (default: <system temp>/feb_drive_cache)
+    FEB_CACHE_MAX_BYTES             size cap for stored files (default: 256 MB)
+    FEB_CACHE_MAX_AGE               seconds an entry is trusted without revalidating (default: 6 hours)
+    FEB_CONVERSION_CACHE_DIR        converted PDF cache directory (default: <system temp>/feb_conversion_cache)
+    FEB_CONVERSION_CACHE_MAX_BYTES  size cap for converted PDFs (default: 128 MB)
+    FEB_RESULT_CACHE_DIR            combined PDF cache directory (default: <system temp>/feb_result_cache)
+    FEB_RESULT_CACHE_MAX_BYTES      size cap for combined PDFs, 0 disables the cache (default: 128 MB)
+    FEB_RESULT_CACHE_TTL            seconds a combined PDF is served from the cache (default: 1 hour)
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = os.environ.get("FEB_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "feb_drive_cache")
+DEFAULT_MAX_BYTES = int(os.environ.get("FEB_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+DEFAULT_MAX_AGE = float(os.environ.get("FEB_CACHE_MAX_AGE", 6 * 3600))
+CONVERSION_CACHE_DIR = (os.environ.get("FEB_CONVERSION_CACHE_DIR")
+                        or os.path.join(tempfile.gettempdir(), "feb_conversion_cache"))
+CONVERSION_CACHE_MAX_BYTES = int(os.environ.get("FEB_CONVERSION_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+RESULT_CACHE_DIR = os.environ.get("FEB_RESULT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "feb_result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("FEB_RESULT_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("FEB_RESULT_CACHE_TTL", 3600))
+
+
+def hash_file(path, chunk_size=65536):
+    """Return the hex SHA-256 digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """Hard-link src to dst when possible (same filesystem), otherwise copy it."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class DownloadCache:
+    """
+    Content-addressed file cache with a size cap and LRU eviction.
+
+    Safe to share between threads; separate processes may point at the same
+    directory because every write is done with an atomic rename.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.objects_dir = self.cache_dir / "objects"
+        self.keys_dir = self.cache_dir / "keys"
+        self.partial_dir = self.cache_dir / "partial"
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.keys_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _key_path(self, key):
+        safe_key = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        return self.keys_dir / f"{safe_key}.json"
+
+    def _object_path(self, sha256):
+        return self.objects_dir / sha256
+
+    def _write_record(self, key, record):
+        key_path = self._key_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.keys_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, key_path)
+
+    def lookup(self, key):
+        """
+        Look up a cached entry.
+
+        Returns:
+            The entry dict (with 'path' and 'fresh' filled in), or None on a miss
+        """
+        key_path = self._key_path(key)
+        try:
+            with open(key_path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        object_path = self._object_path(record.get('sha256', ''))
+        if not object_path.is_file():
+            # Object was evicted by another process; drop the dangling key
+            try:
+                key_path.unlink()
+            except OSError:
+                pass
+            return None
+
+        record['path'] = str(object_path)
+        record['fresh'] = time.time() - record.get('validated_at', 0) < self.max_age
+        return record
+
+    def touch(self, key, revalidated=False):
+        """Mark a key as recently used (and, optionally, as just revalidated)."""
+        key_path = self._key_path(key)
+        if revalidated:
+            with self._lock:
+                entry = self.lookup(key)
+                if entry is None:
+                    return
+                entry.pop('path', None)
+                entry.pop('fresh', None)
+                entry['validated_at'] = time.time()
+                self._write_record(key, entry)
+        else:
+            try:
+                os.utime(key_path)
+            except OSError:
+                pass
+
+    def _copy_stream(self, src):
+        """Copy a file object into a temp file under objects/, hashing as it goes."""
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: src.read(65536), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        return digest.hexdigest(), tmp_path
+
+    def store(self, key, src, validators=None, **extra):
+        """
+        Add a file to the cache under key. The source file is left in place.
+
+        Args:
+            key: Cache key (e.g. a Drive file ID)
+            src: Path of the file to store, or a binary file object (read
+                from its current position to the end)
+            validators: Optional dict with 'etag' and/or 'last_modified'
+            extra: Additional JSON-serialisable fields kept in the record
+
+        Returns:
+            The stored entry dict
+        """
+        if hasattr(src, 'read'):
+            sha256, tmp_path = self._copy_stream(src)
+        else:
+            sha256, tmp_path = hash_file(src), None
+        object_path = self._object_path(sha256)
+        with self._lock:
+            if object_path.is_file():
+                if tmp_path:
+                    os.remove(tmp_path)
+            else:
+                if tmp_path is None:
+                    fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+                    os.close(fd)
+                    os.remove(tmp_path)
+                    _link_or_copy(src, tmp_path)
+                os.replace(tmp_path, object_path)
+
+            record = {
+                'key': key,
+                'sha256': sha256,
+                'size': os.path.getsize(object_path),
+                'etag': (validators or {}).get('etag'),
+                'last_modified': (validators or {}).get('last_modified'),
+                'validated_at': time.time(),
+            }
+            record.update(extra)
+            self._write_record(key, record)
+            self._evict()
+
+        record['path'] = str(object_path)
+        record['fresh'] = True
+        return record
+
+    def materialize(self, entry, dest_dir, prefix="cached_", suffix=""):
+        """
+        Place a private copy of a cached file in dest_dir.
+
+        Callers may delete or convert the returned file without affecting the cache.
+
+        Returns:
+            Path of the copy, or None if the entry was evicted since it was
+            looked up (treat it as a miss)
+        """
+        fd, dest_path = tempfile.mkstemp(dir=dest_dir, prefix=prefix, suffix=suffix)
+        os.close(fd)
+        os.remove(dest_path)
+        try:
+            _link_or_copy(entry['path'], dest_path)
+        except FileNotFoundError:
+            return None
+        return dest_path
+
+    def open_entry(self, entry):
+        """
+        Open a looked-up entry for reading.
+
+        Returns:
+            Binary file object, or None if the entry was evicted since it was
+            looked up (treat it as a miss); once open, eviction can't affect it
+        """
+        try:
+            return open(entry['path'], 'rb')
+        except FileNotFoundError:
+            return None
+
+    def _partial_paths(self, key):
+        safe_key = self._key_path(key).stem
+        return self.partial_dir / f"{safe_key}.part", self.partial_dir / f"{safe_key}.json"
+
+    def store_partial(self, key, src, size, **record):
+        """
+        Keep the first size bytes of an interrupted download so it can be resumed.
+
+        Args:
+            key: Cache key (e.g. a Drive file ID)
+            src: Binary file object positioned at the start of the download
+            size: Number of bytes that were downloaded
+            record: JSON-serialisable details needed to resume (URL, validator, ...)
+        """
+        if size <= 0 or size > self.max_bytes:
+            return
+        data_path, record_path = self._partial_paths(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.partial_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            remaining = size
+            while remaining:
+                chunk = src.read(min(65536, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        os.replace(tmp_path, data_path)
+
+        record.update(key=key, bytes=size - remaining, saved_at=time.time())
+        fd, tmp_path = tempfile.mkstemp(dir=self.partial_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, record_path)
+
+    def lookup_partial(self, key):
+        """
+        Look up an interrupted download.
+
+        Returns:
+            The record passed to store_partial plus 'bytes' and 'path', or None
+            (partials older than max_age are discarded)
+        """
+        data_path, record_path = self._partial_paths(key)
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            size = data_path.stat().st_size
+        except (OSError, ValueError):
+            return None
+        if size != record.get('bytes') or time.time() - record.get('saved_at', 0) > self.max_age:
+            self.discard_partial(key)
+            return None
+        record['path'] = str(data_path)
+        return record
+
+    def discard_partial(self, key):
+        """Remove an interrupted download (after it completed or can't be resumed)."""
+        for path in self._partial_paths(key):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Remove least recently used keys until stored objects fit within max_bytes."""
+        records = []
+        for key_path in self.keys_dir.glob("*.json"):
+            try:
+                with open(key_path) as f:
+                    record = json.load(f)
+                records.append((key_path.stat().st_mtime, key_path, record.get('sha256')))
+            except (OSError, ValueError):
+                continue
+
+        sizes = {}
+        for object_path in self.objects_dir.iterdir():
+            if object_path.suffix != ".tmp":
+                sizes[object_path.name] = object_path.stat().st_size
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        records.sort()
+        refcounts = {}
+        for _, _, sha256 in records:
+            refcounts[sha256] = refcounts.get(sha256, 0) + 1
+
+        for _, key_path, sha256 in records:
+            if total <= self.max_bytes:
+                break
+            try:
+                key_path.unlink()
+            except OSError:
+                continue
+            refcounts[sha256] -= 1
+            if refcounts[sha256] == 0 and sha256 in sizes:
+                try:
+                    self._object_path(sha256).unlink()
+                    total -= sizes.pop(sha256)
+                except OSError:
+                    pass
+
+        # Still over the cap: drop objects no key points at any more
+        if total <= self.max_bytes:
+            return
+        for sha256 in list(sizes):
+            if refcounts.get(sha256, 0) == 0:
+                try:
+                    self._object_path(sha256).unlink()
+                except OSError:
+                    pass
+
+
+class ConversionCache(DownloadCache):
+    """
+    Cache of PDFs converted from images.
+
+    Keys already include the source content hash and conversion settings, so
+    entries never go stale; they are only evicted (least recently used first)
+    to stay within max_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=CONVERSION_CACHE_MAX_BYTES):
+        super().__init__(cache_dir or CONVERSION_CACHE_DIR, max_bytes=max_bytes, max_age=float('inf'))
+
+
+class ResultCache(DownloadCache):
+    """
+    Cache of combined PDFs, keyed by combine_drive_files.result_key().
+
+    Unlike downloads, an expired entry can't be revalidated (that would mean
+    asking Drive about every input), so lookup() treats entries older than
+    ttl as misses and the combine runs again. The stored object's SHA-256 is a
+    strong validator for the PDF, used as the response's ETag.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        super().__init__(cache_dir or RESULT_CACHE_DIR, max_bytes=max_bytes, max_age=ttl)
+
+    def lookup(self, key):
+        """
+        Look up a combined PDF.
+
+        Returns:
+            The entry dict (with 'path' and 'sha256'), or None on a miss or
+            when the entry is older than the TTL
+        """
+        entry = super().lookup(key)
+        if entry is None or not entry['fresh']:
+            return None
+        return entry
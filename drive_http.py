@@ -0,0 +1,260 @@
+"""
+Shared HTTP connection pool for talking to Google Drive.
+
+Every download goes through one pooled HTTPAdapter, so connections to
+drive.google.com / drive.usercontent.google.com are kept alive and reused
+across files and requests. http_get() adds connect/read timeouts and retries
+429 and 5xx responses (and dropped connections) with exponential backoff and
+full jitter, honouring Retry-After when Drive sends it. Retries are counted
+per request and in running totals (see get_http_stats()), which makes Drive
+throttling visible.
+
+copy_body() streams a response body to a file and, when the connection drops
+part-way, picks up where it stopped with a Range request against the final
+(post-redirect) URL instead of starting again from byte zero.
+
+Settings can be overridden with environment variables:
+    FEB_HTTP_POOL_SIZE        max connections kept per host (default: 10)
+    FEB_HTTP_CONNECT_TIMEOUT  seconds to wait for a connection (default: 10)
+    FEB_HTTP_READ_TIMEOUT     seconds to wait between bytes (default: 60)
+    FEB_HTTP_MAX_RETRIES      retries after the first attempt (default: 4)
+    FEB_HTTP_BACKOFF_BASE     first backoff step in seconds (default: 0.5)
+    FEB_HTTP_RESUME_ATTEMPTS  times a dropped download is resumed (default: 3)
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = int(os.environ.get("FEB_HTTP_POOL_SIZE", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("FEB_HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("FEB_HTTP_READ_TIMEOUT", 60))
+HTTP_MAX_RETRIES = int(os.environ.get("FEB_HTTP_MAX_RETRIES", 4))
+HTTP_BACKOFF_BASE = float(os.environ.get("FEB_HTTP_BACKOFF_BASE", 0.5))
+HTTP_BACKOFF_CAP = 30.0
+HTTP_RESUME_ATTEMPTS = int(os.environ.get("FEB_HTTP_RESUME_ATTEMPTS", 3))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Raised while iterating a body when the connection drops or stalls
+BODY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# pool_block=True makes extra threads wait for a free connection instead of
+# opening unbounded new ones to the same host
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+_shared_session = None
+_session_lock = threading.Lock()
+
+_stats = {'requests': 0, 'retried_requests': 0, 'retries': 0, 'throttled': 0, 'failures': 0}
+_stats_lock = threading.Lock()
+
+
+def new_session():
+    """
+    Create a session with its own cookies that shares the module's connection pool.
+
+    Drive's confirm flow depends on cookies from earlier responses, so each
+    download should use its own session while still reusing connections.
+    """
+    session = requests.Session()
+    session.mount('https://', _adapter)
+    session.mount('http://', _adapter)
+    return session
+
+
+def get_session():
+    """Return the process-wide session (for requests that don't need private cookies)."""
+    global _shared_session
+    with _session_lock:
+        if _shared_session is None:
+            _shared_session = new_session()
+        return _shared_session
+
+
+def get_http_stats():
+    """Return a snapshot of request/retry counters since the process started."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _record(retries, throttled, failed=False):
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['retries'] += retries
+        _stats['throttled'] += throttled
+        if retries:
+            _stats['retried_requests'] += 1
+        if failed:
+            _stats['failures'] += 1
+
+
+def _backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform between 0 and base * 2**attempt (capped)."""
+    return random.uniform(0, min(HTTP_BACKOFF_CAP, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_after(response):
+    """Seconds from a numeric Retry-After header, or None."""
+    value = response.headers.get('Retry-After', '')
+    try:
+        return min(HTTP_BACKOFF_CAP, max(0.0, float(value)))
+    except ValueError:
+        return None
+
+
+def http_get(url, session=None, max_retries=HTTP_MAX_RETRIES, **kwargs):
+    """
+    GET a URL with timeouts and retry/backoff on throttling and server errors.
+
+    Args:
+        url: URL to fetch
+        session: Session to use (default: the shared pooled session)
+        max_retries: Retries allowed after the first attempt
+        kwargs: Passed through to Session.get (a default timeout is added)
+
+    Returns:
+        The final requests.Response, with a `retries` attribute holding the
+        number of retries it took. A 429/5xx is returned (not raised) once
+        retries run out.
+    """
+    session = session or get_session()
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    retries = 0
+    throttled = 0
+    while True:
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if retries >= max_retries:
+                _record(retries, throttled, failed=True)
+                raise
+            delay = _backoff_delay(retries)
+            print(f"Request to {url} failed ({e.__class__.__name__}), retrying in {delay:.1f}s ({retries + 1}/{max_retries})")
+        else:
+            if response.status_code not in RETRY_STATUSES or retries >= max_retries:
+                if retries:
+                    print(f"Request to {url} finished with {response.status_code} after {retries} retries")
+                _record(retries, throttled)
+                response.retries = retries
+                return response
+            if response.status_code == 429:
+                throttled += 1
+            delay = _retry_after(response)
+            if delay is None:
+                delay = _backoff_delay(retries)
+            response.close()
+            print(f"Drive returned {response.status_code} for {url}, retrying in {delay:.1f}s ({retries + 1}/{max_retries})")
+        time.sleep(delay)
+        retries += 1
+
+
+class IncompleteDownload(requests.RequestException):
+    """A body could not be completed, even after resuming; `written` bytes made it to the output."""
+
+    def __init__(self, message, written):
+        super().__init__(message)
+        self.written = written
+
+
+def range_source(response, session=None):
+    """
+    Describe how to resume a streamed response with Range requests.
+
+    Returns:
+        Dict with the final 'url', an If-Range 'validator' (strong ETag or
+        Last-Modified, may be None), the body 'length' (None if unknown),
+        whether the server advertised byte 'ranges', and the 'session' to
+        use; or None when the body is content-encoded (offsets would not
+        match the decoded bytes)
+    """
+    if response.headers.get('Content-Encoding', 'identity').lower() not in ('identity', ''):
+        return None
+    etag = response.headers.get('ETag')
+    validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+    length = response.headers.get('Content-Length', '')
+    return {
+        'url': response.url,
+        'validator': validator,
+        'length': int(length) if length.isdigit() else None,
+        'ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+        'session': session,
+    }
+
+
+def open_range(source, start, end=None):
+    """
+    Request bytes start..end (end exclusive, None for the rest) of a range_source.
+
+    Returns:
+        A streaming 206 response for exactly that range, or None if the
+        server answered with anything else (no range support, or the file
+        changed since the validator was taken)
+    """
+    headers = {'Range': f"bytes={start}-{'' if end is None else end - 1}"}
+    if source.get('validator'):
+        headers['If-Range'] = source['validator']
+    response = http_get(source['url'], session=source.get('session'), stream=True, headers=headers)
+    if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f"bytes {start}-"):
+        response.close()
+        return None
+    return response
+
+
+def copy_body(chunks, out, source=None, written=0, end=None, close=None, max_resumes=HTTP_RESUME_ATTEMPTS):
+    """
+    Write the remaining chunks of a response body to out, resuming if it drops.
+
+    Args:
+        chunks: Iterator over the body (e.g. response.iter_content())
+        out: Writable binary file object
+        source: range_source() of the response, or None to disable resuming
+        written: Offset in the file of the first byte chunks will yield
+        end: Offset to stop at (exclusive); defaults to the body length
+        close: Releases the current response; called before resuming and
+            once the body is done
+        max_resumes: Range requests allowed after drops
+
+    Returns:
+        Offset after the last byte written
+
+    Raises:
+        IncompleteDownload if the body could not be completed
+    """
+    if end is None and source is not None:
+        end = source['length']
+    resumes = 0
+    while True:
+        try:
+            for chunk in chunks:
+                if end is not None and written + len(chunk) > end:
+                    chunk = chunk[:end - written]
+                out.write(chunk)
+                written += len(chunk)
+                if end is not None and written >= end:
+                    break
+            if end is None or written >= end:
+                if close is not None:
+                    close()
+                return written
+            error = f"connection closed after {written} of {end} bytes"
+        except BODY_ERRORS as e:
+            error = f"{e.__class__.__name__}: {e}"
+
+        if close is not None:
+            close()
+        if source is None or resumes >= max_resumes:
+            raise IncompleteDownload(f"Download interrupted ({error})", written)
+        resumes += 1
+        print(f"Download dropped at byte {written} ({error}), resuming with a Range request ({resumes}/{max_resumes})")
+        try:
+            response = open_range(source, written, end)
+        except requests.RequestException as e:
+            raise IncompleteDownload(f"Download interrupted and could not be resumed: {e}", written)
+        if response is None:
+            raise IncompleteDownload(f"Download interrupted ({error}) and the server refused to resume it", written)
+        chunks = response.iter_content(chunk_size=8192)
+        close = response.close
@@ -0,0 +1,143 @@
+"""
+Background jobs with bounded concurrency and time-limited results.
+
+The server's job API (POST /jobs) hands each combine to a JobQueue and
+returns at once; clients poll the job and fetch the result when it is done,
+so no single HTTP request has to outlive a host's request timeout. At most
+`workers` jobs run at the same time and at most `max_queued` more wait for a
+turn; beyond that submit() raises QueueFull. A finished job, and the result
+file it produced, is kept for `ttl` seconds after it finishes.
+
+Settings can be overridden with environment variables:
+    FEB_JOB_WORKERS     jobs that run at the same time (default: 4)
+    FEB_JOB_QUEUE       jobs that may wait for a free worker (default: 32)
+    FEB_JOB_RESULT_TTL  seconds a finished job and its result are kept (default: 900)
+"""
+
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stage_timing import StageTimings
+
+JOB_WORKERS = int(os.environ.get("FEB_JOB_WORKERS", 4))
+JOB_QUEUE = int(os.environ.get("FEB_JOB_QUEUE", 32))
+JOB_RESULT_TTL = float(os.environ.get("FEB_JOB_RESULT_TTL", 900))
+
+
+class QueueFull(Exception):
+    """Every worker is busy and the wait queue is full."""
+
+
+class Job:
+    """One submitted job; see JobQueue.submit()."""
+
+    def __init__(self, meta, on_span=None):
+        self.id = secrets.token_urlsafe(12)
+        self.meta = meta
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.error_status = None
+        self.result = None
+        self.timings = StageTimings(on_span)
+
+    def to_dict(self, ttl=None):
+        """Status as a JSON-ready dict (including stage timings so far)."""
+        status = dict(self.meta, id=self.id, status=self.status, created_at=self.created,
+                      started_at=self.started, finished_at=self.finished, stages=self.timings.summary())
+        if self.error is not None:
+            status['error'] = self.error
+        if self.finished is not None and ttl is not None:
+            status['expires_at'] = self.finished + ttl
+        return status
+
+
+class JobQueue:
+    """Bounded pool of job threads with expiring results; see the module docstring."""
+
+    def __init__(self, workers=JOB_WORKERS, max_queued=JOB_QUEUE, ttl=JOB_RESULT_TTL, on_expire=None, on_span=None):
+        """
+        Args:
+            workers: Jobs that run at the same time
+            max_queued: Jobs that may wait for a free worker
+            ttl: Seconds a finished job is kept
+            on_expire: Optional function called with each expired Job, to
+                release its result (e.g. delete a file)
+            on_span: Optional StageTimings on_span hook for every job's timings
+        """
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.on_span = on_span
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def submit(self, func, *args, meta=None, error_status=None):
+        """
+        Queue func(job, *args) to run on a job thread.
+
+        func's return value becomes job.result. If it raises, the job is
+        'failed' and job.error holds the message; error_status(exception),
+        when given, maps the exception to an HTTP status kept on the job.
+
+        Returns:
+            The new Job (status 'queued')
+
+        Raises:
+            QueueFull if workers + max_queued jobs are already queued or running
+        """
+        self.expire()
+        job = Job(meta or {}, self.on_span)
+        with self._lock:
+            active = sum(1 for j in self._jobs.values() if j.status in ('queued', 'running'))
+            if active >= self.workers + self.max_queued:
+                raise QueueFull(f"{active} jobs are already queued or running")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args, error_status)
+        return job
+
+    def _run(self, job, func, args, error_status):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = func(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.error = str(e)
+            job.error_status = error_status(e) if error_status else None
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        """The job with this ID, or None if it never existed or has expired."""
+        self.expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def counts(self):
+        """Number of jobs per status."""
+        with self._lock:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def expire(self):
+        """Forget jobs that finished more than ttl seconds ago."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished is not None and job.finished < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            if self.on_expire is not None:
+                self.on_expire(job)
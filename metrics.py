@@ -0,0 +1,228 @@
+"""
+Prometheus metrics for the combine servers (GET /metrics).
+
+The text exposition format is simple enough to write by hand, so the servers
+need no extra dependency. Most metrics are fed from StageTimings spans: pass
+observe_span as a StageTimings' on_span and every stage, cache lookup and Drive
+strategy attempt is counted as it ends. The servers add request-level counts
+with request_started() / request_finished() and register collectors for values
+that are read at scrape time (job queue, CPU pool, Drive HTTP counters).
+
+Exported metrics:
+    feb_requests_total{endpoint,outcome}            finished requests
+    feb_request_duration_seconds{endpoint}          histogram of request latency
+    feb_requests_in_flight{endpoint}                requests being handled now
+    feb_stage_duration_seconds{stage}               histogram per pipeline stage (see stage_timing)
+    feb_stage_errors_total{stage}                   stages that raised
+    feb_bytes_in_total{source}                      input bytes by where they came from
+                                                    (drive, resume, cache, revalidated, coalesced, upload)
+    feb_bytes_out_total{endpoint}                   PDF bytes sent to clients
+    feb_cache_lookups_total{cache,result}           download / conversion / result cache hits and misses
+    feb_cache_hit_ratio{cache}                      hits / lookups since the process started
+    feb_drive_strategy_attempts_total{strategy,outcome}  Drive download strategies tried (won, lost, failed)
+
+Counters live in the process, so with several gunicorn workers each one
+reports its own; scrape them separately or run one worker.
+"""
+
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic count, optionally per label combination."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram with _sum and _count."""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(key + (("le", _format_value(float(bound))),))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    """Metrics plus collectors, rendered together in registration order."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        Add a function called at every scrape.
+
+        collect() returns Gauge / Counter objects filled in with current
+        values (built fresh each time, not registered).
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "feb_requests_total", "Finished requests by endpoint and outcome.", ("endpoint", "outcome")))
+request_duration = registry.register(Histogram(
+    "feb_request_duration_seconds", "Request latency, including sending the response.", ("endpoint",)))
+requests_in_flight = registry.register(Gauge(
+    "feb_requests_in_flight", "Requests being handled right now.", ("endpoint",)))
+stage_duration = registry.register(Histogram(
+    "feb_stage_duration_seconds", "Time spent per pipeline stage (one observation per span).", ("stage",)))
+stage_errors = registry.register(Counter(
+    "feb_stage_errors_total", "Pipeline stages that raised.", ("stage",)))
+bytes_in = registry.register(Counter(
+    "feb_bytes_in_total", "Input file bytes by where they came from.", ("source",)))
+bytes_out = registry.register(Counter(
+    "feb_bytes_out_total", "Combined PDF bytes sent to clients.", ("endpoint",)))
+cache_lookups = registry.register(Counter(
+    "feb_cache_lookups_total", "Cache lookups by cache and result (hit, miss, coalesced).", ("cache", "result")))
+strategy_attempts = registry.register(Counter(
+    "feb_drive_strategy_attempts_total", "Drive download strategy attempts by outcome.", ("strategy", "outcome")))
+
+_CACHES = ("download", "conversion", "result")
+
+
+def _cache_hit_ratios():
+    ratios = Gauge("feb_cache_hit_ratio", "Cache hits / lookups since the process started.", ("cache",))
+    for cache in _CACHES:
+        hits = cache_lookups.value(cache=cache, result="hit")
+        total = sum(cache_lookups.value(cache=cache, result=result) for result in ("hit", "miss", "coalesced"))
+        if total:
+            ratios.inc(hits / total, cache=cache)
+    return [ratios]
+
+
+registry.add_collector(_cache_hit_ratios)
+
+
+def observe_span(span):
+    """StageTimings on_span hook: count a finished span."""
+    stage = span['stage']
+    stage_duration.observe(span['seconds'], stage=stage)
+    if span.get('error'):
+        stage_errors.inc(stage=stage)
+
+    if stage == 'download' and not span.get('error'):
+        source = span.get('source', 'drive')
+        if span.get('bytes') is not None:
+            bytes_in.inc(span['bytes'], source=source)
+        result = {'cache': 'hit', 'revalidated': 'hit', 'coalesced': 'coalesced'}.get(source, 'miss')
+        cache_lookups.inc(cache="download", result=result)
+    elif stage == 'upload' and not span.get('error'):
+        bytes_in.inc(span.get('bytes') or 0, source="upload")
+    elif stage == 'convert' and not span.get('error'):
+        cache_lookups.inc(cache="conversion", result="hit" if span.get('cached') else "miss")
+    elif stage == 'result_cache':
+        cache_lookups.inc(cache="result", result="hit" if span.get('hit') else "miss")
+    elif stage == 'strategy':
+        strategy_attempts.inc(strategy=span.get('strategy', ''), outcome=span.get('outcome', ''))
+
+
+def request_started(endpoint):
+    """Count a request as in flight."""
+    requests_in_flight.inc(endpoint=endpoint)
+
+
+def request_finished(endpoint, outcome, seconds, sent_bytes=None):
+    """Count a finished request (call once per request_started)."""
+    requests_in_flight.dec(endpoint=endpoint)
+    requests_total.inc(endpoint=endpoint, outcome=outcome)
+    request_duration.observe(seconds, endpoint=endpoint)
+    if sent_bytes:
+        bytes_out.inc(sent_bytes, endpoint=endpoint)
@@ -0,0 +1,475 @@
+"""
+Post-processing for combined PDFs.
+
+optimize_pdf() rewrites a PDF losslessly: identical objects (the same font,
+logo or ICC profile pulled in by two inputs) are stored once, uncompressed or
+ASCII-encoded streams are Flate-compressed, and, optionally, resources that no
+page uses are dropped.
+
+fit_pdf_to_budget() shrinks a PDF to an output size budget by downscaling and
+recompressing its embedded raster images (phone photos, scanned pages). Pages
+that only hold text and vector graphics are copied untouched.
+
+Budgets and options can be set per call or with environment variables:
+    FEB_MAX_OUTPUT_BYTES          largest combined PDF to produce, in bytes (default: no limit)
+    FEB_MAX_IMAGE_DPI             highest image resolution kept, measured with the image
+                                  fitted to a letter-size page (default: no limit)
+    FEB_OPTIMIZE_OUTPUT           run optimize_pdf on combined PDFs (default: 1)
+    FEB_REMOVE_UNUSED_RESOURCES   also drop unused page resources (default: 0)
+"""
+
+import hashlib
+import io
+import os
+import zlib
+from collections import deque
+
+import PyPDF2
+from PIL import Image
+from PyPDF2.generic import (
+    ArrayObject,
+    ContentStream,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+from pdf_stream import StreamingPdfWriter
+
+MAX_OUTPUT_BYTES = int(os.environ.get("FEB_MAX_OUTPUT_BYTES", 0)) or None
+MAX_IMAGE_DPI = float(os.environ.get("FEB_MAX_IMAGE_DPI", 0)) or None
+OPTIMIZE_OUTPUT = os.environ.get("FEB_OPTIMIZE_OUTPUT", "1") != "0"
+REMOVE_UNUSED_RESOURCES = os.environ.get("FEB_REMOVE_UNUSED_RESOURCES", "0") != "0"
+
+# Document-level entries optimize_pdf carries over besides the pages
+KEPT_CATALOG_KEYS = ('/Outlines', '/AcroForm')
+
+LETTER_INCHES = (8.5, 11.0)
+
+# (extra downscale factor, JPEG quality) tried in order until the budget is met
+BUDGET_STEPS = [(1.0, 85), (0.85, 80), (0.7, 75), (0.55, 70), (0.45, 60), (0.35, 50), (0.25, 40)]
+
+_IMAGE_MODES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+
+
+def letter_dpi(width, height):
+    """Resolution of a width x height pixel image when fitted to a letter page (either orientation)."""
+    short_inches, long_inches = LETTER_INCHES
+    return max(max(width, height) / long_inches, min(width, height) / short_inches)
+
+
+def _filters(stream):
+    filters = stream.get('/Filter')
+    if filters is None:
+        return []
+    if isinstance(filters, list):
+        return [str(f) for f in filters]
+    return [str(filters)]
+
+
+def _recompressible(stream):
+    """True for 8-bit RGB/gray images without masks that Pillow can decode from this stream."""
+    if stream.get('/Subtype') != '/Image' or stream.get('/ImageMask'):
+        return False
+    if '/SMask' in stream or '/Mask' in stream or '/Decode' in stream:
+        return False
+    if stream.get('/BitsPerComponent') != 8 or stream.get('/ColorSpace') not in _IMAGE_MODES:
+        return False
+    return _filters(stream) in ([], ['/FlateDecode'], ['/DCTDecode'])
+
+
+def _decode_image(stream, original_data, target_size):
+    width, height = int(stream['/Width']), int(stream['/Height'])
+    if _filters(stream) == ['/DCTDecode']:
+        image = Image.open(io.BytesIO(original_data))
+        # Decode at reduced scale when the image is going to be shrunk anyway
+        image.draft(None, target_size)
+        return image
+    return Image.frombytes(_IMAGE_MODES[stream['/ColorSpace']], (width, height), stream.get_data())
+
+
+class _ImageSlot:
+    """One recompressible image XObject and the data it started with."""
+
+    def __init__(self, page_number, stream):
+        self.page_number = page_number
+        self.stream = stream
+        self.width = int(stream['/Width'])
+        self.height = int(stream['/Height'])
+        self.filter = stream.get('/Filter')
+        self.color_space = stream['/ColorSpace']
+        self.data = stream._data
+
+    def restore(self):
+        self._set(self.data, self.width, self.height, self.filter, self.color_space)
+
+    def recompress(self, scale, quality):
+        # Start from the original pixels every time so quality loss doesn't compound
+        self.stream._data = self.data
+        self.stream.decoded_self = None
+        size = (max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+        image = _decode_image(self.stream, self.data, size)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=quality, optimize=True)
+        color_space = '/DeviceGray' if image.mode == 'L' else '/DeviceRGB'
+        if len(out.getvalue()) >= len(self.data) and size == (self.width, self.height):
+            # Recompressing at full size didn't help; keep the original bytes
+            self.restore()
+            return
+        self._set(out.getvalue(), size[0], size[1], NameObject('/DCTDecode'), color_space)
+
+    def _set(self, data, width, height, filter_name, color_space):
+        self.stream._data = data
+        self.stream.decoded_self = None
+        self.stream[NameObject('/Width')] = NumberObject(width)
+        self.stream[NameObject('/Height')] = NumberObject(height)
+        self.stream[NameObject('/ColorSpace')] = NameObject(color_space)
+        if filter_name is None:
+            self.stream.pop('/Filter', None)
+        else:
+            self.stream[NameObject('/Filter')] = filter_name
+        self.stream.pop('/DecodeParms', None)
+
+
+def _page_images(page):
+    resources = page.get('/Resources')
+    if resources is None:
+        return []
+    xobjects = resources.get_object().get('/XObject')
+    if xobjects is None:
+        return []
+    xobjects = xobjects.get_object()
+    return [xobjects[name].get_object() for name in xobjects]
+
+
+def page_sizes(writer):
+    """
+    Approximate bytes per page: content streams plus the image XObjects it draws.
+
+    Returns:
+        List of dicts with 'page' (1-based) and 'bytes'
+    """
+    sizes = []
+    for number, page in enumerate(writer.pages, start=1):
+        total = 0
+        contents = page.get('/Contents')
+        if contents is not None:
+            contents = contents.get_object()
+            streams = contents if isinstance(contents, list) else [contents]
+            total += sum(len(stream.get_object()._data or b'') for stream in streams)
+        total += sum(len(image._data or b'') for image in _page_images(page) if image.get('/Subtype') == '/Image')
+        sizes.append({'page': number, 'bytes': total})
+    return sizes
+
+
+def fit_pdf_to_budget(source, output, max_bytes=MAX_OUTPUT_BYTES, max_dpi=MAX_IMAGE_DPI):
+    """
+    Downscale and recompress a PDF's raster images until it fits the budget.
+
+    Images are first capped at max_dpi (measured at letter size), then scaled
+    down and re-encoded at lower JPEG quality step by step until the file is at
+    most max_bytes. Without max_bytes, only images over max_dpi are re-encoded. If the smallest step is still too big, that attempt is kept.
+    Pages without raster images, and images that can't be decoded safely
+    (masks, CMYK, 1-bit scans), are left untouched.
+
+    Args:
+        source: Path or binary file object of the PDF to shrink
+        output: Path or writable binary file object for the result
+        max_bytes: Size budget in bytes, or None for no size limit
+        max_dpi: Image resolution cap, or None for no cap
+
+    Returns:
+        Dict with the final 'bytes', whether the budget was 'met', and
+        'pages' (see page_sizes)
+    """
+    reader = PyPDF2.PdfReader(source)
+    writer = PyPDF2.PdfWriter()
+    for page in reader.pages:
+        writer.add_page(page)
+
+    slots = []
+    seen = set()
+    for number, page in enumerate(writer.pages, start=1):
+        for stream in _page_images(page):
+            # An image shared by several pages is only recompressed once
+            if id(stream) not in seen and _recompressible(stream):
+                seen.add(id(stream))
+                slots.append(_ImageSlot(number, stream))
+
+    steps = BUDGET_STEPS if max_bytes else BUDGET_STEPS[:1]
+    if not slots or (max_dpi is None and max_bytes is None):
+        steps = []
+
+    result = io.BytesIO()
+    writer.write(result)
+    size = len(result.getvalue())
+    if max_dpi is not None and any(letter_dpi(s.width, s.height) > max_dpi for s in slots):
+        # Force at least the DPI cap even if the file is already small enough
+        fits = False
+    else:
+        fits = max_bytes is None or size <= max_bytes
+
+    for extra_scale, quality in steps:
+        if fits:
+            break
+        for slot in slots:
+            over_cap = max_dpi is not None and letter_dpi(slot.width, slot.height) > max_dpi
+            if max_bytes is None and not over_cap:
+                # Only the DPI cap applies, so images under it keep their original bytes
+                continue
+            scale = extra_scale
+            if max_dpi is not None:
+                scale = min(scale, max_dpi / letter_dpi(slot.width, slot.height))
+            slot.recompress(min(scale, 1.0), quality)
+        result = io.BytesIO()
+        writer.write(result)
+        size = len(result.getvalue())
+        fits = max_bytes is None or size <= max_bytes
+        print(f"  Images at {extra_scale:.0%} scale, JPEG quality {quality}: {size} bytes")
+
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'wb') as f:
+            f.write(result.getvalue())
+    else:
+        output.write(result.getvalue())
+
+    pages = page_sizes(writer)
+    for entry in pages:
+        print(f"  Page {entry['page']}: ~{entry['bytes']} bytes")
+    met = max_bytes is None or size <= max_bytes
+    print(f"Final PDF size: {size} bytes" + ("" if met else f" (over the {max_bytes} byte budget)"))
+    return {'bytes': size, 'met': met, 'pages': pages}
+
+
+# Streams smaller than this are not worth a Flate header
+MIN_COMPRESS_BYTES = 64
+# Filters that only re-encode bytes as text; their data is replaced with Flate
+_ASCII_FILTERS = ('/ASCIIHexDecode', '/ASCII85Decode')
+_RESOURCE_CATEGORIES = ('/XObject', '/Font', '/ExtGState', '/Pattern', '/Shading', '/ColorSpace', '/Properties')
+_MAX_DEDUP_PASSES = 10
+
+
+def _key(indirect):
+    return (indirect.idnum, indirect.generation)
+
+
+def _children(obj):
+    """Direct values nested in a dict/array/stream (not following references)."""
+    if isinstance(obj, DictionaryObject):
+        return obj.values()
+    if isinstance(obj, ArrayObject):
+        return obj
+    return ()
+
+
+def _content_names(stream, reader):
+    """Every name used as an operand in a content stream."""
+    names = set()
+    for operands, operator in ContentStream(stream, reader).operations:
+        if operator == b'INLINE IMAGE':
+            operands = list(operands['settings'].values())
+        for operand in operands:
+            if isinstance(operand, NameObject):
+                names.add(str(operand))
+            elif isinstance(operand, ArrayObject):
+                names.update(str(item) for item in operand if isinstance(item, NameObject))
+    return names
+
+
+def _category_identities(resources):
+    """(identity, dict) for each resource category dict; identity is the object key if indirect."""
+    for category in _RESOURCE_CATEGORIES:
+        value = resources.get(category)
+        if value is not None:
+            subdict = value.get_object()
+            yield (_key(value) if isinstance(value, IndirectObject) else id(subdict)), subdict
+
+
+def _remove_unused_resources(reader):
+    """
+    Drop /Resources entries that no page's content stream refers to.
+
+    A resource dictionary shared by several pages keeps the union of what
+    they use. Pages that draw forms or Type 3 fonts without their own
+    resources (which then look names up in the page's) are left alone, as
+    are resource dictionaries that forms share with a page.
+
+    Returns:
+        Number of resource entries removed
+    """
+    used = {}
+    subdicts = {}
+    skipped = set()
+    for page in reader.pages:
+        resources = page.get('/Resources')
+        if resources is None:
+            continue
+        resources = resources.get_object()
+        contents = page.get_contents()
+        names = _content_names(contents, reader) if contents is not None else set()
+
+        safe = True
+        xobjects = resources.get('/XObject')
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+        for name in names & set(xobjects):
+            xobject = xobjects[name].get_object()
+            if xobject.get('/Subtype') != '/Form':
+                continue
+            if '/Resources' not in xobject:
+                safe = False
+            else:
+                skipped.update(identity for identity, _ in _category_identities(xobject['/Resources']))
+        fonts = resources.get('/Font')
+        fonts = fonts.get_object() if fonts is not None else {}
+        for name in names & set(fonts):
+            font = fonts[name].get_object()
+            if font.get('/Subtype') == '/Type3' and '/Resources' not in font:
+                safe = False
+
+        for identity, subdict in _category_identities(resources):
+            subdicts[identity] = subdict
+            used.setdefault(identity, set()).update(names)
+            if not safe:
+                skipped.add(identity)
+
+    removed = 0
+    for identity, subdict in subdicts.items():
+        if identity in skipped:
+            continue
+        for name in list(subdict):
+            if name not in used[identity]:
+                del subdict[name]
+                removed += 1
+    return removed
+
+
+def _template(obj, refs):
+    """Serialize obj with references left as placeholders (appended to refs)."""
+    if isinstance(obj, IndirectObject):
+        refs.append(_key(obj))
+        return b"R"
+    if isinstance(obj, StreamObject):
+        entries = b"".join(NameObject(k).encode() + _template(v, refs) for k, v in sorted(obj.items()) if k != '/Length')
+        return b"<<" + entries + b">>stream" + hashlib.sha256(obj._data).digest()
+    if isinstance(obj, DictionaryObject):
+        return b"<<" + b"".join(NameObject(k).encode() + _template(v, refs) for k, v in sorted(obj.items())) + b">>"
+    if isinstance(obj, ArrayObject):
+        return b"[" + b" ".join(_template(item, refs) for item in obj) + b"]"
+    if obj is None:
+        return b"null"
+    out = io.BytesIO()
+    obj.write_to_stream(out, None)
+    return out.getvalue()
+
+
+def _find_duplicates(reader):
+    """
+    Map every object reachable from the pages to the first identical object.
+
+    Objects are compared by content with references resolved to their own
+    canonical objects, repeated until nothing changes, so e.g. two copies of
+    a font whose descriptors and font files are also duplicates collapse
+    into one. Pages and the page tree are never merged.
+
+    Returns:
+        Dict of (idnum, generation) -> canonical (idnum, generation), only
+        for objects that have a duplicate
+    """
+    templates = {}
+    queue = deque(value for page in reader.pages for key, value in page.items() if key != '/Parent')
+    while queue:
+        value = queue.popleft()
+        if isinstance(value, IndirectObject):
+            key = _key(value)
+            if key in templates:
+                continue
+            obj = value.get_object()
+            if isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Page', '/Pages'):
+                templates[key] = None
+                continue
+            refs = []
+            templates[key] = (hashlib.sha256(_template(obj, refs)).digest(), refs)
+            if isinstance(obj, StreamObject):
+                # Stream data is re-read when the object is written
+                reader.resolved_objects.pop((value.generation, value.idnum), None)
+            queue.extend(_children(obj))
+        else:
+            queue.extend(_children(value))
+
+    canonical = {key: key for key in templates}
+    for _ in range(_MAX_DEDUP_PASSES):
+        first = {}
+        updated = {}
+        for key, template in templates.items():
+            if template is None:
+                updated[key] = key
+                continue
+            digest, refs = template
+            signature = digest + b"".join(b"%d,%d;" % canonical.get(ref, ref) for ref in refs)
+            updated[key] = first.setdefault(signature, key)
+        if updated == canonical:
+            break
+        canonical = updated
+    return {key: target for key, target in canonical.items() if key != target}
+
+
+def _compress_stream(obj):
+    """Flate-compress an unfiltered (or ASCII-filtered) stream when that makes it smaller."""
+    if not isinstance(obj, StreamObject) or obj.get('/Type') == '/Metadata':
+        return obj
+    filters = _filters(obj)
+    if filters and filters[0] not in _ASCII_FILTERS:
+        return obj
+    if filters:
+        if len(filters) > 1 or '/DecodeParms' in obj:
+            return obj
+        data = obj.get_data()
+    else:
+        data = obj._data
+    if len(data) < MIN_COMPRESS_BYTES:
+        return obj
+    compressed = zlib.compress(data, 9)
+    if len(compressed) >= len(obj._data):
+        return obj
+    obj._data = compressed
+    obj.decoded_self = None
+    obj[NameObject('/Filter')] = NameObject('/FlateDecode')
+    return obj
+
+
+def optimize_pdf(source, output, remove_unused=REMOVE_UNUSED_RESOURCES):
+    """
+    Losslessly shrink a PDF: merge duplicate objects and compress streams.
+
+    Pages look the same afterwards, and the document's outlines (bookmarks)
+    and form fields are carried over.
+
+    Args:
+        source: Path or binary file object of the PDF to optimize
+        output: Path or writable binary file object for the result
+        remove_unused: Also drop fonts, images and other resources that the
+            page content never refers to
+
+    Returns:
+        Dict with output 'bytes' and the number of 'deduplicated' objects
+        and 'removed_resources'
+    """
+    reader = PyPDF2.PdfReader(source)
+    if getattr(reader, 'is_encrypted', False):
+        reader.decrypt("")
+    removed = _remove_unused_resources(reader) if remove_unused else 0
+    duplicates = _find_duplicates(reader)
+
+    writer = StreamingPdfWriter(output)
+    writer.add_reader(reader, canonical=duplicates, transform=_compress_stream, catalog_keys=KEPT_CATALOG_KEYS)
+    writer.close()
+
+    print(f"Optimized PDF: {writer.bytes_written} bytes, {len(duplicates)} duplicate objects merged"
+          + (f", {removed} unused resources removed" if remove_unused else ""))
+    return {'bytes': writer.bytes_written, 'deduplicated': len(duplicates), 'removed_resources': removed}
@@ -0,0 +1,198 @@
+"""
+Streaming PDF writer for merging large inputs with bounded memory.
+
+PyPDF2's PdfMerger/PdfWriter keep every copied object until write(), so peak
+memory grows with the total size of all inputs. StreamingPdfWriter instead
+writes each page, and every object it references, to the output as soon as
+the page is added, and forgets them. Only the xref offsets are kept. Once a
+reader's pages are written it can be dropped, so peak memory is roughly one
+input's working set rather than the sum of all of them.
+
+Only pages are carried over unless add_reader is asked for catalog entries:
+optimize_pdf, which rewrites a single already-merged PDF, keeps its outlines
+and form fields that way. When several inputs are merged (the streaming
+merge), their outlines, form fields and named destinations are not copied.
+"""
+
+import io
+import os
+from collections import deque
+
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+)
+
+_CATALOG_NUMBER = 1
+_PAGES_NUMBER = 2
+
+
+class StreamingPdfWriter:
+    """
+    Write pages from one or more PdfReaders straight to an output file.
+
+    Usage:
+        writer = StreamingPdfWriter(output)
+        for reader in readers:
+            writer.add_reader(reader)
+        writer.close()
+    """
+
+    def __init__(self, output):
+        """
+        Args:
+            output: Path or writable binary file object for the merged PDF
+        """
+        self._owns_output = isinstance(output, (str, os.PathLike))
+        self._out = open(output, 'wb') if self._owns_output else output
+        self._offset = 0
+        self._offsets = {}
+        self._next_number = _PAGES_NUMBER + 1
+        self._kids = ArrayObject()
+        self._catalog = DictionaryObject()
+        self.bytes_written = 0
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self._kids)
+
+    def _write(self, data):
+        self._out.write(data)
+        self._offset += len(data)
+
+    def _allocate(self):
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def _write_object(self, number, obj):
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer, None)
+        self._offsets[number] = self._offset
+        self._write(b"%d 0 obj\n" % number + buffer.getvalue() + b"\nendobj\n")
+
+    def add_reader(self, reader, canonical=None, transform=None, catalog_keys=()):
+        """
+        Append all pages of reader, writing them (and everything they use) immediately.
+
+        The reader's cached objects are released as they are written, so the
+        reader holds little beyond its page list afterwards.
+
+        Args:
+            reader: PdfReader (already decrypted if needed)
+            canonical: Optional dict mapping (idnum, generation) of an input
+                object to the key of an identical object to write instead
+            transform: Optional function applied to each copied object before
+                it is written; returns the object to write
+            catalog_keys: Entries of the reader's document catalog (e.g.
+                '/Outlines', '/AcroForm') to copy into the output's catalog,
+                pointing at the copied pages; for a single reader, since a
+                later reader's entries replace an earlier one's
+        """
+        canonical = canonical or {}
+        mapping = {}
+        pending = deque()
+
+        # Pages are numbered up front so links between pages of the same
+        # input point at the copies instead of pulling in the old page tree
+        pages = list(reader.pages)
+        page_numbers = []
+        for page in pages:
+            number = self._allocate()
+            if page.indirect_reference is not None:
+                mapping[(page.indirect_reference.idnum, page.indirect_reference.generation)] = number
+            page_numbers.append(number)
+
+        def reference(indirect):
+            key = (indirect.idnum, indirect.generation)
+            key = canonical.get(key, key)
+            if key not in mapping:
+                indirect = IndirectObject(key[0], key[1], reader)
+                target = indirect.get_object()
+                if isinstance(target, DictionaryObject) and target.get('/Type') == '/Pages':
+                    # References to the input's page tree go to the merged one
+                    return IndirectObject(_PAGES_NUMBER, 0, None)
+                mapping[key] = self._allocate()
+                pending.append(indirect)
+            return IndirectObject(mapping[key], 0, None)
+
+        def write_pending():
+            while pending:
+                indirect = pending.popleft()
+                copy = _copy(indirect.get_object(), reference)
+                if transform is not None:
+                    copy = transform(copy)
+                self._write_object(mapping[(indirect.idnum, indirect.generation)], copy)
+                reader.resolved_objects.pop((indirect.generation, indirect.idnum), None)
+
+        for page, number in zip(pages, page_numbers):
+            copy = _copy(page, reference, skip=('/Parent',))
+            copy[NameObject('/Parent')] = IndirectObject(_PAGES_NUMBER, 0, None)
+            self._write_object(number, copy)
+            self._kids.append(IndirectObject(number, 0, None))
+            write_pending()
+
+        # After the pages, so outline destinations and form widgets resolve
+        # to the page copies already written
+        root = reader.trailer['/Root']
+        for key in catalog_keys:
+            if key in root:
+                self._catalog[NameObject(key)] = _copy(root.raw_get(key), reference)
+                write_pending()
+
+    def close(self):
+        """Write the page tree, catalog, xref table and trailer."""
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): self._kids,
+            NameObject('/Count'): NumberObject(len(self._kids)),
+        })
+        catalog = DictionaryObject(self._catalog)
+        catalog[NameObject('/Type')] = NameObject('/Catalog')
+        catalog[NameObject('/Pages')] = IndirectObject(_PAGES_NUMBER, 0, None)
+        self._write_object(_PAGES_NUMBER, pages)
+        self._write_object(_CATALOG_NUMBER, catalog)
+
+        xref_offset = self._offset
+        size = self._next_number
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for number in range(1, size):
+            lines.append(b"%010d 00000 n \n" % self._offsets[number])
+        self._write(b"".join(lines))
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                    % (size, _CATALOG_NUMBER, xref_offset))
+        self.bytes_written = self._offset
+        if self._owns_output:
+            self._out.close()
+
+
+def _copy(obj, reference, skip=()):
+    """Copy a direct object, replacing indirect references through reference()."""
+    if isinstance(obj, IndirectObject):
+        return reference(obj)
+    if isinstance(obj, StreamObject):
+        copy = EncodedStreamObject() if '/Filter' in obj else DecodedStreamObject()
+        copy._data = obj._data
+        # /Length is rewritten from the data when the stream is written
+        skip = tuple(skip) + ('/Length',)
+    elif isinstance(obj, DictionaryObject):
+        copy = DictionaryObject()
+    elif isinstance(obj, ArrayObject):
+        return ArrayObject(_copy(item, reference) for item in obj)
+    elif obj is None:
+        # Dangling reference in the input
+        return NullObject()
+    else:
+        return obj
+    for key, value in obj.items():
+        if key not in skip:
+            copy[NameObject(key)] = _copy(value, reference)
+    return copy
@@ -0,0 +1,129 @@
+"""
+Low-priority background warming of the download and conversion caches.
+
+The extension knows every Drive link of a reimbursement row as soon as the row
+is pasted, long before it asks for each item's combine. POST /prefetch hands
+those links to a Prefetcher, which downloads (and converts) them in the
+background, so the later combines find their files cached and only merge.
+
+Prefetching must not slow down real combines. It runs on `workers` threads,
+one file at a time each, and before every file it waits while busy() reports
+load (combines running at capacity or waiting for admission). Links already
+waiting or being fetched are not queued again. At most `max_pending` links
+wait; more are dropped, since a prefetch is only a hint.
+
+Settings can be overridden with environment variables:
+    FEB_PREFETCH_WORKERS  files prefetched at the same time, 0 disables prefetching (default: 2)
+    FEB_PREFETCH_QUEUE    links that may wait to be prefetched (default: 200)
+"""
+
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+PREFETCH_WORKERS = int(os.environ.get("FEB_PREFETCH_WORKERS", 2))
+PREFETCH_QUEUE = int(os.environ.get("FEB_PREFETCH_QUEUE", 200))
+
+# Seconds between checks of busy() while prefetching is held back
+_BUSY_POLL_SECONDS = 0.25
+
+
+class Prefetcher:
+    """Deduplicated, bounded queue of background fetches; see the module docstring."""
+
+    def __init__(self, fetch, workers=PREFETCH_WORKERS, max_pending=PREFETCH_QUEUE, busy=None):
+        """
+        Args:
+            fetch: Function called with each queued item on a worker thread;
+                what it raises is logged and counted, not propagated
+            workers: Items fetched at the same time (0 disables the prefetcher)
+            max_pending: Items that may wait for a worker
+            busy: Optional function returning True while foreground work
+                should have the machine to itself
+        """
+        self.fetch = fetch
+        self.workers = workers
+        self.max_pending = max_pending
+        self.busy = busy
+        self._pending = deque()
+        self._keys = set()
+        self._running = 0
+        self._counts = {'done': 0, 'failed': 0, 'dropped': 0}
+        self._threads = []
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def submit(self, items):
+        """
+        Queue items for prefetching.
+
+        Args:
+            items: Iterable of (key, item) pairs; an item whose key is already
+                waiting or being fetched is skipped
+
+        Returns:
+            Dict with how many items were 'queued', 'skipped' (duplicates)
+            and 'dropped' (queue full)
+        """
+        result = {'queued': 0, 'skipped': 0, 'dropped': 0}
+        with self._cond:
+            for key, item in items:
+                if key in self._keys:
+                    result['skipped'] += 1
+                elif len(self._pending) >= self.max_pending:
+                    result['dropped'] += 1
+                else:
+                    self._keys.add(key)
+                    self._pending.append((key, item))
+                    result['queued'] += 1
+            self._counts['dropped'] += result['dropped']
+            if result['queued']:
+                self._start_workers()
+                self._cond.notify(result['queued'])
+        return result
+
+    def _start_workers(self):
+        """Start the worker threads on first use; call with the lock held."""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"prefetch-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _wait_until_idle(self):
+        while self.busy is not None and self.busy():
+            time.sleep(_BUSY_POLL_SECONDS)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            self._wait_until_idle()
+            with self._cond:
+                if not self._pending:
+                    continue
+                key, item = self._pending.popleft()
+                self._running += 1
+            outcome = 'done'
+            try:
+                self.fetch(item)
+            except Exception as e:
+                outcome = 'failed'
+                print(f"Prefetch of {key} failed: {e}")
+                if not isinstance(e, (ValueError, OSError)):
+                    traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._keys.discard(key)
+                    self._counts[outcome] += 1
+
+    def stats(self):
+        """Items waiting and being fetched, plus how many were done, failed or dropped so far."""
+        with self._cond:
+            return dict(self._counts, pending=len(self._pending), running=self._running)
@@ -0,0 +1,37 @@
+"""
+Run the combine server locally, from the repo root:
+    python -m server          Flask app (app.py)
+    python -m server asgi     ASGI app (asgi_app.py), with uvicorn
+
+Start it this way rather than as python server/app.py: CPU pool workers are
+spawned processes that re-import a script run by path as their own main
+module, which would build every cache, queue and background thread of the
+server again in each worker. A package's __main__ is never re-imported.
+
+In production use gunicorn or uvicorn instead (see DEPLOY.md).
+"""
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def main(argv):
+    port = int(os.environ.get("PORT", 8765))
+    if argv[1:] == ["asgi"]:
+        import uvicorn
+        from asgi_app import app
+
+        uvicorn.run(app, host="0.0.0.0", port=port)
+    elif argv[1:]:
+        sys.exit("usage: python -m server [asgi]")
+    else:
+        from app import app
+
+        app.run(host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,14 +1,21 @@
 """
 Flask server for the FEB Auto Reimbursor extension.
-POST /combine with JSON: { "link1": "...", "link2": "...", "filename": "..." }
-Downloads both files from Google Drive, combines (PDFs + images, decrypts encrypted PDFs), returns PDF.
+POST /combine with JSON: { "links": ["...", "...", ...], "filename": "..." }
+(or the older { "link1": "...", "link2": "...", "filename": "..." }),
+or with multipart/form-data or a raw PDF / image body to send files directly
+(see UploadParser).
+Downloads the files from Google Drive, combines them in order (PDFs + images, decrypts encrypted PDFs), returns PDF.
 
 Deploy to Render (or any free Python host) so the Chrome extension can call it.
 """
 
+import atexit
 import os
+import shutil
 import sys
 import tempfile
+import threading
+import time
 import traceback
 from pathlib import Path
 
@@ -16,66 +23,421 @@ from pathlib import Path
 REPO_ROOT = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(REPO_ROOT))
 
-from flask import Flask, request, send_file, jsonify
-from combine_drive_files import process_file, combine_pdfs
+if __name__ == "__main__":
+    # Run as a script, CPU pool workers would re-import this file as their main
+    # module and set up the whole server again; python -m server avoids that
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")]))
+    os.execv(sys.executable, [sys.executable, "-m", "server"])
+
+from flask import Flask, Response, request, send_file, jsonify
+from werkzeug.exceptions import ClientDisconnected
+from combine_drive_files import combine_links, SpooledBuffer, copy_buffer
+from cpu_pool import JobTimeout
+from stage_timing import StageTimings, timed
+from job_queue import JobQueue, QueueFull
+from single_flight import SingleFlight
+from admission import Overloaded
+import metrics
+# Caches, CPU pool, admission control, prefetcher and request parsing, shared with asgi_app.py
+import combine_service as service
+from combine_service import (LOG_TIMINGS, UPLOAD_CHUNK_BYTES, UploadParser, UploadTooLarge, cached_result,
+                             close_uploads, combine_key, convert_in_pool, error_status, is_upload,
+                             merge_in_pool, overloaded_body, parse_combine_request, prefetch_links, upload_bytes)
 
 app = Flask(__name__)
 
 
+def read_upload(stream, content_type, query, timings=None):
+    """
+    Read a /combine body carrying files from a file-like stream, as an 'upload' span.
+
+    Returns:
+        Tuple of (inputs, filename, max_bytes, max_dpi), as parse_combine_request
+
+    Raises:
+        UploadTooLarge or ValueError with a message for the client; the
+        files received so far are closed
+    """
+    parser = UploadParser(content_type, query)
+    try:
+        with timed(timings, "upload") as span:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                span.bytes = parser.size
+            data = parser.finish()
+        return parse_combine_request(data)
+    except BaseException:
+        parser.discard()
+        raise
+
+
+def run_combine(links, output, max_bytes, max_dpi, timings):
+    """Combine links into output with the server's caches and CPU pool."""
+    return combine_links(links, output, cache=service.download_cache, max_bytes=max_bytes, max_dpi=max_dpi,
+                         convert=convert_in_pool, merge=merge_in_pool, conversions=service.conversion_cache,
+                         timings=timings)
+
+
+# Combines in progress, so identical requests arriving together (a double-click,
+# or the popup and the content script both asking) share one pipeline
+combine_flight = SingleFlight()
+# Keys of the flights started by background jobs, whose admission wait is unbounded
+_background_flights = set()
+
+
+def _combine_to_buffer(key, links, max_bytes, max_dpi, timings, background=False):
+    if background:
+        _background_flights.add(key)
+    try:
+        with timed(timings, "admission"):
+            slot = service.admission.acquire(bounded=not background)
+    finally:
+        _background_flights.discard(key)
+    with slot:
+        timings.add_listener(slot.observe_span)
+        slot.add_bytes(upload_bytes(links))
+        output = SpooledBuffer()
+        try:
+            run_combine(links, output, max_bytes, max_dpi, timings)
+            entry = None
+            if key is not None and service.result_cache is not None:
+                output.seek(0)
+                entry = service.result_cache.store(key, output)
+            output.seek(0)
+        except BaseException:
+            output.close()
+            raise
+    return output, entry
+
+
+def _copy_combined(result):
+    output, entry = result
+    return copy_buffer(output), entry
+
+
+def combine_once(key, links, max_bytes, max_dpi, timings, background=False):
+    """
+    Combine links into a new SpooledBuffer and store it in the result cache.
+
+    The pipeline first waits for room under the admission limits (an
+    'admission' span). A request identical (same key) to one already running
+    waits for it and gets a copy of its PDF, recording a 'coalesced' span
+    instead of the pipeline stages. A foreground request that would join a
+    job's flight still waiting for admission first waits its own bounded turn,
+    so it gets Overloaded rather than the job's unbounded wait.
+
+    Args:
+        background: True for jobs, which wait for admission as long as it
+            takes instead of being turned away
+
+    Returns:
+        Tuple of (PDF file object at the start, result cache entry or None)
+
+    Raises:
+        Overloaded when the admission queue is full or the wait timed out
+    """
+    if key is None:
+        return _combine_to_buffer(key, links, max_bytes, max_dpi, timings, background)
+    if not background and key in _background_flights:
+        with timed(timings, "admission"):
+            service.admission.wait_turn()
+    start = time.perf_counter()
+    result, shared = combine_flight.do(key, _combine_to_buffer, key, links, max_bytes, max_dpi, timings,
+                                       background, share=_copy_combined)
+    if shared:
+        timings.record("coalesced", time.perf_counter() - start)
+    return result
+
+
+def not_modified(entry):
+    """Empty 304 for a client that already has this exact result (If-None-Match)."""
+    response = Response(status=304)
+    response.set_etag(entry["sha256"])
+    return response
+
+
 @app.after_request
 def cors(response):
     response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, If-None-Match"
+    response.headers["Access-Control-Expose-Headers"] = ("Server-Timing, Location, Retry-After, ETag, "
+                                                         "X-Combines-Running, X-Combines-Queued")
+    load = service.admission.stats()
+    response.headers["X-Combines-Running"] = str(load["running"])
+    response.headers["X-Combines-Queued"] = str(load["queued"])
     return response
 
 
 @app.route("/combine", methods=["OPTIONS"])
+@app.route("/jobs", methods=["OPTIONS"])
 def combine_options():
     return "", 204
 
 
 @app.route("/combine", methods=["POST"])
 def combine():
-    data = request.get_json(silent=True) or {}
-    link1 = (data.get("link1") or data.get("link_1") or "").strip()
-    link2 = (data.get("link2") or data.get("link_2") or "").strip()
-    filename = (data.get("filename") or "combined.pdf").strip()
-    if not filename.endswith(".pdf"):
-        filename += ".pdf"
-
-    if not link1 or not link2:
-        return jsonify({"error": "Need link1 and link2"}), 400
+    started = time.perf_counter()
+    metrics.request_started("combine")
+    timings = StageTimings(on_span=metrics.observe_span)
+    try:
+        if is_upload(request.content_type):
+            # Read from the raw stream so uploads are parsed once, as they arrive
+            links, filename, max_bytes, max_dpi = read_upload(request.stream, request.content_type,
+                                                              request.args.items(multi=True), timings)
+        else:
+            links, filename, max_bytes, max_dpi = parse_combine_request(request.get_json(silent=True) or {})
+    except ValueError as e:
+        outcome = "too_large" if isinstance(e, UploadTooLarge) else "bad_request"
+        metrics.request_finished("combine", outcome, time.perf_counter() - started)
+        return jsonify({"error": str(e)}), 413 if outcome == "too_large" else 400
+    except ClientDisconnected:
+        # The body ended before its Content-Length (the client went away)
+        metrics.request_finished("combine", "disconnected", time.perf_counter() - started)
+        return jsonify({"error": "The request body was cut short"}), 400
+    except BaseException:
+        metrics.request_finished("combine", "error", time.perf_counter() - started)
+        raise
 
-    temp_dir = tempfile.mkdtemp(prefix="feb_combine_")
+    # Downloads, uploads, conversions and the merged output are held in memory
+    # unless they grow past SPOOL_THRESHOLD, but cache misses are still written
+    # to disk: downloads to the download cache, converted images to the
+    # conversion cache and the merged PDF to the result cache.
+    outcome = "ok"
+    sending = False
     try:
-        pdf1 = process_file(link1, temp_dir)
-        pdf2 = process_file(link2, temp_dir)
-        output_path = os.path.join(temp_dir, filename)
-        combine_pdfs([pdf1, pdf2], output_path)
-        return send_file(
-            output_path,
+        key = combine_key(links, max_bytes, max_dpi)
+        entry = cached_result(key, timings)
+        # None when evicted since the lookup: combine as on a miss
+        output = service.result_cache.open_entry(entry) if entry is not None else None
+        if output is not None:
+            outcome = "cached"
+        else:
+            output, entry = combine_once(key, links, max_bytes, max_dpi, timings)
+
+        # POST responses aren't made conditional by Flask, so check the ETag here
+        if entry is not None and request.if_none_match.contains_weak(entry["sha256"]):
+            output.close()
+            outcome = "not_modified"
+            return not_modified(entry)
+        size = output.seek(0, os.SEEK_END)
+        output.seek(0)
+        response = send_file(
+            output,
             mimetype="application/pdf",
             as_attachment=True,
             download_name=filename,
+            etag=entry["sha256"] if entry is not None else False,
         )
+        response.headers["Server-Timing"] = timings.server_timing()
+
+        # The WSGI server closes the response once the body is sent (or the
+        # client went away); a direct-passthrough body would skip the close hook
+        response.direct_passthrough = False
+        send_started = time.perf_counter()
+
+        def sent():
+            timings.record("send", time.perf_counter() - send_started, bytes=size)
+            _finish_combine(timings, links, outcome, started, size)
+
+        response.call_on_close(sent)
+        sending = True
+        return response
+    except Overloaded as e:
+        outcome = "overloaded"
+        print(f"Combine turned away: {e}")
+        response = jsonify(overloaded_body(e))
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 429
+    except JobTimeout as e:
+        outcome = "timeout"
+        print(f"Combine timed out: {e}")
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
+        outcome = "error"
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
     finally:
+        close_uploads(links)
+        if not sending:
+            _finish_combine(timings, links, outcome, started)
+
+
+def _finish_combine(timings, links, outcome, started, sent_bytes=None):
+    """Log a /combine's timings and count it in the metrics."""
+    if LOG_TIMINGS:
+        print(timings.to_json(event="combine", links=len(links), outcome=outcome))
+    metrics.request_finished("combine", outcome, time.perf_counter() - started, sent_bytes)
+
+
+# Seconds a client is asked to wait when the job queue is full
+JOB_RETRY_AFTER = 10
+
+# Where job results are written (see job_result_dir)
+_job_result_dir = None
+_job_result_dir_lock = threading.Lock()
+
+
+def job_result_dir():
+    """
+    Directory for the results of jobs (FEB_JOB_WORKERS, FEB_JOB_QUEUE,
+    FEB_JOB_RESULT_TTL). Created by the first job, so processes that never
+    run one leave nothing behind; each result is deleted when its job
+    expires, and the directory with whatever is left when the process exits.
+    """
+    global _job_result_dir
+    with _job_result_dir_lock:
+        if _job_result_dir is None:
+            _job_result_dir = tempfile.mkdtemp(prefix="feb_job_results_")
+            atexit.register(shutil.rmtree, _job_result_dir, ignore_errors=True)
+        return _job_result_dir
+
+
+def _delete_job_result(job):
+    if job.result:
         try:
-            for f in Path(temp_dir).iterdir():
-                f.unlink()
-            os.rmdir(temp_dir)
-        except Exception:
+            os.remove(job.result)
+        except OSError:
             pass
 
 
-@app.route("/")
-def index():
-    return "FEB PDF combiner. POST JSON to /combine with link1, link2, filename."
+job_queue = JobQueue(on_expire=_delete_job_result, on_span=metrics.observe_span)
 
 
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8765))
-    app.run(host="0.0.0.0", port=port)
+def _combine_job(job, links, max_bytes, max_dpi):
+    """Job body: combine into a result file and return its path."""
+    result_dir = job_result_dir()
+    path = os.path.join(result_dir, f"{job.id}.pdf")
+    outcome = "ok"
+    started = time.perf_counter()
+    metrics.request_started("job")
+    try:
+        key = combine_key(links, max_bytes, max_dpi)
+        entry = cached_result(key, job.timings)
+        # None when evicted since the lookup: combine as on a miss
+        cached_path = None
+        if entry is not None:
+            cached_path = service.result_cache.materialize(entry, result_dir, prefix=f"{job.id}_", suffix=".pdf")
+        if cached_path is not None:
+            outcome = "cached"
+            path = cached_path
+        else:
+            output, entry = combine_once(key, links, max_bytes, max_dpi, job.timings, background=True)
+            with output, open(path, "wb") as f:
+                shutil.copyfileobj(output, f)
+        if entry is not None:
+            job.meta["etag"] = entry["sha256"]
+    except Exception as e:
+        outcome = "timeout" if isinstance(e, JobTimeout) else "error"
+        if outcome == "error":
+            traceback.print_exc()
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        if LOG_TIMINGS:
+            print(job.timings.to_json(event="job", job=job.id, links=len(links), outcome=outcome))
+        metrics.request_finished("job", outcome, time.perf_counter() - started)
+    return path
+
+
+def _job_status(job):
+    status = job.to_dict(ttl=job_queue.ttl)
+    status["status_url"] = f"/jobs/{job.id}"
+    if job.status == "done":
+        status["result_url"] = f"/jobs/{job.id}/result"
+    return status
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Start a combine in the background; same JSON body as /combine."""
+    data = request.get_json(silent=True) or {}
+    try:
+        links, filename, max_bytes, max_dpi = parse_combine_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        job = job_queue.submit(_combine_job, links, max_bytes, max_dpi,
+                               meta={"filename": filename, "links": len(links)}, error_status=error_status)
+    except QueueFull as e:
+        print(f"Job queue full: {e}")
+        response = jsonify({"error": "The server is busy, try again shortly"})
+        response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+        return response, 503
+    response = jsonify(_job_status(job))
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return response, 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "No such job (it may have expired)"}), 404
+    return jsonify(_job_status(job))
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "No such job (it may have expired)"}), 404
+    if job.status == "failed":
+        return jsonify(_job_status(job)), job.error_status or 500
+    if job.status != "done":
+        return jsonify(dict(_job_status(job), error="The job has not finished yet")), 409
+    # GET is conditional, so If-None-Match with the job's etag gets a 304
+    response = send_file(job.result, mimetype="application/pdf", as_attachment=True,
+                         download_name=job.meta["filename"], etag=job.meta.get("etag", True))
+    response.headers["Server-Timing"] = job.timings.server_timing()
+    if response.status_code == 200:
+        metrics.bytes_out.inc(os.path.getsize(job.result), endpoint="job")
+    return response
+
+
+@app.route("/prefetch", methods=["OPTIONS"])
+def prefetch_options():
+    return "", 204
+
+
+@app.route("/prefetch", methods=["POST"])
+def prefetch():
+    """Warm the caches with links whose combines come later; answers 202 at once."""
+    if not service.prefetcher.enabled:
+        return jsonify({"error": "Prefetching is disabled on this server"}), 404
+    try:
+        counts = prefetch_links(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(counts), 202
+
+
+def _job_metrics():
+    """Values read at scrape time: the job queue (see combine_service._server_metrics for the rest)."""
+    jobs = metrics.Gauge("feb_jobs", "Jobs in the job queue by status.", ("status",))
+    for status, count in job_queue.counts().items():
+        jobs.inc(count, status=status)
+    return [jobs]
+
+
+metrics.registry.add_collector(_job_metrics)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return metrics.registry.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+@app.route("/")
+def index():
+    return ("FEB PDF combiner. POST JSON to /combine with links (a list) or link1, link2, and filename "
+            "(or multipart/form-data with link fields and files), or POST the JSON to /jobs and poll /jobs/<id>. "
+            "POST links to /prefetch ahead of time to warm the caches.")
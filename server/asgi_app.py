@@ -0,0 +1,359 @@
+"""
+ASGI version of the combine server, with the same /combine contract as app.py.
+
+Drive downloads run on the event loop over non-blocking HTTP (combine_async),
+while image conversion and merging run in the CPU worker pool, handed over on
+threads, so one process can wait on hundreds of slow Drive downloads at once
+instead of tying up a worker per request. Request parsing, the caches and the
+CPU pool live in combine_service, shared with app.py.
+
+The merged PDF is streamed back in chunks once the merge has finished: the
+optimization pass, the size budget, the ETag and Content-Length all need the
+whole document, so nothing is sent while it is being merged.
+
+Run with:
+    uvicorn server.asgi_app:app --host 0.0.0.0 --port $PORT
+"""
+
+import asyncio
+import contextlib
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+from urllib.parse import quote
+
+# Run from repo root so we can import combine_drive_files (and combine_service next to us)
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+if __name__ == "__main__":
+    # Run as a script, CPU pool workers would re-import this file as their main
+    # module and set up the whole server again; python -m server avoids that
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")]))
+    os.execv(sys.executable, [sys.executable, "-m", "server", "asgi"])
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import combine_async
+from combine_drive_files import SpooledBuffer, copy_buffer
+from cpu_pool import JobTimeout
+from single_flight import AsyncSingleFlight
+import metrics
+from stage_timing import StageTimings, timed
+from admission import Overloaded
+# Caches, CPU pool, admission control, prefetcher and request parsing, shared with app.py
+import combine_service as service
+from combine_service import (
+    LOG_TIMINGS,
+    UploadParser,
+    UploadTooLarge,
+    cached_result,
+    close_uploads,
+    combine_key,
+    convert_in_pool,
+    error_status,
+    etag_header,
+    is_upload,
+    merge_in_pool,
+    overloaded_body,
+    parse_combine_request,
+    prefetch_links,
+    upload_bytes,
+)
+
+# Size of each piece of the streamed PDF
+RESPONSE_CHUNK_BYTES = 64 * 1024
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, If-None-Match",
+    "Access-Control-Expose-Headers": "Server-Timing, ETag, Retry-After, X-Combines-Running, X-Combines-Queued",
+}
+
+
+def content_disposition(filename):
+    """Content-Disposition for a download, with an RFC 5987 name for non-ASCII filenames."""
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(filename)}"
+    escaped = filename.replace("\\", "\\\\").replace('"', '\\"')
+    return f'attachment; filename="{escaped}"'
+
+
+def if_none_match(request, entry):
+    """Whether the request's If-None-Match already names this cached result."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag_header(entry) in tags
+
+
+def _finish(timings, links, outcome, started, sent_bytes=None):
+    """Log a /combine's timings and count it in the metrics."""
+    if LOG_TIMINGS:
+        print(timings.to_json(event="combine", server="asgi", links=links, outcome=outcome))
+    metrics.request_finished("combine", outcome, time.perf_counter() - started, sent_bytes)
+
+
+async def _stream_output(output, timings, links, started, outcome="ok"):
+    """Send the merged PDF in chunks, then log the request's timings."""
+    sent = 0
+    try:
+        with timed(timings, "send") as span:
+            while True:
+                chunk = output.read(RESPONSE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+                sent += len(chunk)
+                span.bytes = sent
+    except BaseException:
+        outcome = "disconnected"
+        raise
+    finally:
+        output.close()
+        _finish(timings, links, outcome, started, sent)
+
+
+async def read_upload(request, timings):
+    """app.read_upload for Starlette: feed the body to an UploadParser as it arrives."""
+    parser = UploadParser(request.headers.get("content-type"), request.query_params.multi_items())
+    try:
+        with timed(timings, "upload") as span:
+            async for chunk in request.stream():
+                if chunk:
+                    parser.feed(chunk)
+                    span.bytes = parser.size
+            data = parser.finish()
+        return parse_combine_request(data)
+    except BaseException:
+        parser.discard()
+        raise
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return parse_combine_request(data)
+
+
+async def combine(request):
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+
+    started = time.perf_counter()
+    metrics.request_started("combine")
+    timings = StageTimings(on_span=metrics.observe_span)
+    try:
+        if is_upload(request.headers.get("content-type")):
+            links, filename, max_bytes, max_dpi = await read_upload(request, timings)
+        else:
+            links, filename, max_bytes, max_dpi = await read_json(request)
+    except ValueError as e:
+        outcome = "too_large" if isinstance(e, UploadTooLarge) else "bad_request"
+        metrics.request_finished("combine", outcome, time.perf_counter() - started)
+        return JSONResponse({"error": str(e)}, status_code=413 if outcome == "too_large" else 400)
+    except ClientDisconnect:
+        metrics.request_finished("combine", "disconnected", time.perf_counter() - started)
+        return JSONResponse({"error": "The request body was cut short"}, status_code=400)
+    except BaseException:
+        metrics.request_finished("combine", "error", time.perf_counter() - started)
+        raise
+
+    outcome = "ok"
+    streaming = False
+    try:
+        key = combine_key(links, max_bytes, max_dpi)
+        entry = await asyncio.to_thread(cached_result, key, timings)
+        # None when evicted since the lookup: combine as on a miss
+        output = service.result_cache.open_entry(entry) if entry is not None else None
+        if output is not None:
+            outcome = "cached"
+            close_uploads(links)
+        else:
+            output, entry = await combine_once(key, links, max_bytes, max_dpi, timings)
+
+        if entry is not None and if_none_match(request, entry):
+            output.close()
+            outcome = "not_modified"
+            return Response(status_code=304, headers={"ETag": etag_header(entry)})
+
+        size = output.seek(0, os.SEEK_END)
+        output.seek(0)
+        headers = {
+            "Content-Disposition": content_disposition(filename),
+            "Content-Length": str(size),
+            "Server-Timing": timings.server_timing(),
+        }
+        if entry is not None:
+            headers["ETag"] = etag_header(entry)
+        response = StreamingResponse(_stream_output(output, timings, len(links), started, outcome),
+                                     media_type="application/pdf", headers=headers)
+        # From here on _stream_output logs and counts the request
+        streaming = True
+        return response
+    except Overloaded as e:
+        outcome = "overloaded"
+        print(f"Combine turned away: {e}")
+        return JSONResponse(overloaded_body(e), status_code=429, headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        if isinstance(e, JobTimeout):
+            outcome = "timeout"
+            print(f"Combine timed out: {e}")
+        else:
+            outcome = "error"
+            traceback.print_exc()
+        return JSONResponse({"error": str(e)}, status_code=error_status(e))
+    except BaseException:
+        # Cancelled while waiting for the combine: the client went away
+        outcome = "disconnected"
+        raise
+    finally:
+        if not streaming:
+            _finish(timings, len(links), outcome, started)
+
+
+# Combines in progress, shared by identical requests arriving together
+combine_flight = AsyncSingleFlight()
+
+
+async def _combine_to_buffer(key, links, max_bytes, max_dpi, timings):
+    """Download and convert links on the event loop, merge them in the CPU pool and cache the result."""
+    with timed(timings, "admission"):
+        slot = await service.admission.acquire_async()
+    with slot:
+        timings.add_listener(slot.observe_span)
+        slot.add_bytes(upload_bytes(links))
+        output = SpooledBuffer()
+        try:
+            pdf_files = await combine_async.process_files(links, cache=service.download_cache,
+                                                          convert=convert_in_pool,
+                                                          conversions=service.conversion_cache, timings=timings)
+            try:
+                await asyncio.to_thread(merge_in_pool, pdf_files, output, max_bytes, max_dpi, timings)
+            finally:
+                for pdf_file in pdf_files:
+                    pdf_file.close()
+            entry = None
+            if key is not None and service.result_cache is not None:
+                output.seek(0)
+                entry = await asyncio.to_thread(service.result_cache.store, key, output)
+            output.seek(0)
+        except BaseException:
+            output.close()
+            raise
+    return output, entry
+
+
+def _copy_combined(result):
+    output, entry = result
+    return copy_buffer(output), entry
+
+
+async def combine_once(key, links, max_bytes, max_dpi, timings):
+    """
+    Async counterpart of app.combine_once: identical concurrent requests share one pipeline.
+
+    Uploaded files among links are closed when it returns or raises.
+    """
+    start = time.perf_counter()
+    try:
+        if key is None:
+            result, shared = await _combine_to_buffer(key, links, max_bytes, max_dpi, timings), False
+        else:
+            result, shared = await combine_flight.do(key, _combine_to_buffer, key, links, max_bytes, max_dpi,
+                                                     timings, share=_copy_combined)
+    except asyncio.CancelledError:
+        # The pipeline keeps running for coalesced requests and may still be
+        # reading the uploads; it closes the ones it merges itself
+        raise
+    except BaseException:
+        close_uploads(links)
+        raise
+    close_uploads(links)
+    if shared:
+        timings.record("coalesced", time.perf_counter() - start)
+    return result
+
+
+async def prefetch(request):
+    """
+    Same contract as app.py's /prefetch. The prefetcher (combine_service) is
+    shared with app.py and fetches on its own threads, off the event loop.
+    """
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+    if not service.prefetcher.enabled:
+        return JSONResponse({"error": "Prefetching is disabled on this server"}, status_code=404)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    try:
+        counts = prefetch_links(data if isinstance(data, dict) else {})
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(counts, status_code=202)
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.registry.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def index(request):
+    return PlainTextResponse("FEB PDF combiner. POST JSON to /combine with links (a list) or link1, link2, and filename "
+                             "(or multipart/form-data with link fields and files).")
+
+
+class CorsMiddleware:
+    """Add the same CORS headers as app.py to every response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.update(CORS_HEADERS)
+                load = service.admission.stats()
+                headers["X-Combines-Running"] = str(load["running"])
+                headers["X-Combines-Queued"] = str(load["queued"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await combine_async.close_client()
+    service.cpu_pool.shutdown()
+
+
+app = CorsMiddleware(Starlette(
+    routes=[
+        Route("/combine", combine, methods=["POST", "OPTIONS"]),
+        Route("/prefetch", prefetch, methods=["POST", "OPTIONS"]),
+        Route("/metrics", prometheus_metrics),
+        Route("/", index),
+    ],
+    lifespan=lifespan,
+))
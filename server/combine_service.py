@@ -0,0 +1,490 @@
+"""
+State and request handling shared by the combine servers (app.py for WSGI,
+asgi_app.py for ASGI): the caches, the CPU pool, admission control and the
+prefetcher, and the parsing of /combine, /jobs and /prefetch bodies.
+
+Both servers import this module instead of each other, so running either one
+builds this state once per process. Nothing here depends on the web framework.
+"""
+
+import hashlib
+import math
+import os
+import sys
+from pathlib import Path
+
+# Run from repo root so we can import combine_drive_files
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from combine_drive_files import (SpooledBuffer, UploadedFile, convert_google_drive_link, from_job_output,
+                                 image_to_pdf_job, merge_pdfs_job, process_file, result_key, sniff_file_type,
+                                 to_job_source)
+from pdf_optimize import MAX_OUTPUT_BYTES, MAX_IMAGE_DPI
+from drive_cache import ConversionCache, DownloadCache, ResultCache, RESULT_CACHE_MAX_BYTES
+from cpu_pool import CpuPool, JobTimeout
+from stage_timing import StageTimings, timed
+from admission import AdmissionController
+from prefetch import Prefetcher
+from drive_http import get_http_stats
+import metrics
+
+# Shared across requests (and workers, via FEB_CACHE_DIR) so retried combines skip Drive
+download_cache = DownloadCache()
+# Converted images, so the same receipt is only converted once (FEB_CONVERSION_CACHE_*)
+conversion_cache = ConversionCache()
+# Whole combined PDFs (FEB_RESULT_CACHE_*), so repeating a /combine skips Drive and the merge
+result_cache = ResultCache() if RESULT_CACHE_MAX_BYTES > 0 else None
+
+# Most links (and uploaded files) accepted in one /combine request
+MAX_COMBINE_LINKS = int(os.environ.get("FEB_MAX_COMBINE_LINKS", 20))
+# Largest /combine request body carrying uploaded files
+MAX_UPLOAD_BYTES = int(os.environ.get("FEB_MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+# Size of each piece read from an upload body
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# Content types of a /combine body that is itself the file to combine
+RAW_UPLOAD_TYPES = ("application/pdf", "image/png", "image/jpeg", "application/octet-stream")
+
+# Image conversion and PDF merging run in worker processes (FEB_CPU_WORKERS,
+# FEB_CPU_JOB_TIMEOUT) so they don't hold the GIL while other requests are
+# downloading; downloads stay on threads.
+cpu_pool = CpuPool()
+
+# Log one JSON line per /combine with its per-stage timing spans
+LOG_TIMINGS = os.environ.get("FEB_LOG_TIMINGS", "1") != "0"
+
+
+def convert_in_pool(image, output):
+    """image_to_pdf replacement that runs the conversion in cpu_pool."""
+    pdf, report = cpu_pool.run(image_to_pdf_job, to_job_source(image))
+    from_job_output(pdf, output)
+    return report
+
+
+def merge_in_pool(pdf_files, output, max_bytes=None, max_dpi=None, timings=None):
+    """merge_pdfs replacement that runs the merge and budget pass in cpu_pool."""
+    # A file listed twice is sent (and parsed) once
+    sources = {}
+    job_sources = []
+    for pdf_file in pdf_files:
+        if id(pdf_file) not in sources:
+            sources[id(pdf_file)] = to_job_source(pdf_file)
+        job_sources.append(sources[id(pdf_file)])
+    merged, report, spans = cpu_pool.run(merge_pdfs_job, job_sources, max_bytes, max_dpi)
+    if timings is not None:
+        timings.extend(spans)
+    from_job_output(merged, output)
+    return report
+
+
+def links_from_request(data):
+    """
+    Read the ordered list of Drive links from a /combine JSON body.
+
+    Returns:
+        Tuple of (list of links, error message or None)
+    """
+    if "links" in data:
+        links = data.get("links")
+        # Uploaded files only come from UploadParser, never from JSON
+        if not isinstance(links, list) or not all(isinstance(link, (str, UploadedFile)) for link in links):
+            return [], "links must be a list of Google Drive links"
+        links = [link if isinstance(link, UploadedFile) else link.strip()
+                 for link in links if isinstance(link, UploadedFile) or link.strip()]
+        if not links:
+            return [], "Need at least one link"
+        if len(links) > MAX_COMBINE_LINKS:
+            return [], f"At most {MAX_COMBINE_LINKS} files can be combined at once"
+    else:
+        link1 = (data.get("link1") or data.get("link_1") or "").strip()
+        link2 = (data.get("link2") or data.get("link_2") or "").strip()
+        if not link1 or not link2:
+            return [], "Need link1 and link2 (or a links list)"
+        links = [link1, link2]
+
+    # Checked here so a bad link is a 400 before the combine takes a slot
+    for link in links:
+        if isinstance(link, str) and not drive_file_id(link):
+            return [], f"Not a Google Drive file link: {link}"
+    return links, None
+
+
+def drive_file_id(link):
+    """The Drive file ID of a link, or None if it isn't a Google Drive file link."""
+    try:
+        file_id, _ = convert_google_drive_link(link)
+    except ValueError:
+        return None
+    return file_id or None
+
+
+def budget_from_request(data):
+    """
+    Read the optional max_bytes / max_dpi output budget from a /combine JSON body,
+    falling back to the server-wide FEB_MAX_OUTPUT_BYTES / FEB_MAX_IMAGE_DPI.
+
+    Raises:
+        ValueError unless each given value is a positive, finite number
+    """
+    max_bytes, max_dpi = MAX_OUTPUT_BYTES, MAX_IMAGE_DPI
+    try:
+        if data.get("max_bytes") not in (None, ""):
+            max_bytes = int(data["max_bytes"])
+            if max_bytes <= 0:
+                raise ValueError(max_bytes)
+        # A zero, negative or infinite DPI would scale images to nothing instead of failing
+        if data.get("max_dpi") not in (None, ""):
+            max_dpi = float(data["max_dpi"])
+            if not 0 < max_dpi < math.inf:
+                raise ValueError(max_dpi)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("max_bytes and max_dpi must be positive numbers")
+    return max_bytes, max_dpi
+
+
+def parse_combine_request(data):
+    """
+    Read a /combine (or /jobs) JSON body.
+
+    Returns:
+        Tuple of (links, filename ending in .pdf, max_bytes, max_dpi)
+
+    Raises:
+        ValueError with a message for the client
+    """
+    links, error = links_from_request(data)
+    if error:
+        raise ValueError(error)
+    filename = (data.get("filename") or "combined.pdf").strip()
+    if not filename.endswith(".pdf"):
+        filename += ".pdf"
+    max_bytes, max_dpi = budget_from_request(data)
+    return links, filename, max_bytes, max_dpi
+
+
+class UploadTooLarge(ValueError):
+    """The request body is bigger than MAX_UPLOAD_BYTES (answered with 413)."""
+
+
+def is_upload(content_type):
+    """Whether a /combine body with this Content-Type carries files rather than JSON."""
+    mimetype, _ = parse_options_header(content_type or "")
+    return mimetype == "multipart/form-data" or mimetype in RAW_UPLOAD_TYPES
+
+
+class _UploadWriter:
+    """One uploaded file, spooled and hashed as it arrives."""
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self.buffer = SpooledBuffer()
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        """The finished UploadedFile; raises ValueError (and closes it) unless it is a PDF, PNG or JPEG."""
+        self.buffer.seek(0)
+        if sniff_file_type(self.buffer.read(4)) is None:
+            self.buffer.close()
+            raise ValueError(f"{self.name} is not a PDF, PNG or JPEG file")
+        self.buffer.seek(0)
+        return UploadedFile(self.buffer, self.digest.hexdigest(), self.size, self.name)
+
+
+# Stands for the request body among the link query parameters of a raw upload
+_BODY = "-"
+
+
+class UploadParser:
+    """
+    Incremental parser for a /combine body that carries files.
+
+    The body is fed in as it arrives, and each file is written once, straight
+    into its own SpooledBuffer (hashed on the way for the result cache), so
+    the request is never buffered whole before the combine starts. Two forms
+    are accepted:
+
+        multipart/form-data  'link' fields (Drive links) and file parts, combined
+                             in the order they appear, plus optional 'filename',
+                             'max_bytes' and 'max_dpi' fields as in the JSON body
+        PDF, PNG or JPEG     the body is one file; links and options go in the
+                             query string, where link=- marks the file's place
+                             among the links (first by default)
+
+    Usage:
+        parser = UploadParser(content_type, query)
+        for chunk in body: parser.feed(chunk)
+        data = parser.finish()  # a dict for parse_combine_request
+    """
+
+    def __init__(self, content_type, query):
+        """
+        Args:
+            content_type: The request's Content-Type header
+            query: The query-string parameters as (name, value) pairs
+
+        Raises:
+            ValueError if a multipart body has no boundary
+        """
+        mimetype, options = parse_options_header(content_type or "")
+        self.size = 0
+        self.items = []
+        self.fields = {}
+        self._part = None
+        self._value = []
+        if mimetype == "multipart/form-data":
+            if not options.get("boundary"):
+                raise ValueError("multipart/form-data body without a boundary")
+            self._decoder = MultipartDecoder(options["boundary"].encode(), max_parts=MAX_COMBINE_LINKS + 8)
+            self._body = None
+            return
+        self._decoder = None
+        for name, value in query:
+            if name == "link":
+                if value.strip():
+                    self.items.append(value.strip())
+            elif name in ("filename", "max_bytes", "max_dpi"):
+                self.fields[name] = value
+        if _BODY not in self.items:
+            self.items.insert(0, _BODY)
+        self._body = _UploadWriter(self.fields.get("filename") or "upload")
+
+    def feed(self, data):
+        """
+        Parse the next piece of the body.
+
+        Raises:
+            UploadTooLarge past MAX_UPLOAD_BYTES, ValueError on a malformed body
+        """
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge(f"Uploads are limited to {MAX_UPLOAD_BYTES // (1024 * 1024)} MB per request")
+        if self._decoder is None:
+            self._body.write(data)
+            return
+        self._decoder.receive_data(data)
+        self._next_events()
+
+    def _next_events(self):
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except RequestEntityTooLarge:
+                raise UploadTooLarge(f"At most {MAX_COMBINE_LINKS} files can be combined at once")
+            if isinstance(event, (NeedData, Epilogue)):
+                return
+            if isinstance(event, File):
+                self._part = _UploadWriter(event.filename or event.name)
+            elif isinstance(event, Field):
+                self._part = event.name
+                self._value = []
+            elif isinstance(event, Data):
+                if isinstance(self._part, _UploadWriter):
+                    self._part.write(event.data)
+                else:
+                    self._value.append(event.data)
+                if not event.more_data:
+                    self._end_part()
+
+    def _end_part(self):
+        part, self._part = self._part, None
+        if isinstance(part, _UploadWriter):
+            # An empty file input in a browser form still sends a part
+            if part.size:
+                self.items.append(part.finish())
+            else:
+                part.buffer.close()
+            return
+        value = b"".join(self._value).decode("utf-8", "replace").strip()
+        if part == "link":
+            if value:
+                self.items.append(value)
+        elif part in ("filename", "max_bytes", "max_dpi"):
+            self.fields[part] = value
+
+    def finish(self):
+        """
+        End of the body.
+
+        Returns:
+            A dict in the shape of the JSON body ('links' holds the Drive
+            links and UploadedFile inputs in order), for parse_combine_request
+
+        Raises:
+            ValueError if the body was empty or cut short
+        """
+        if self._decoder is None:
+            if not self._body.size:
+                raise ValueError("Empty request body")
+            upload = self._body.finish()
+            self._body = None
+            self.items = [upload if item == _BODY else item for item in self.items]
+        else:
+            self._decoder.receive_data(None)
+            self._next_events()
+            if self._part is not None:
+                raise ValueError("The multipart body ended in the middle of a part")
+        return dict(self.fields, links=self.items)
+
+    def discard(self):
+        """Close every file received so far (on errors)."""
+        close_uploads(self.items)
+        for writer in (self._body, self._part):
+            if isinstance(writer, _UploadWriter):
+                writer.buffer.close()
+
+
+def close_uploads(links):
+    """Close the UploadedFile inputs among links (the pipeline closes the ones it merged itself)."""
+    for link in links:
+        if isinstance(link, UploadedFile):
+            link.close()
+
+
+def combine_key(links, max_bytes, max_dpi):
+    """
+    Identity of a combine's output (see result_key), used by the result cache
+    and to coalesce identical requests; None when a link has no Drive file ID.
+    """
+    try:
+        return result_key(links, max_bytes, max_dpi)
+    except ValueError:
+        return None
+
+
+def cached_result(key, timings=None):
+    """
+    Look up a combine in the result cache.
+
+    Returns:
+        The entry dict, or None on a miss (or when key is None or the result
+        cache is disabled)
+    """
+    if result_cache is None or key is None:
+        return None
+    with timed(timings, "result_cache") as span:
+        entry = result_cache.lookup(key)
+        span.labels["hit"] = entry is not None
+        if entry is not None:
+            result_cache.touch(key)
+    return entry
+
+
+# Limits on running combines and the input bytes they hold (FEB_ADMISSION_*);
+# beyond them, and a short wait queue, /combine answers 429 with Retry-After
+admission = AdmissionController()
+
+
+def upload_bytes(links):
+    """Total size of the uploaded files among links, charged to the admission slot up front."""
+    return sum(link.size for link in links if isinstance(link, UploadedFile))
+
+
+def etag_header(entry):
+    """Strong ETag for a cached result: the combined PDF's SHA-256, quoted."""
+    return f'"{entry["sha256"]}"'
+
+
+def overloaded_body(error):
+    """JSON body of the 429 for a combine turned away by admission control, with the current load."""
+    load = admission.stats()
+    return {"error": "The server is busy, try again shortly", "retry_after": error.retry_after,
+            "running": load["running"], "queued": load["queued"]}
+
+
+def error_status(error):
+    """HTTP status for a failed combine: 503 when a CPU job timed out, else 500."""
+    return 503 if isinstance(error, JobTimeout) else 500
+
+
+def prefetch_file(link):
+    """Prefetcher body: download (and convert) one file into the caches, keeping nothing else."""
+    timings = StageTimings(on_span=metrics.observe_span)
+    outcome = "ok"
+    try:
+        pdf_file = process_file(link, None, download_cache, convert_in_pool, conversion_cache, timings)
+        pdf_file.close()
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        if LOG_TIMINGS:
+            print(timings.to_json(event="prefetch", outcome=outcome))
+
+
+def combines_busy():
+    """Whether combines are running at capacity or waiting, so prefetching should hold back."""
+    load = admission.stats()
+    return load["queued"] > 0 or load["running"] >= admission.max_pipelines
+
+
+# Links sent ahead of their combines (FEB_PREFETCH_WORKERS, FEB_PREFETCH_QUEUE),
+# warmed into the download and conversion caches only while combines leave room
+prefetcher = Prefetcher(prefetch_file, busy=combines_busy)
+
+
+def prefetch_links(data):
+    """
+    Queue the links of a /prefetch JSON body ({"links": [...]}) on the prefetcher.
+
+    Returns:
+        Dict with the counts from Prefetcher.submit, plus 'invalid' for links
+        without a Drive file ID
+
+    Raises:
+        ValueError with a message for the client
+    """
+    links = data.get("links")
+    if not isinstance(links, list) or not all(isinstance(link, str) for link in links):
+        raise ValueError("links must be a list of Google Drive links")
+    items = []
+    invalid = 0
+    for link in links:
+        file_id = drive_file_id(link.strip())
+        if file_id is None:
+            invalid += 1
+            continue
+        items.append((file_id, link.strip()))
+    return dict(prefetcher.submit(items), invalid=invalid)
+
+
+def _server_metrics():
+    """Values read at scrape time: CPU pool, Drive HTTP counters, admission load and prefetching."""
+    busy = metrics.Gauge("feb_cpu_workers_busy", "CPU pool workers running a conversion or merge.")
+    busy.inc(cpu_pool.busy_workers())
+    drive = metrics.Counter("feb_drive_http_total", "Drive HTTP requests, retries, throttled (429) responses "
+                                                    "and failures since the process started.", ("kind",))
+    for kind, count in get_http_stats().items():
+        drive.inc(count, kind=kind)
+    load = admission.stats()
+    pipelines = metrics.Gauge("feb_admission_pipelines", "Combine pipelines running or waiting for admission.",
+                              ("state",))
+    pipelines.inc(load["running"], state="running")
+    pipelines.inc(load["queued"], state="queued")
+    held = metrics.Gauge("feb_admission_bytes_in_flight", "Input bytes held by running pipelines.")
+    held.inc(load["bytes_in_flight"])
+    rejected = metrics.Counter("feb_admission_rejected_total", "Combines turned away with 429.")
+    rejected.inc(load["rejected"])
+    prefetch_load = prefetcher.stats()
+    prefetching = metrics.Gauge("feb_prefetch_files", "Prefetched files waiting or being fetched.", ("state",))
+    prefetching.inc(prefetch_load["pending"], state="pending")
+    prefetching.inc(prefetch_load["running"], state="running")
+    prefetched = metrics.Counter("feb_prefetch_total", "Prefetched files by outcome (done, failed, dropped).",
+                                 ("outcome",))
+    for outcome in ("done", "failed", "dropped"):
+        prefetched.inc(prefetch_load[outcome], outcome=outcome)
+    return [busy, drive, pipelines, held, rejected, prefetching, prefetched]
+
+
+metrics.registry.add_collector(_server_metrics)
+
+
+metrics.registry.add_collector(_server_metrics)
@@ -0,0 +1,143 @@
+"""
+Coalescing of identical concurrent work ("single flight").
+
+When a call for a key is already running, later callers with the same key
+don't start their own; they wait for the running call and all receive its
+result (or its exception). Once the call finishes the key is forgotten, so
+nothing is cached: a caller that arrives afterwards starts a new call.
+
+Results that callers consume or close (file objects) can't be handed to
+several callers at once. Pass share=, a function that makes a private copy of
+a result; the first caller keeps the original and every other caller gets a
+copy, made as soon as the call finishes and before anyone touches the result.
+
+SingleFlight is for threads (server/app.py), AsyncSingleFlight for coroutines
+on one event loop (combine_async, server/asgi_app.py).
+
+Usage:
+    downloads = SingleFlight()
+    source, shared = downloads.do(file_id, download, file_id, share=copy_file)
+"""
+
+import asyncio
+import threading
+
+
+class _Call:
+    """One running call and the callers waiting for it."""
+
+    def __init__(self):
+        self.callers = 1
+        self.results = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """Per-key coalescing of concurrent calls made from several threads."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, share=None):
+        """
+        Call func(*args), or wait for the call already running for key.
+
+        Args:
+            key: Hashable identity of the work (e.g. a Drive file ID)
+            func: Function to run when no call for key is in flight
+            share: Optional function returning a private copy of func's
+                result for each additional caller
+
+        Returns:
+            Tuple of (result, shared: True if this caller joined a call
+            started by another one)
+
+        Raises:
+            Whatever func raised, in every caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if shared:
+                call.callers += 1
+            else:
+                call = self._calls[key] = _Call()
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            with self._lock:
+                return call.results.pop(), True
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.error = e
+            call.done.set()
+            raise
+        with self._lock:
+            del self._calls[key]
+        try:
+            call.results = [share(result) if share else result for _ in range(call.callers - 1)]
+        except Exception as e:
+            call.error = e
+        finally:
+            call.done.set()
+        return result, False
+
+    def in_flight(self):
+        """Number of keys with a call running."""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    Per-key coalescing of concurrent coroutines on one event loop.
+
+    The call runs as its own task, so it keeps going for the other callers
+    when the caller that started it is cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func, *args, share=None):
+        """
+        Await func(*args), or wait for the call already running for key.
+
+        Same arguments and return value as SingleFlight.do(); func is a
+        coroutine function.
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            call.callers += 1
+        else:
+            call = self._calls[key] = _Call()
+            call.task = asyncio.ensure_future(self._run(key, call, func, args, share))
+        try:
+            await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done():
+                call.callers -= 1
+            raise
+        return call.results.pop(), shared
+
+    async def _run(self, key, call, func, args, share):
+        try:
+            result = await func(*args)
+        finally:
+            del self._calls[key]
+        # No await from here on: every caller still waiting gets its copy
+        # before any of them can touch the result
+        copies = [share(result) if share else result for _ in range(call.callers - 1)]
+        call.results = copies + [result]
+
+    def in_flight(self):
+        """Number of keys with a call running."""
+        return len(self._calls)
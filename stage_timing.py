@@ -0,0 +1,172 @@
+"""
+Per-stage timings for the combine pipeline.
+
+A StageTimings object is passed down through combine_links (and the functions
+it calls) and collects one span per pipeline stage and file:
+
+    download   one file, from cache lookup to the last byte (source: cache,
+               revalidated, drive, resume, or coalesced when it waited for
+               the same file being downloaded for another combine)
+    strategy   one Drive download strategy attempt (outcome: won, lost, failed)
+    sniff      reading the first bytes of the winning response to detect the file type
+    transfer   copying the rest of the body
+    convert    image to PDF (cached: True when served from the conversion cache)
+    decrypt    opening an encrypted PDF with the empty password
+    merge      reading and appending all inputs
+    optimize   the lossless optimization pass
+    budget     fitting the output to the size budget
+    write      writing the combined PDF
+
+The server adds 'upload' (receiving files sent in the request body),
+'result_cache' (looking up the whole combined PDF; hit: True or False),
+'coalesced' (waiting for an identical combine already running), 'admission'
+(waiting for room under the admission limits) and 'send' (sending the
+response, after the Server-Timing header has gone out).
+
+Each span is a dict with 'stage', wall-clock 'start' (epoch seconds),
+'seconds', 'bytes' (None when not applicable), 'error' (exception class name
+or None) and any labels such as 'file_id'. Spans are plain dicts so they can
+be logged as JSON, pickled back from worker processes, or aggregated with
+summarize().
+
+Usage:
+    timings = StageTimings()
+    combine_links(links, output, timings=timings)
+    print(timings.to_json())
+"""
+
+import json
+import threading
+import time
+
+
+class Span:
+    """A stage being timed; set .bytes and add .labels before it ends."""
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.bytes = None
+
+
+class StageTimings:
+    """Thread-safe collection of spans for one combine."""
+
+    def __init__(self, on_span=None):
+        """
+        Args:
+            on_span: Optional function called with each span dict as soon as
+                it ends (e.g. to log it or feed a metrics aggregator)
+        """
+        self._listeners = [on_span] if on_span is not None else []
+        self.created = time.time()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, on_span):
+        """Also call on_span with every span that ends from now on."""
+        with self._lock:
+            self._listeners.append(on_span)
+
+    def record(self, stage, seconds, bytes=None, error=None, start=None, **labels):
+        """Add a span measured elsewhere."""
+        span = dict(labels, stage=stage, start=time.time() - seconds if start is None else start,
+                    seconds=seconds, bytes=bytes, error=error)
+        with self._lock:
+            self._spans.append(span)
+            listeners = list(self._listeners)
+        for on_span in listeners:
+            on_span(span)
+        return span
+
+    def extend(self, spans):
+        """Add spans collected by another StageTimings (e.g. in a worker process)."""
+        for span in spans:
+            span = dict(span)
+            self.record(span.pop('stage'), span.pop('seconds'), **span)
+
+    @property
+    def spans(self):
+        """Copy of the spans recorded so far, in the order they ended."""
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self):
+        """Spans aggregated per stage, see summarize()."""
+        return summarize(self.spans)
+
+    def to_json(self, **extra):
+        """One JSON object with the spans and their per-stage summary."""
+        spans = self.spans
+        return json.dumps(dict(extra, seconds=round(time.time() - self.created, 6),
+                               stages=summarize(spans), spans=spans), default=str)
+
+    def server_timing(self):
+        """
+        Per-stage totals as an HTTP Server-Timing header value.
+
+        Stages that ran in parallel (downloads, conversions) are summed, so
+        they can add up to more than the request itself.
+        """
+        return ", ".join(f"{stage};dur={totals['seconds'] * 1000:.1f}"
+                         for stage, totals in self.summary().items())
+
+    def format_table(self):
+        """Per-stage totals as lines of text for console output."""
+        lines = [f"{'stage':10} {'count':>5} {'seconds':>9} {'bytes':>12}"]
+        for stage, totals in self.summary().items():
+            size = str(totals['bytes']) if totals['bytes'] is not None else "-"
+            lines.append(f"{stage:10} {totals['count']:>5} {totals['seconds']:>9.3f} {size:>12}")
+        return "\n".join(lines)
+
+
+def summarize(spans):
+    """
+    Aggregate spans per stage.
+
+    Returns:
+        Dict of stage -> {'count', 'seconds' (total), 'max_seconds', 'bytes'
+        (total, or None if no span of that stage had a byte count), 'errors'},
+        in the order each stage first ended
+    """
+    totals = {}
+    for span in spans:
+        stage = totals.setdefault(span['stage'], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                  'bytes': None, 'errors': 0})
+        stage['count'] += 1
+        stage['seconds'] += span['seconds']
+        stage['max_seconds'] = max(stage['max_seconds'], span['seconds'])
+        if span.get('bytes') is not None:
+            stage['bytes'] = (stage['bytes'] or 0) + span['bytes']
+        if span.get('error'):
+            stage['errors'] += 1
+    return totals
+
+
+class timed:
+    """
+    Context manager timing one stage into timings (a no-op when timings is None).
+
+    Yields a Span whose .bytes and .labels end up in the recorded span. An
+    exception leaving the block is recorded as the span's 'error' and re-raised.
+
+    Usage:
+        with timed(timings, 'convert', file_id=file_id) as span:
+            span.bytes = convert(source, output)
+    """
+
+    def __init__(self, timings, stage, **labels):
+        self.timings = timings
+        self.span = Span(stage, labels)
+
+    def __enter__(self):
+        self._start_wall = time.time()
+        self._start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.timings is not None:
+            self.timings.record(self.span.stage, time.perf_counter() - self._start, bytes=self.span.bytes,
+                                error=exc_type.__name__ if exc_type else None, start=self._start_wall,
+                                **self.span.labels)
+        return False
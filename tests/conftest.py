@@ -0,0 +1,54 @@
+"""
+Shared setup for the test suite: caches go to a throwaway directory and the
+server modules (server/app.py, server/asgi_app.py) are importable. The
+drive_stub fixture serves files the way Google Drive does.
+
+Run from the repo root with:
+    python -m pytest -q
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+_CACHE_ROOT = tempfile.mkdtemp(prefix="feb_tests_")
+os.environ.setdefault("FEB_CACHE_DIR", os.path.join(_CACHE_ROOT, "downloads"))
+os.environ.setdefault("FEB_CONVERSION_CACHE_DIR", os.path.join(_CACHE_ROOT, "conversions"))
+os.environ.setdefault("FEB_RESULT_CACHE_DIR", os.path.join(_CACHE_ROOT, "results"))
+os.environ.setdefault("FEB_LOG_TIMINGS", "0")
+
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(REPO_ROOT / "server"))
+
+
+@pytest.fixture
+def drive_stub(monkeypatch):
+    """
+    Start a benchmarks.drive_stub.DriveStub and point the Drive downloaders at it.
+
+    Usage:
+        stub = drive_stub({"direct-pdf": ("direct", "pdf", data)})
+    """
+    import combine_async
+    import combine_drive_files
+    from benchmarks.drive_stub import DriveStub
+
+    stubs = []
+
+    def start(files):
+        stub = DriveStub(files).start()
+        stubs.append(stub)
+        for module in (combine_drive_files, combine_async):
+            monkeypatch.setattr(module, "DRIVE_BASE_URL", stub.base_url)
+        # gdown only talks to the real Drive
+        monkeypatch.setattr(combine_drive_files, "DRIVE_STRATEGIES", ("direct", "confirm", "scrape"))
+        return stub
+
+    yield start
+    for stub in stubs:
+        stub.stop()
@@ -0,0 +1,54 @@
+"""Admission control and how foreground combines coalesce onto background jobs."""
+
+import threading
+import time
+
+import pytest
+
+import app
+import combine_service
+from admission import AdmissionController, Overloaded
+from stage_timing import StageTimings
+
+
+def test_wait_turn_is_bounded_and_leaves_no_slot():
+    controller = AdmissionController(max_pipelines=1, max_queued=4, max_wait=0.2)
+    slot = controller.acquire()
+    with pytest.raises(Overloaded):
+        controller.wait_turn()
+    slot.release()
+    controller.wait_turn()
+    assert controller.stats()["running"] == 0
+
+
+def test_foreground_joining_queued_job_gets_overloaded(monkeypatch):
+    controller = AdmissionController(max_pipelines=1, max_queued=4, max_wait=0.2)
+    monkeypatch.setattr(combine_service, "admission", controller)
+    ran = threading.Event()
+
+    def fake_run_combine(links, output, max_bytes, max_dpi, timings):
+        ran.set()
+        output.write(b"%PDF-1.4\n")
+
+    monkeypatch.setattr(app, "run_combine", fake_run_combine)
+    monkeypatch.setattr(combine_service, "result_cache", None)
+    key = "test-key"
+    links = ["https://drive.google.com/file/d/abc/view"]
+
+    # Every pipeline slot is taken, so the job waits for admission without bound
+    blocker = controller.acquire()
+    job = threading.Thread(target=app.combine_once, args=(key, links, None, None, StageTimings()),
+                           kwargs={"background": True})
+    job.start()
+    while key not in app._background_flights:
+        time.sleep(0.01)
+
+    started = time.perf_counter()
+    with pytest.raises(Overloaded):
+        app.combine_once(key, links, None, None, StageTimings())
+    assert time.perf_counter() - started < 2
+
+    blocker.release()
+    job.join(timeout=5)
+    assert ran.is_set()
+    assert controller.stats() == {"running": 0, "queued": 0, "bytes_in_flight": 0, "rejected": 1}
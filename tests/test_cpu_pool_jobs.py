@@ -0,0 +1,97 @@
+"""Pool jobs exchange spilled files by path: SpooledBuffer, to_job_source, from_job_output."""
+
+import io
+import os
+
+import PyPDF2
+import pytest
+
+import combine_drive_files
+import combine_service
+from benchmarks.drive_stub import make_statement_pdf
+from combine_drive_files import (SpooledBuffer, from_job_output, image_to_pdf_job, merge_pdfs_job, to_job_source)
+from cpu_pool import CpuPool
+
+PDF = make_statement_pdf(2)
+
+
+def spooled(data, max_size):
+    buffer = SpooledBuffer(max_size=max_size)
+    buffer.write(data)
+    return buffer
+
+
+def page_count(data):
+    return len(PyPDF2.PdfReader(io.BytesIO(data)).pages)
+
+
+def test_spilled_buffer_has_a_path_that_goes_with_it():
+    buffer = spooled(b"x" * 100, max_size=10)
+    path = buffer.path
+    assert path and os.path.isfile(path)
+    buffer.seek(0)
+    assert buffer.read() == b"x" * 100
+    buffer.close()
+    assert not os.path.exists(path)
+
+    kept = spooled(b"y" * 100, max_size=10)
+    path = kept.keep()
+    try:
+        with open(path, "rb") as f:
+            assert f.read() == b"y" * 100
+    finally:
+        os.remove(path)
+    assert spooled(b"small", max_size=10).keep() is None
+
+
+def test_only_files_still_in_memory_are_sent_as_bytes():
+    small = spooled(PDF, max_size=len(PDF) + 1)
+    large = spooled(PDF, max_size=10)
+    with small, large:
+        assert to_job_source(small) == PDF
+        assert to_job_source(large) == large.path
+
+
+def test_job_output_on_disk_is_adopted_not_copied(monkeypatch):
+    monkeypatch.setattr(combine_drive_files, "SPOOL_THRESHOLD", 10)
+    merged, report, _ = merge_pdfs_job([PDF, PDF])
+    assert isinstance(merged, str) and os.path.isfile(merged)
+
+    output = SpooledBuffer()
+    from_job_output(merged, output)
+    with output:
+        assert output.path == merged
+        output.seek(0)
+        assert page_count(output.read()) == 4
+    assert not os.path.exists(merged)
+
+
+def test_worker_process_reads_inputs_by_path():
+    pool = CpuPool(workers=1)
+    source = spooled(PDF, max_size=10)
+    try:
+        merged, report, spans = pool.run(merge_pdfs_job, [to_job_source(source)] * 2)
+    finally:
+        pool.shutdown()
+        source.close()
+    output = io.BytesIO()
+    from_job_output(merged, output)
+    assert page_count(output.getvalue()) == 4
+    assert spans
+
+
+def test_failed_job_leaves_no_spilled_output(monkeypatch, tmp_path):
+    monkeypatch.setattr(combine_drive_files, "SPOOL_THRESHOLD", 10)
+    monkeypatch.setattr(combine_drive_files.tempfile, "tempdir", str(tmp_path))
+    with pytest.raises(Exception):
+        image_to_pdf_job(b"not an image")
+    assert not list(tmp_path.iterdir())
+
+
+def test_merge_in_pool_takes_the_inputs_as_an_iterator(monkeypatch):
+    monkeypatch.setattr(combine_service, "cpu_pool", CpuPool(workers=0))
+    pdf_file = spooled(PDF, max_size=len(PDF) + 1)
+    output = io.BytesIO()
+    # combine_links passes a generator, which can only be read once
+    combine_service.merge_in_pool((f for f in [pdf_file, pdf_file]), output)
+    assert page_count(output.getvalue()) == 4
@@ -0,0 +1,52 @@
+"""Cache entries evicted between lookup and use are misses, not errors."""
+
+import io
+import os
+
+from PIL import Image
+
+import combine_drive_files
+from drive_cache import ConversionCache, DownloadCache, ResultCache
+
+
+def evicted_entry(cache, key, data=b"%PDF-1.4 cached\n"):
+    """Store data under key, look it up, then remove its object as a concurrent eviction would."""
+    cache.store(key, io.BytesIO(data), file_type="pdf")
+    entry = cache.lookup(key)
+    os.remove(entry["path"])
+    return entry
+
+
+def test_materialize_and_open_evicted_entry_are_misses(tmp_path):
+    for cache in (DownloadCache(tmp_path / "d"), ConversionCache(tmp_path / "c"), ResultCache(tmp_path / "r")):
+        entry = evicted_entry(cache, "key")
+        assert cache.materialize(entry, tmp_path) is None
+        assert cache.open_entry(entry) is None
+        assert not [name for name in os.listdir(tmp_path) if name.startswith("cached_")]
+
+
+def test_conversion_evicted_after_lookup_is_converted_again(tmp_path):
+    conversions = ConversionCache(tmp_path / "c")
+    image = io.BytesIO()
+    Image.new("RGB", (40, 30), "white").save(image, "PNG")
+    source = io.BytesIO(image.getvalue())
+    key = combine_drive_files.conversion_key(source)
+    source.seek(0)
+    conversions.store(key, io.BytesIO(b"%PDF-1.4 cached\n"), file_type="pdf")
+    lookup = conversions.lookup
+
+    def lookup_then_evict(key):
+        entry = lookup(key)
+        os.remove(entry["path"])
+        return entry
+
+    conversions.lookup = lookup_then_evict
+    calls = []
+
+    def convert(src, output):
+        calls.append(1)
+        output.write(b"%PDF-1.4 converted\n")
+
+    pdf_file = combine_drive_files._convert_image(source, "png", "file", None, convert, conversions, None)
+    assert calls == [1]
+    assert pdf_file.read() == b"%PDF-1.4 converted\n"
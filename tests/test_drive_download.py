@@ -0,0 +1,85 @@
+"""Hedged Drive download strategies, against the Drive stand-in (benchmarks/drive_stub.py)."""
+
+import io
+import time
+
+import pytest
+
+import combine_drive_files
+from benchmarks.drive_stub import make_statement_pdf
+from stage_timing import StageTimings
+
+PDF = make_statement_pdf(2)
+# Big enough that reading it whole would show, never parsed
+LARGE_PDF = b"%PDF-1.4\n" + b"0" * 1_000_000
+
+
+@pytest.fixture(autouse=True)
+def fresh_strategy_scores(monkeypatch):
+    """Start every test from the default strategy order (direct, confirm, scrape)."""
+    monkeypatch.setattr(combine_drive_files, "_strategy_scores", {"direct": 0.0, "confirm": 0.0, "scrape": 0.0})
+    monkeypatch.setattr(combine_drive_files, "_strategy_wins", {"direct": 0, "confirm": 0, "scrape": 0})
+
+
+def strategy_outcomes(timings):
+    return {span["strategy"]: span["outcome"] for span in timings.spans if span["stage"] == "strategy"}
+
+
+@pytest.mark.parametrize("hedged", [False, True])
+@pytest.mark.parametrize("mode, winner", [("direct", "direct"), ("scan", "confirm"), ("link", "scrape")])
+def test_each_drive_page_is_handled_by_its_strategy(drive_stub, mode, winner, hedged):
+    drive_stub({"file": (mode, "pdf", PDF)})
+    out = io.BytesIO()
+    timings = StageTimings()
+
+    info = combine_drive_files._fetch_from_google_drive("file", out, hedged=hedged, timings=timings)
+
+    assert out.getvalue() == PDF
+    assert info["strategy"] == winner
+    assert info["file_type"] == "pdf"
+    assert strategy_outcomes(timings)[winner] == "won"
+
+
+def test_sign_in_page_is_reported_as_not_shared(drive_stub):
+    drive_stub({"file": ("signin", "pdf", PDF)})
+    with pytest.raises(ValueError) as error:
+        combine_drive_files._fetch_from_google_drive("file", io.BytesIO(), hedged=True)
+    assert str(error.value) == combine_drive_files.AUTH_REQUIRED_MESSAGE
+
+
+def test_slow_strategy_is_hedged_with_the_next_one(drive_stub, monkeypatch):
+    drive_stub({"file": ("slow", "pdf", PDF)})
+    monkeypatch.setattr(combine_drive_files, "HEDGE_DELAY", 0.05)
+    timings = StageTimings()
+    out = io.BytesIO()
+
+    combine_drive_files._fetch_from_google_drive("file", out, hedged=True, timings=timings)
+
+    assert out.getvalue() == PDF
+    # The loser's span ends once its response is opened and released
+    deadline = time.time() + 5
+    while len(strategy_outcomes(timings)) < 2 and time.time() < deadline:
+        time.sleep(0.02)
+    outcomes = strategy_outcomes(timings)
+    assert sorted(outcomes.values())[:2] == ["lost", "won"]
+    assert "direct" in outcomes and "confirm" in outcomes
+
+
+def test_scrape_gives_up_on_a_file_after_its_first_bytes(drive_stub, monkeypatch):
+    drive_stub({"file": ("direct", "pdf", LARGE_PDF)})
+    responses = []
+    http_get = combine_drive_files.http_get
+
+    def recording_get(*args, **kwargs):
+        response = http_get(*args, **kwargs)
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(combine_drive_files, "http_get", recording_get)
+    session = combine_drive_files.new_session()
+    with pytest.raises(combine_drive_files._StrategyFailed, match="served the file directly"):
+        combine_drive_files._strategy_scrape("file", session, cancelled=None)
+
+    [response] = responses
+    assert response.raw.tell() < 64 * 1024
+    assert response.raw.closed
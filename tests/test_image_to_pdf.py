@@ -0,0 +1,87 @@
+"""image_to_pdf: JPEG passthrough and the decoded-image memory ceiling."""
+
+import io
+
+import PyPDF2
+import pytest
+from PIL import Image
+
+import combine_drive_files
+from combine_drive_files import image_to_pdf
+
+
+def image_bytes(size, fmt, mode="RGB", **save_args):
+    image = Image.radial_gradient("L").resize(size).convert(mode)
+    data = io.BytesIO()
+    image.save(data, fmt, **save_args)
+    return data.getvalue()
+
+
+def pdf_image(data):
+    """The single image XObject of a one-page PDF, and the page's size in points."""
+    page = PyPDF2.PdfReader(io.BytesIO(data)).pages[0]
+    xobjects = page["/Resources"]["/XObject"]
+    [name] = list(xobjects)
+    return xobjects[name].get_object(), (float(page.mediabox.width), float(page.mediabox.height))
+
+
+@pytest.mark.parametrize("mode, color_space", [("RGB", "/DeviceRGB"), ("L", "/DeviceGray")])
+def test_baseline_jpeg_is_embedded_unchanged(mode, color_space):
+    jpeg = image_bytes((640, 480), "JPEG", mode, quality=80)
+    output = io.BytesIO()
+    report = image_to_pdf(io.BytesIO(jpeg), output)
+
+    image, page_size = pdf_image(output.getvalue())
+    assert report["passthrough"] is True
+    assert image["/Filter"] == "/DCTDecode"
+    assert image["/ColorSpace"] == color_space
+    assert image._data == jpeg
+    # Same page size as the Pillow path: IMAGE_RESOLUTION pixels per inch
+    assert page_size == pytest.approx((640 * 72 / 100, 480 * 72 / 100))
+
+
+@pytest.mark.parametrize("save_args", [{"progressive": True}, {}], ids=["progressive", "cmyk"])
+def test_jpeg_that_cannot_be_embedded_is_reencoded(save_args):
+    mode = "RGB" if save_args else "CMYK"
+    jpeg = image_bytes((320, 240), "JPEG", mode, **save_args)
+    output = io.BytesIO()
+    report = image_to_pdf(io.BytesIO(jpeg), output)
+
+    image, _ = pdf_image(output.getvalue())
+    assert report["passthrough"] is False
+    assert image._data != jpeg
+    assert (image["/Width"], image["/Height"]) == (320, 240)
+
+
+def test_passthrough_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(combine_drive_files, "JPEG_PASSTHROUGH", False)
+    output = io.BytesIO()
+    report = image_to_pdf(io.BytesIO(image_bytes((64, 48), "JPEG")), output)
+    assert report["passthrough"] is False
+
+
+def test_png_over_the_pixel_ceiling_is_refused_before_decoding(monkeypatch):
+    monkeypatch.setattr(combine_drive_files, "MAX_IMAGE_PIXELS", 10_000)
+    png = image_bytes((200, 100), "PNG", "RGBA")
+    with pytest.raises(ValueError, match="too large"):
+        image_to_pdf(io.BytesIO(png), io.BytesIO())
+
+    report = image_to_pdf(io.BytesIO(image_bytes((100, 100), "PNG", "RGBA")), io.BytesIO())
+    assert report["pixels"] == 10_000
+
+
+def test_large_jpeg_is_decoded_under_the_ceiling(monkeypatch):
+    monkeypatch.setattr(combine_drive_files, "MAX_IMAGE_PIXELS", 10_000)
+    # 36x the ceiling: decoded at 1/8 scale, never at full size
+    jpeg = image_bytes((600, 600), "JPEG", progressive=True)
+    output = io.BytesIO()
+    report = image_to_pdf(io.BytesIO(jpeg), output)
+
+    assert report["pixels"] <= 10_000
+    assert report["peak_image_bytes"] <= 2 * 3 * 10_000
+    _, page_size = pdf_image(output.getvalue())
+    assert page_size == pytest.approx((600 * 72 / 100, 600 * 72 / 100))
+
+    # Past what even 1/8 scale can bring under the ceiling
+    with pytest.raises(ValueError, match="too large"):
+        image_to_pdf(io.BytesIO(image_bytes((900, 900), "JPEG", progressive=True)), io.BytesIO())
@@ -0,0 +1,109 @@
+"""The /jobs API of app.py: submit, poll, fetch the result, failure and expiry."""
+
+import io
+import os
+import time
+
+import PyPDF2
+import pytest
+
+import app
+from benchmarks.drive_stub import make_statement_pdf
+from job_queue import JobQueue
+
+PDF = make_statement_pdf(2)
+
+
+def drive_link(file_id):
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def result_dir(monkeypatch, tmp_path):
+    """Start without a job result directory, creating it under tmp_path."""
+    monkeypatch.setattr(app, "_job_result_dir", None)
+    monkeypatch.setattr(app.tempfile, "tempdir", str(tmp_path))
+    return tmp_path
+
+
+def wait_for(client, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f"/jobs/{job_id}").get_json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_job_runs_in_the_background_and_serves_its_result(drive_stub, client, result_dir):
+    drive_stub({"job-slow": ("slow", "pdf", PDF), "job-direct": ("direct", "pdf", PDF)})
+    assert not list(result_dir.iterdir())
+
+    response = client.post("/jobs", json={"links": [drive_link("job-slow"), drive_link("job-direct")],
+                                          "filename": "statement"})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert response.headers["Location"] == f"/jobs/{job['id']}" == job["status_url"]
+    assert job["status"] in ("queued", "running")
+    assert job["filename"] == "statement.pdf" and job["links"] == 2
+
+    # The slow file holds the job back long enough to ask too early
+    early = client.get(f"/jobs/{job['id']}/result")
+    assert early.status_code == 409
+
+    status = wait_for(client, job["id"])
+    assert status["status"] == "done"
+    assert status["result_url"] == f"/jobs/{job['id']}/result"
+    assert "download" in status["stages"]
+
+    result = client.get(status["result_url"])
+    assert result.status_code == 200
+    assert result.mimetype == "application/pdf"
+    assert 'filename=statement.pdf' in result.headers["Content-Disposition"]
+    assert len(PyPDF2.PdfReader(io.BytesIO(result.data)).pages) == 4
+    # The result directory is made by the first job
+    [job_dir] = result_dir.iterdir()
+    assert job_dir.name.startswith("feb_job_results_")
+    assert os.path.dirname(app.job_queue.get(job["id"]).result) == str(job_dir)
+
+
+def test_failed_job_reports_its_error(drive_stub, client, result_dir):
+    drive_stub({"job-private": ("signin", "pdf", PDF)})
+    job = client.post("/jobs", json={"links": [drive_link("job-private")] * 2}).get_json()
+
+    status = wait_for(client, job["id"])
+    assert status["status"] == "failed"
+    assert status["error"]
+    assert "result_url" not in status
+    result = client.get(f"/jobs/{job['id']}/result")
+    assert result.status_code == 500
+    assert result.get_json()["status"] == "failed"
+
+
+def test_expired_job_and_its_result_are_gone(drive_stub, client, result_dir, monkeypatch):
+    drive_stub({"job-expiring": ("direct", "pdf", PDF)})
+    queue = JobQueue(ttl=60, on_expire=app._delete_job_result)
+    monkeypatch.setattr(app, "job_queue", queue)
+    job = client.post("/jobs", json={"links": [drive_link("job-expiring")] * 2}).get_json()
+    wait_for(client, job["id"])
+    path = queue.get(job["id"]).result
+    assert os.path.isfile(path)
+
+    queue.ttl = 0
+    time.sleep(0.01)
+    queue.expire()
+    assert not os.path.exists(path)
+    for url in (f"/jobs/{job['id']}", f"/jobs/{job['id']}/result"):
+        assert client.get(url).status_code == 404
+
+
+def test_invalid_body_is_rejected_before_queueing(client):
+    response = client.post("/jobs", json={"links": "not a list"})
+    assert response.status_code == 400
+    assert "error" in response.get_json()
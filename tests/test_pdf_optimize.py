@@ -0,0 +1,109 @@
+"""Output size / DPI budget (fit_pdf_to_budget) and the lossless optimize pass."""
+
+import io
+
+import PyPDF2
+from PIL import Image
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject, NumberObject, TextStringObject
+
+from combine_drive_files import merge_pdfs
+from pdf_optimize import fit_pdf_to_budget, letter_dpi, optimize_pdf
+
+
+def image_pdf(*sizes):
+    """A PDF with one JPEG-embedded photo-like image per page, of the given pixel sizes."""
+    pages = []
+    for width, height in sizes:
+        image = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+        pages.append(image)
+    data = io.BytesIO()
+    pages[0].save(data, "PDF", save_all=True, append_images=pages[1:], resolution=72)
+    return data.getvalue()
+
+
+def page_images(data):
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    images = []
+    for page in reader.pages:
+        xobjects = page["/Resources"]["/XObject"].get_object()
+        images.extend(xobjects[name].get_object() for name in xobjects)
+    return images
+
+
+def test_dpi_cap_leaves_under_cap_images_untouched():
+    source = image_pdf((3000, 2000), (300, 200))
+    big, small = page_images(source)
+    max_dpi = 100
+    assert letter_dpi(3000, 2000) > max_dpi > letter_dpi(300, 200)
+
+    output = io.BytesIO()
+    fit_pdf_to_budget(io.BytesIO(source), output, max_bytes=None, max_dpi=max_dpi)
+    new_big, new_small = page_images(output.getvalue())
+
+    assert new_small._data == small._data
+    assert new_small["/Filter"] == small["/Filter"]
+    assert (new_small["/Width"], new_small["/Height"]) == (300, 200)
+    # The over-cap image is downscaled to the cap
+    assert letter_dpi(new_big["/Width"], new_big["/Height"]) <= max_dpi + 1
+    assert new_big._data != big._data
+
+
+def bookmarked_pdf(title, field=None):
+    """A one-page PDF with a bookmark to its page and, optionally, a text field on it."""
+    writer = PyPDF2.PdfWriter()
+    writer.add_blank_page(200, 200)
+    writer.add_outline_item(title, 0)
+    if field is not None:
+        widget = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject("/Widget"),
+            NameObject("/FT"): NameObject("/Tx"),
+            NameObject("/T"): TextStringObject(field),
+            NameObject("/Rect"): ArrayObject(NumberObject(n) for n in (10, 10, 100, 30)),
+        }))
+        writer.pages[0][NameObject("/Annots")] = ArrayObject([widget])
+        writer._root_object[NameObject("/AcroForm")] = DictionaryObject({NameObject("/Fields"): ArrayObject([widget])})
+    data = io.BytesIO()
+    writer.write(data)
+    data.seek(0)
+    return data
+
+
+def test_optimized_merge_keeps_bookmarks():
+    outputs = {}
+    for optimize in (False, True):
+        output = io.BytesIO()
+        merge_pdfs([bookmarked_pdf("Sec"), bookmarked_pdf("Sec")], output, max_bytes=None, max_dpi=None,
+                   optimize=optimize)
+        reader = PyPDF2.PdfReader(io.BytesIO(output.getvalue()))
+        outputs[optimize] = [item.title for item in reader.outline]
+    assert outputs[True] == outputs[False] == ["Sec", "Sec"]
+
+
+def test_optimize_keeps_form_fields_on_their_page():
+    output = io.BytesIO()
+    optimize_pdf(bookmarked_pdf("Form", field="amount"), output)
+    reader = PyPDF2.PdfReader(io.BytesIO(output.getvalue()))
+
+    assert list(reader.get_fields()) == ["amount"]
+    field = reader.trailer["/Root"]["/AcroForm"].raw_get("/Fields")[0]
+    widget = reader.pages[0].raw_get("/Annots")[0]
+    # The field and the page's widget are one object, not two copies
+    assert field.idnum == widget.idnum
+    assert [item.title for item in reader.outline] == ["Form"]
+
+
+def test_optimize_stores_an_image_shared_by_two_inputs_once():
+    merged = io.BytesIO()
+    merge_pdfs([io.BytesIO(image_pdf((300, 200))), io.BytesIO(image_pdf((300, 200)))], merged,
+               max_bytes=None, max_dpi=None, optimize=False)
+    output = io.BytesIO()
+    report = optimize_pdf(io.BytesIO(merged.getvalue()), output)
+
+    reader = PyPDF2.PdfReader(io.BytesIO(output.getvalue()))
+    images = [page["/Resources"]["/XObject"].raw_get(name)
+              for page in reader.pages for name in page["/Resources"]["/XObject"]]
+    assert len(reader.pages) == 2
+    assert report["deduplicated"] >= 1
+    assert images[0].idnum == images[1].idnum
+    assert report["bytes"] < len(merged.getvalue())
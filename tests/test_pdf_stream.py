@@ -0,0 +1,41 @@
+"""StreamingPdfWriter, the bounded-memory merge (combine_pdfs(streaming=True))."""
+
+import io
+
+import PyPDF2
+
+from combine_drive_files import combine_pdfs
+
+
+def blank_pdf(*widths):
+    """A PDF with one blank page per width, so pages can be told apart."""
+    writer = PyPDF2.PdfWriter()
+    for width in widths:
+        writer.add_blank_page(width, 100)
+    data = io.BytesIO()
+    writer.write(data)
+    data.seek(0)
+    return data
+
+
+def test_streaming_merge_writes_pages_in_order():
+    output = io.BytesIO()
+    report = combine_pdfs([blank_pdf(100, 110), blank_pdf(120)], output, streaming=True)
+
+    reader = PyPDF2.PdfReader(io.BytesIO(output.getvalue()))
+    assert report["pages"] == 3
+    assert report["bytes"] == len(output.getvalue())
+    assert [float(page.mediabox.width) for page in reader.pages] == [100, 110, 120]
+    # Every page hangs off the one merged page tree
+    pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+    assert all(page.raw_get("/Parent").idnum == pages_ref.idnum for page in reader.pages)
+
+
+def test_streaming_merge_matches_the_in_memory_merge():
+    outputs = []
+    for streaming in (False, True):
+        output = io.BytesIO()
+        combine_pdfs([blank_pdf(100), blank_pdf(200, 300)], output, streaming=streaming)
+        reader = PyPDF2.PdfReader(io.BytesIO(output.getvalue()))
+        outputs.append([(float(p.mediabox.width), float(p.mediabox.height)) for p in reader.pages])
+    assert outputs[0] == outputs[1]
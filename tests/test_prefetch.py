@@ -0,0 +1,103 @@
+"""Prefetcher queueing and back-off, and /prefetch warming the caches for later combines."""
+
+import threading
+import time
+
+import pytest
+
+import app
+import combine_service
+import prefetch
+from benchmarks.drive_stub import make_statement_pdf
+from prefetch import Prefetcher
+
+PDF = make_statement_pdf(1)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_duplicates_are_skipped_and_overflow_dropped():
+    release = threading.Event()
+    fetched = []
+
+    def fetch(item):
+        release.wait(5)
+        fetched.append(item)
+
+    prefetcher = Prefetcher(fetch, workers=1, max_pending=2)
+    first = prefetcher.submit([("a", 1), ("a", 1)])
+    assert first == {"queued": 1, "skipped": 1, "dropped": 0}
+    wait_until(lambda: prefetcher.stats()["running"] == 1)
+
+    # 'a' is being fetched, two more fit in the queue
+    second = prefetcher.submit([("a", 1), ("b", 2), ("c", 3), ("d", 4)])
+    assert second == {"queued": 2, "skipped": 1, "dropped": 1}
+
+    release.set()
+    wait_until(lambda: prefetcher.stats()["done"] == 3)
+    assert fetched == [1, 2, 3]
+    assert prefetcher.stats() == {"done": 3, "failed": 0, "dropped": 1, "pending": 0, "running": 0}
+    # Once fetched, a key may be queued again
+    assert prefetcher.submit([("a", 1)])["queued"] == 1
+
+
+def test_failures_are_counted_not_raised():
+    def fetch(item):
+        raise ValueError("not shared")
+
+    prefetcher = Prefetcher(fetch, workers=1)
+    prefetcher.submit([("a", 1)])
+    wait_until(lambda: prefetcher.stats()["failed"] == 1)
+    assert prefetcher.stats()["running"] == 0
+
+
+def test_nothing_is_fetched_while_combines_are_busy(monkeypatch):
+    monkeypatch.setattr(prefetch, "_BUSY_POLL_SECONDS", 0.01)
+    busy = threading.Event()
+    busy.set()
+    fetched = []
+    prefetcher = Prefetcher(fetched.append, workers=2, busy=busy.is_set)
+
+    prefetcher.submit([("a", 1), ("b", 2)])
+    time.sleep(0.1)
+    assert fetched == []
+    assert prefetcher.stats()["pending"] == 2
+
+    busy.clear()
+    wait_until(lambda: prefetcher.stats()["done"] == 2)
+    assert sorted(fetched) == [1, 2]
+
+
+def test_disabled_prefetcher_answers_404(monkeypatch):
+    monkeypatch.setattr(combine_service, "prefetcher", Prefetcher(lambda item: None, workers=0))
+    response = app.app.test_client().post("/prefetch", json={"links": []})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("body", [{}, {"links": "https://drive.google.com/file/d/abc/view"}, {"links": [1]}])
+def test_prefetch_rejects_a_body_without_a_links_list(body):
+    response = app.app.test_client().post("/prefetch", json=body)
+    assert response.status_code == 400
+
+
+def test_prefetched_file_is_cached_for_the_combine(drive_stub, monkeypatch):
+    drive_stub({"prefetch-a": ("direct", "pdf", PDF)})
+    monkeypatch.setattr(combine_service, "prefetcher", Prefetcher(combine_service.prefetch_file, workers=1))
+    client = app.app.test_client()
+    link = "https://drive.google.com/file/d/prefetch-a/view"
+
+    response = client.post("/prefetch", json={"links": [link, link + "?usp=sharing", "https://example.com/x"]})
+    assert response.status_code == 202
+    assert response.get_json() == {"queued": 1, "skipped": 1, "dropped": 0, "invalid": 1}
+    wait_until(lambda: combine_service.prefetcher.stats()["done"] == 1)
+    assert combine_service.download_cache.lookup("prefetch-a") is not None
+
+    combined = client.post("/combine", json={"links": [link, link]})
+    assert combined.status_code == 200
+    # Served from the download cache: no transfer from Drive
+    assert "transfer" not in combined.headers["Server-Timing"]
@@ -0,0 +1,41 @@
+"""Cleanup when one file of a combine fails while others are still being fetched."""
+
+import os
+import threading
+import time
+
+import pytest
+
+import combine_drive_files
+
+
+def test_failed_combine_cleans_up_files_still_running(tmp_path, monkeypatch):
+    release = threading.Event()
+    written = []
+
+    def fake_process_file(link, temp_dir, *args):
+        if link.endswith("bad"):
+            raise ValueError("not a PDF")
+        # Still downloading when the other file fails
+        release.wait(5)
+        path = os.path.join(temp_dir, f"{link.rsplit('/', 1)[-1]}.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n")
+        written.append(path)
+        return path
+
+    monkeypatch.setattr(combine_drive_files, "process_file", fake_process_file)
+    links = [
+        "https://drive.google.com/file/d/bad",
+        "https://drive.google.com/file/d/slow1",
+        "https://drive.google.com/file/d/slow2",
+    ]
+    with pytest.raises(ValueError):
+        list(combine_drive_files.iter_processed_files(links, temp_dir=str(tmp_path), max_workers=3))
+
+    release.set()
+    deadline = time.time() + 5
+    while (len(written) < 2 or os.listdir(tmp_path)) and time.time() < deadline:
+        time.sleep(0.02)
+    assert len(written) == 2
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,100 @@
+"""Replaying a combine from the result cache, with its ETag and If-None-Match (304)."""
+
+import asyncio
+import hashlib
+import time
+
+import httpx
+
+import app
+import asgi_app
+from benchmarks.drive_stub import make_statement_pdf
+
+PDF = make_statement_pdf(2)
+
+
+def drive_link(file_id):
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+
+def server_timing(response):
+    return response.headers.get("Server-Timing", "")
+
+
+def test_repeated_combine_is_replayed_and_can_be_revalidated(drive_stub):
+    drive_stub({"replay-a": ("direct", "pdf", PDF), "replay-b": ("direct", "pdf", PDF)})
+    client = app.app.test_client()
+    body = {"links": [drive_link("replay-a"), drive_link("replay-b")]}
+
+    first = client.post("/combine", json=body)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag == f'"{hashlib.sha256(first.data).hexdigest()}"'
+
+    # Another spelling of the same links is the same combine
+    again = client.post("/combine", json={"links": [drive_link("replay-a") + "?usp=sharing", drive_link("replay-b")]})
+    assert again.status_code == 200
+    assert again.data == first.data
+    assert again.headers["ETag"] == etag
+    assert "result_cache" in server_timing(again)
+    assert "download" not in server_timing(again) and "merge" not in server_timing(again)
+
+    cached = client.post("/combine", json=body, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == etag
+
+    stale = client.post("/combine", json=body, headers={"If-None-Match": '"something-else"'})
+    assert stale.status_code == 200
+    assert stale.data == first.data
+    assert "download" not in server_timing(stale)
+
+
+def test_changed_settings_are_a_different_result(drive_stub):
+    drive_stub({"replay-budget": ("direct", "pdf", PDF)})
+    client = app.app.test_client()
+    links = [drive_link("replay-budget")] * 2
+
+    first = client.post("/combine", json={"links": links})
+    other = client.post("/combine", json={"links": links, "max_dpi": 72},
+                        headers={"If-None-Match": first.headers["ETag"]})
+    assert other.status_code == 200
+    assert "merge" in server_timing(other)
+
+
+def test_asgi_server_answers_304_for_the_same_result(drive_stub):
+    drive_stub({"replay-asgi": ("direct", "pdf", PDF)})
+    body = {"links": [drive_link("replay-asgi")] * 2}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = await client.post("/combine", json=body)
+            second = await client.post("/combine", json=body, headers={"If-None-Match": first.headers["ETag"]})
+            return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert first.headers["ETag"] == f'"{hashlib.sha256(first.content).hexdigest()}"'
+    assert second.status_code == 304
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+
+def test_job_result_carries_the_etag_of_the_combine(drive_stub):
+    drive_stub({"replay-job": ("direct", "pdf", PDF)})
+    client = app.app.test_client()
+    body = {"links": [drive_link("replay-job")] * 2}
+    combined = client.post("/combine", json=body)
+
+    job = client.post("/jobs", json=body).get_json()
+    deadline = time.time() + 30
+    while client.get(f"/jobs/{job['id']}").get_json()["status"] not in ("done", "failed"):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    result = client.get(f"/jobs/{job['id']}/result")
+    assert result.status_code == 200
+    assert result.data == combined.data
+    assert result.headers["ETag"] == combined.headers["ETag"]
+    revalidated = client.get(f"/jobs/{job['id']}/result", headers={"If-None-Match": combined.headers["ETag"]})
+    assert revalidated.status_code == 304
@@ -0,0 +1,93 @@
+"""Range resume of dropped Drive downloads, against the Drive stand-in (benchmarks/drive_stub.py)."""
+
+import io
+
+import pytest
+import requests
+
+import combine_drive_files
+from drive_cache import DownloadCache
+from drive_http import IncompleteDownload, copy_body, http_get, range_source
+
+DATA = b"%PDF-1.4\n" + bytes(range(256)) * 2048
+DROP_AT = 100_000
+
+
+def dropping(chunks, after):
+    """The chunks of a body, cut off with a connection error once `after` bytes have gone by."""
+    sent = 0
+    for chunk in chunks:
+        if sent + len(chunk) >= after:
+            yield chunk[:after - sent]
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+        sent += len(chunk)
+        yield chunk
+
+
+def test_dropped_body_is_resumed_with_a_range_request(drive_stub):
+    stub = drive_stub({"file": ("direct", "pdf", DATA)})
+    response = http_get(f"{stub.base_url}/uc?export=download&id=file", stream=True)
+    source = range_source(response)
+    assert source["ranges"] and source["length"] == len(DATA) and source["validator"]
+
+    out = io.BytesIO()
+    written = copy_body(dropping(response.iter_content(8192), DROP_AT), out, source, close=response.close)
+    assert written == len(DATA)
+    assert out.getvalue() == DATA
+
+
+def test_body_that_cannot_be_resumed_reports_what_arrived(drive_stub):
+    stub = drive_stub({"file": ("direct", "pdf", DATA)})
+    response = http_get(f"{stub.base_url}/uc?export=download&id=file", stream=True)
+    out = io.BytesIO()
+    with pytest.raises(IncompleteDownload) as error:
+        copy_body(dropping(response.iter_content(8192), DROP_AT), out, None, close=response.close)
+    assert error.value.written == DROP_AT == len(out.getvalue())
+
+
+def test_partial_download_is_kept_and_finished_by_the_next_attempt(drive_stub, monkeypatch, tmp_path):
+    drive_stub({"file": ("direct", "pdf", DATA)})
+    cache = DownloadCache(tmp_path)
+    real_copy_body = combine_drive_files.copy_body
+    calls = []
+
+    def copy_body_that_drops(chunks, out, source=None, written=0, **kwargs):
+        calls.append(written)
+        if len(calls) == 1:
+            # The first download drops and may not resume within the request
+            return real_copy_body(dropping(chunks, DROP_AT), out, source, written, **dict(kwargs, max_resumes=0))
+        return real_copy_body(chunks, out, source, written, **kwargs)
+
+    monkeypatch.setattr(combine_drive_files, "copy_body", copy_body_that_drops)
+    with pytest.raises(IncompleteDownload):
+        combine_drive_files._fetch_drive_file("file", None, cache, None)
+    # The sniffed first bytes were written before the copied body
+    kept = calls[0] + DROP_AT
+    assert cache.lookup_partial("file")["bytes"] == kept
+
+    pdf_file, file_type, origin = combine_drive_files._fetch_drive_file("file", None, cache, None)
+    with pdf_file:
+        assert pdf_file.read() == DATA
+    assert (file_type, origin) == ("pdf", "resume")
+    assert calls[-1] == kept
+    assert cache.lookup_partial("file") is None
+
+
+def test_large_file_is_fetched_as_parallel_ranges(drive_stub, monkeypatch):
+    drive_stub({"file": ("direct", "pdf", DATA)})
+    monkeypatch.setattr(combine_drive_files, "RANGE_PARTS", 3)
+    monkeypatch.setattr(combine_drive_files, "RANGE_PART_MIN_BYTES", 64 * 1024)
+    opened = []
+    open_range = combine_drive_files.open_range
+
+    def recording_open_range(source, start, end=None):
+        opened.append((start, end))
+        return open_range(source, start, end)
+
+    monkeypatch.setattr(combine_drive_files, "open_range", recording_open_range)
+    out = io.BytesIO()
+    combine_drive_files._fetch_from_google_drive("file", out, hedged=False)
+
+    assert out.getvalue() == DATA
+    assert len(opened) == 2
+    assert opened[-1][1] == len(DATA)
@@ -0,0 +1,169 @@
+"""Request parsing and request metrics of the combine servers."""
+
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+import asgi_app
+import combine_service
+import metrics
+from werkzeug.test import EnvironBuilder
+
+BOUNDARY = "feb-test-boundary"
+
+TRUNCATED_MULTIPART = (
+    f"--{BOUNDARY}\r\n"
+    'Content-Disposition: form-data; name="file"; filename="receipt.pdf"\r\n'
+    "Content-Type: application/pdf\r\n\r\n"
+    "%PDF-1.4 not the whole file"
+).encode()
+
+
+def in_flight():
+    return metrics.requests_in_flight.value(endpoint="combine")
+
+
+def asgi_scope(content_type):
+    """Scope of a POST /combine to asgi_app."""
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/combine",
+        "raw_path": b"/combine",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", content_type.encode())],
+        "client": ("127.0.0.1", 1234),
+        "server": ("127.0.0.1", 80),
+    }
+
+
+def test_truncated_upload_finishes_request_flask():
+    before = in_flight()
+    # Content-Length promises more than the body holds, as when the client goes away mid-upload
+    environ = EnvironBuilder(
+        path="/combine",
+        method="POST",
+        input_stream=io.BytesIO(TRUNCATED_MULTIPART),
+        content_type=f"multipart/form-data; boundary={BOUNDARY}",
+    ).get_environ()
+    environ["CONTENT_LENGTH"] = str(len(TRUNCATED_MULTIPART) + 4096)
+    response = app.app.response_class.from_app(app.app, environ)
+    assert response.status_code == 400
+    assert in_flight() == before
+    assert metrics.requests_total.value(endpoint="combine", outcome="disconnected") >= 1
+
+
+def test_truncated_upload_finishes_request_asgi():
+    before = in_flight()
+    messages = [
+        {"type": "http.request", "body": TRUNCATED_MULTIPART, "more_body": True},
+        {"type": "http.disconnect"},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = asgi_scope(f"multipart/form-data; boundary={BOUNDARY}")
+    asyncio.run(asgi_app.app(scope, receive, send))
+    assert sent[0]["status"] == 400
+    assert in_flight() == before
+
+
+def test_cancelled_combine_finishes_request_asgi(monkeypatch):
+    before = in_flight()
+    started = asyncio.Event()
+
+    async def combine_forever(*args):
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(asgi_app, "combine_once", combine_forever)
+    monkeypatch.setattr(combine_service, "result_cache", None)
+    body = json.dumps({"links": ["https://drive.google.com/file/d/abc/view"]}).encode()
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def scenario():
+        # As the server does when the client goes away mid-combine
+        request = asyncio.ensure_future(asgi_app.app(asgi_scope("application/json"), receive, send))
+        await started.wait()
+        assert in_flight() == before + 1
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+
+    asyncio.run(scenario())
+    assert in_flight() == before
+    assert metrics.requests_total.value(endpoint="combine", outcome="disconnected") >= 1
+
+
+def test_servers_share_state_without_importing_each_other():
+    code = "import sys, asgi_app, combine_service; print('app' in sys.modules)"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.split()[-1] == "False"
+
+@pytest.mark.parametrize("field", ["max_bytes", "max_dpi"])
+@pytest.mark.parametrize("value", [0, -5, "-1", float("inf"), float("nan"), "abc"])
+def test_budget_rejects_non_positive_or_non_finite(field, value):
+    with pytest.raises(ValueError):
+        combine_service.budget_from_request({field: value})
+
+
+def test_budget_rejected_with_400():
+    client = app.app.test_client()
+    for body in ({"max_bytes": -5}, {"max_dpi": -1}):
+        body["links"] = ["https://drive.google.com/file/d/abc/view"]
+        response = client.post("/combine", json=body)
+        assert response.status_code == 400
+        assert "positive" in response.get_json()["error"]
+
+
+def test_budget_defaults_and_valid_values():
+    assert combine_service.budget_from_request({}) == (combine_service.MAX_OUTPUT_BYTES, combine_service.MAX_IMAGE_DPI)
+    assert combine_service.budget_from_request({"max_bytes": "2000000", "max_dpi": "150"}) == (2000000, 150.0)
+
+
+@pytest.mark.parametrize("body", [
+    {"links": ["https://drive.google.com/file/d/abc/view", "https://example.com/receipt.pdf"]},
+    {"link1": "https://drive.google.com/file/d/abc/view", "link2": "not a link"},
+    {"links": ["https://drive.google.com/open?id="]},
+])
+def test_non_drive_link_rejected_before_admission(body, monkeypatch):
+    def no_admission(*args, **kwargs):
+        raise AssertionError("a bad request took an admission slot")
+
+    monkeypatch.setattr(combine_service.admission, "acquire", no_admission)
+    monkeypatch.setattr(combine_service.admission, "acquire_async", no_admission)
+    response = app.app.test_client().post("/combine", json=body)
+    assert response.status_code == 400
+    assert "Google Drive" in response.get_json()["error"]
+
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app.app(asgi_scope("application/json"), receive, send))
+    assert sent[0]["status"] == 400
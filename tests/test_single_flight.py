@@ -0,0 +1,134 @@
+"""Coalescing of identical concurrent work (SingleFlight, AsyncSingleFlight) and shared downloads."""
+
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+
+import combine_drive_files
+from benchmarks.drive_stub import make_statement_pdf
+from single_flight import AsyncSingleFlight, SingleFlight
+from stage_timing import StageTimings
+
+
+def run_together(count, target):
+    """Run target(index) on count threads and return their results in order."""
+    results = [None] * count
+    errors = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target(index)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def test_concurrent_callers_share_one_call_and_get_private_copies():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return io.BytesIO(b"result")
+
+    def caller(index):
+        if index:
+            started.wait(5)
+        return flight.do("key", work, share=lambda f: io.BytesIO(f.getvalue()))
+
+    def release_when_all_joined():
+        while flight._calls.get("key") is None or flight._calls["key"].callers < 3:
+            time.sleep(0.001)
+        release.set()
+
+    threading.Thread(target=release_when_all_joined, daemon=True).start()
+    results, errors = run_together(3, caller)
+
+    assert errors == [None] * 3
+    assert calls == [1]
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    files = [f for f, _ in results]
+    assert len({id(f) for f in files}) == 3
+    assert all(f.getvalue() == b"result" for f in files)
+    assert flight.in_flight() == 0
+
+
+def test_error_reaches_every_caller_and_the_key_is_forgotten():
+    flight = SingleFlight()
+    joined = threading.Event()
+
+    def failing():
+        while flight._calls["key"].callers < 2:
+            time.sleep(0.001)
+        joined.set()
+        raise ValueError("Drive said no")
+
+    def caller(index):
+        if index:
+            while "key" not in flight._calls:
+                time.sleep(0.001)
+        return flight.do("key", failing)
+
+    _, errors = run_together(2, caller)
+    assert joined.is_set()
+    assert [str(e) for e in errors] == ["Drive said no"] * 2
+    # Nothing is cached: the next call runs again
+    assert flight.do("key", lambda: 42) == (42, False)
+
+
+def test_async_call_keeps_running_for_others_when_its_starter_is_cancelled():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return "pdf"
+
+        first = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, calls, flight.in_flight()
+
+    (result, shared), calls, in_flight = asyncio.run(scenario())
+    assert (result, shared) == ("pdf", True)
+    assert calls == [1]
+    assert in_flight == 0
+
+
+def test_concurrent_downloads_of_one_file_hit_drive_once(drive_stub):
+    pdf = make_statement_pdf(1)
+    # 'slow' holds the first byte back long enough for both threads to meet
+    drive_stub({"file": ("slow", "pdf", pdf)})
+    timings = StageTimings()
+
+    results, errors = run_together(2, lambda _: combine_drive_files.fetch_drive_file("file", timings=timings))
+
+    assert errors == [None, None]
+    for source, file_type in results:
+        with source:
+            assert source.read() == pdf
+            assert file_type == "pdf"
+    sources = sorted(span["source"] for span in timings.spans if span["stage"] == "download")
+    assert sources == ["coalesced", "drive"]
+    assert len([span for span in timings.spans if span["stage"] == "transfer"]) == 1
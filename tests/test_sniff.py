@@ -0,0 +1,55 @@
+"""File type sniffing from the first streamed bytes, and early abort of unsupported downloads."""
+
+import io
+
+import pytest
+
+import combine_drive_files
+from benchmarks.drive_stub import make_statement_pdf
+
+# Not a PDF, PNG or JPEG, and far bigger than the bytes sniffed
+GIF = b"GIF89a" + b"\0" * 1_000_000
+
+
+def test_sniffer_knows_the_type_from_the_first_four_bytes():
+    sniffer = combine_drive_files._StreamSniffer()
+    assert sniffer.feed(b"\x89P") is None
+    assert sniffer.feed(b"NG\r\n\x1a\n") == "png"
+
+
+def test_sniffer_rejects_html_after_a_bounded_read():
+    sniffer = combine_drive_files._StreamSniffer("text/html; charset=utf-8")
+    assert sniffer.feed(b"<!DOCTYPE html><html><body>Sign in") is None
+    with pytest.raises(combine_drive_files._StrategyFailed) as error:
+        sniffer.feed(b" " * combine_drive_files.SNIFF_ERROR_BYTES)
+    assert error.value.html and error.value.auth_required
+
+
+def test_unsupported_download_is_aborted_after_its_first_bytes(drive_stub, monkeypatch):
+    drive_stub({"file": ("direct", "pdf", GIF)})
+    responses = []
+    http_get = combine_drive_files.http_get
+
+    def recording_get(*args, **kwargs):
+        response = http_get(*args, **kwargs)
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(combine_drive_files, "http_get", recording_get)
+    with pytest.raises(ValueError, match="Unsupported file type"):
+        combine_drive_files._fetch_from_google_drive("file", io.BytesIO(), hedged=False)
+
+    assert responses
+    for response in responses:
+        assert response.raw.tell() < 64 * 1024
+        assert response.raw.closed
+
+
+def test_process_file_keeps_the_bytes_read_while_sniffing(drive_stub):
+    pdf = make_statement_pdf(1)
+    drive_stub({"file": ("direct", "pdf", pdf)})
+    pdf_file = combine_drive_files.process_file("https://drive.google.com/file/d/file/view")
+    try:
+        assert pdf_file.read() == pdf
+    finally:
+        pdf_file.close()